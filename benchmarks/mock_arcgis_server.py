@@ -0,0 +1,384 @@
+'''
+Local stand-in for an ArcGIS REST services directory, to benchmark (and try)
+the downloader without hitting a live portal.
+
+    {item}?f=json                                  -> folders
+    {item}/{folder}?f=json                         -> MapServer services of the folder
+    {item}/{folder}/{service}/MapServer?f=json     -> layers (id, name)
+    {item}/{folder}/{service}/MapServer/layers     -> every layer metadata
+    {item}/{folder}/{service}/MapServer/{id}       -> layer metadata (maxRecordCount, supportsPagination...)
+    {item}/{folder}/{service}/MapServer/{id}/query -> features (json / geojson), count, ids
+
+Queries understand resultOffset / resultRecordCount paging, ObjectID ranges
+("OBJECTID >= a AND OBJECTID <= b"), edit dates ("EDIT_DATE > TIMESTAMP '...'"),
+envelope filters and max / min / sum / count outStatistics, which is
+everything ARCGIS_Client sends.
+
+Usage:
+    with ARCGIS_MockServer(features=20000, latency=0.05) as server:
+        client = ARCGIS_Client(base_url=server.url, item=server.item)
+'''
+import re
+import json
+import math
+import time
+import random
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+GEOMETRY_TYPES = {
+    'point': "esriGeometryPoint",
+    'polyline': "esriGeometryPolyline",
+    'polygon': "esriGeometryPolygon",
+    }
+# Roughly Peru, like the portal crawled by default.
+EXTENT = {'xmin': -81.5, 'ymin': -18.5, 'xmax': -68.5, 'ymax': 0.0, 'spatialReference': {'wkid': 4326, 'latestWkid': 4326}}
+LAST_EDIT_DATE = 1700000000000 # ms, every mock feature was edited then.
+
+
+class ARCGIS_MockServer:
+    '''
+    folders / services_per_folder / layers_per_service: size of the services directory.
+    features: features per layer (int), or {layer id: features}.
+    max_record_count: maxRecordCount of every layer.
+    vertices: vertices per ring / path, the geometry complexity.
+    geometry_type: "polygon", "polyline" or "point".
+    latency: seconds slept before answering every request (plus up to jitter seconds).
+    error_rate: share of /query requests answered with an error (HTTP 500 or an ArcGIS error body).
+    rate_limit: max requests per second, the ones above are answered 429 with Retry-After.
+    supports_pagination: False answers resultOffset queries with an error, like old servers.
+    query_formats: supportedQueryFormats advertised (pbf is not served).
+    editing_info: False leaves editingInfo out of the layer metadata (only the edit-date field is left).
+    '''
+    def __init__(self, folders: int = 2, services_per_folder: int = 2, layers_per_service: int = 2, features=5000, max_record_count: int = 1000, vertices: int = 32, geometry_type: str = "polygon", latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, rate_limit: float = None, retry_after: int = 1, supports_pagination: bool = True, query_formats: str = "JSON, geoJSON", editing_info: bool = True, item: str = "/server/rest/services", host: str = "127.0.0.1", port: int = 0, seed: int = 0):
+        if geometry_type not in GEOMETRY_TYPES:
+            raise Exception(f"geometry_type must be one of {list(GEOMETRY_TYPES)}")
+        self.folders = [f"Folder{i}" for i in range(folders)]
+        self.services_per_folder = services_per_folder
+        self.layers_per_service = layers_per_service
+        self.features = features
+        self.max_record_count = max_record_count
+        self.vertices = max(2, vertices)
+        self.geometry_type = geometry_type
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.supports_pagination = supports_pagination
+        self.query_formats = query_formats
+        self.editing_info = editing_info
+        self.item = "/" + item.strip("/")
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'queries': 0, 'errors': 0, 'throttled': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+        self._window = []
+        self._layers = {}
+        self.server = None
+
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+
+    def start(self):
+
+        handler = type("Handler", (_Handler,), {'mock': self})
+        self.server = ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def n_layers(self):
+        return len(self.folders) * self.services_per_folder * self.layers_per_service
+
+
+    def layer_count(self, layer_id: int):
+        if isinstance(self.features, dict):
+            return self.features.get(layer_id, 0)
+        return self.features
+
+
+    def layer_features(self, layer_id: int):
+        """
+        The Esri json features of a layer, built once (deterministic) and kept.
+        """
+        with self._lock:
+            if layer_id not in self._layers:
+                self._layers[layer_id] = [self._feature(layer_id, oid) for oid in range(1, self.layer_count(layer_id) + 1)]
+            return self._layers[layer_id]
+
+
+    def total_features(self):
+        return sum(self.layer_count(i) for i in range(self.layers_per_service)) * len(self.folders) * self.services_per_folder
+
+
+    # Directory
+    def route(self, path, params):
+        """
+        path -> (status, headers, body bytes).
+        """
+        parts = [x for x in path[len(self.item):].split("/") if x]
+        if not path.startswith(self.item):
+            return self._json({'error': {'code': 404, 'message': "Not found"}})
+        if len(parts) == 0:
+            return self._json({'currentVersion': 10.91, 'folders': self.folders, 'services': []})
+        if len(parts) == 1 and parts[0] in self.folders:
+            services = [{'name': f"{parts[0]}/Service{j}", 'type': "MapServer"} for j in range(self.services_per_folder)]
+            return self._json({'currentVersion': 10.91, 'folders': [], 'services': services})
+        if len(parts) == 3 and parts[2] == "MapServer":
+            return self._json({'layers': [{'id': i, 'name': f"Layer{i}"} for i in range(self.layers_per_service)]})
+        if len(parts) == 4 and parts[3] == "layers":
+            return self._json({'layers': [self.layer_metadata(i) for i in range(self.layers_per_service)], 'tables': []})
+        if len(parts) == 4 and parts[3].isdigit() and int(parts[3]) < self.layers_per_service:
+            return self._json(self.layer_metadata(int(parts[3])))
+        if len(parts) == 5 and parts[4] == "query" and parts[3].isdigit() and int(parts[3]) < self.layers_per_service:
+            return self.query(int(parts[3]), params)
+        return self._json({'error': {'code': 404, 'message': f"Not found: {path}"}})
+
+
+    def layer_metadata(self, layer_id: int):
+
+        metadata = {
+            'id': layer_id,
+            'name': f"Layer{layer_id}",
+            'type': "Feature Layer",
+            'geometryType': GEOMETRY_TYPES[self.geometry_type],
+            'objectIdField': "OBJECTID",
+            'maxRecordCount': self.max_record_count,
+            'supportsPagination': self.supports_pagination,
+            'advancedQueryCapabilities': {'supportsPagination': self.supports_pagination},
+            'supportedQueryFormats': self.query_formats,
+            'extent': EXTENT,
+            'editingInfo': {'lastEditDate': LAST_EDIT_DATE},
+            'editFieldsInfo': {'editDateField': "EDIT_DATE"},
+            'fields': [
+                {'name': "OBJECTID", 'type': "esriFieldTypeOID", 'alias': "OBJECTID"},
+                {'name': "NAME", 'type': "esriFieldTypeString", 'alias': "Nombre"},
+                {'name': "CATEGORY", 'type': "esriFieldTypeString", 'alias': "Categoria"},
+                {'name': "AREA", 'type': "esriFieldTypeDouble", 'alias': "Area"},
+                {'name': "EDIT_DATE", 'type': "esriFieldTypeDate", 'alias': "Fecha"},
+                ],
+            }
+        if not self.editing_info:
+            metadata.pop('editingInfo')
+        return metadata
+
+
+    # Query
+    def query(self, layer_id, params):
+
+        with self._lock:
+            self.stats['queries'] += 1
+            throttled = self._throttled()
+            failed = (not throttled) and (self.random.random() < self.error_rate)
+        if throttled:
+            with self._lock:
+                self.stats['throttled'] += 1
+            return 429, {'Retry-After': str(self.retry_after)}, b""
+        if failed:
+            with self._lock:
+                self.stats['errors'] += 1
+            if self.random.random() < 0.5:
+                return 500, {}, b"Internal Server Error"
+            return self._json({'error': {'code': 500, 'message': "Error performing query operation", 'details': []}})
+
+        features = self._filter(self.layer_features(layer_id), params)
+        if params.get('returnCountOnly') == "true":
+            return self._json({'count': len(features)})
+        if params.get('returnIdsOnly') == "true":
+            return self._json({'objectIdFieldName': "OBJECTID", 'objectIds': [f['attributes']['OBJECTID'] for f in features]})
+        if params.get('outStatistics'):
+            statistics = json.loads(params['outStatistics'])
+            functions = {'max': max, 'min': min, 'sum': sum, 'count': len}
+            attributes = {}
+            for x in statistics:
+                values = [f['attributes'][x['onStatisticField']] for f in features]
+                attributes[x['outStatisticFieldName']] = functions[x['statisticType']](values) if (values or x['statisticType'] in ['count', 'sum']) else None
+            return self._json({'features': [{'attributes': attributes}]})
+
+        if 'resultOffset' in params and not self.supports_pagination:
+            return self._json({'error': {'code': 400, 'message': "Pagination is not supported.", 'details': []}})
+        offset = int(params.get('resultOffset', 0))
+        count = min(int(params.get('resultRecordCount', self.max_record_count)), self.max_record_count)
+        page = features[offset:offset + count]
+        exceeded = offset + count < len(features)
+
+        if params.get('f') == "geojson":
+            return self._json({
+                'type': "FeatureCollection",
+                'features': [self._geojson_feature(f) for f in page],
+                'properties': {'exceededTransferLimit': exceeded},
+                })
+        return self._json({
+            'objectIdFieldName': "OBJECTID",
+            'geometryType': GEOMETRY_TYPES[self.geometry_type],
+            'spatialReference': EXTENT['spatialReference'],
+            'fields': self.layer_metadata(layer_id)['fields'],
+            'features': page,
+            'exceededTransferLimit': exceeded,
+            })
+
+
+    def _filter(self, features, params):
+
+        where = params.get('where', "")
+        match = re.search(r"OBJECTID\s*>=\s*(\d+)\s+AND\s+OBJECTID\s*<=\s*(\d+)", where)
+        if match:
+            low, high = int(match.group(1)), int(match.group(2))
+            features = features[max(0, low - 1):high] # ObjectIDs are 1..n in order.
+        match = re.search(r"EDIT_DATE\s*>\s*TIMESTAMP\s*'([^']+)'", where)
+        if match:
+            since = datetime.datetime.strptime(match.group(1)[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp() * 1000
+            features = [f for f in features if f['attributes']['EDIT_DATE'] > since]
+        if params.get('objectIds'):
+            object_ids = {int(x) for x in str(params['objectIds']).split(",") if x.strip()}
+            features = [f for f in features if f['attributes']['OBJECTID'] in object_ids]
+        if params.get('geometry'):
+            envelope = json.loads(params['geometry'])
+            features = [f for f in features if self._intersects(f, envelope)]
+        return features
+
+
+    def _throttled(self):
+        """
+        Sliding one second window of the /query requests (called under the lock).
+        """
+        if self.rate_limit is None:
+            return False
+        now = time.monotonic()
+        self._window = [t for t in self._window if now - t < 1.0]
+        if len(self._window) >= self.rate_limit:
+            return True
+        self._window.append(now)
+        return False
+
+
+    # Features
+    def _feature(self, layer_id, oid):
+        """
+        Deterministic feature: a shape of self.vertices vertices somewhere in EXTENT.
+        """
+        golden = (math.sqrt(5) - 1) / 2
+        u = (oid * golden + layer_id * 0.1) % 1
+        v = (oid * golden * golden + layer_id * 0.3) % 1
+        cx = EXTENT['xmin'] + u * (EXTENT['xmax'] - EXTENT['xmin'])
+        cy = EXTENT['ymin'] + v * (EXTENT['ymax'] - EXTENT['ymin'])
+        radius = 0.005 + 0.02 * ((oid * 7919) % 100) / 100
+        attributes = {
+            'OBJECTID': oid,
+            'NAME': f"Feature {layer_id}-{oid}",
+            'CATEGORY': f"Category {oid % 12}",
+            'AREA': round(math.pi * radius ** 2, 8),
+            'EDIT_DATE': LAST_EDIT_DATE,
+            }
+        if self.geometry_type == "point":
+            return {'attributes': attributes, 'geometry': {'x': round(cx, 6), 'y': round(cy, 6)}}
+        angles = [2 * math.pi * i / self.vertices for i in range(self.vertices)]
+        if self.geometry_type == "polyline":
+            path = [[round(cx + radius * (2 * i / self.vertices - 1), 6), round(cy + radius * math.sin(a), 6)] for i, a in enumerate(angles)]
+            return {'attributes': attributes, 'geometry': {'paths': [path]}}
+        # Clockwise outer ring, closed.
+        ring = [[round(cx + radius * math.cos(-a), 6), round(cy + radius * math.sin(-a), 6)] for a in angles]
+        return {'attributes': attributes, 'geometry': {'rings': [ring + [ring[0]]]}}
+
+
+    @staticmethod
+    def _coordinates(feature):
+        geometry = feature['geometry']
+        if 'x' in geometry:
+            return [[geometry['x'], geometry['y']]]
+        return [xy for part in geometry.get('rings', geometry.get('paths', [])) for xy in part]
+
+
+    def _intersects(self, feature, envelope):
+        coordinates = self._coordinates(feature)
+        xs, ys = [x for x, y in coordinates], [y for x, y in coordinates]
+        return not (min(xs) > envelope['xmax'] or max(xs) < envelope['xmin'] or min(ys) > envelope['ymax'] or max(ys) < envelope['ymin'])
+
+
+    def _geojson_feature(self, feature):
+        geometry = feature['geometry']
+        if 'x' in geometry:
+            shape = {'type': "Point", 'coordinates': [geometry['x'], geometry['y']]}
+        elif 'paths' in geometry:
+            shape = {'type': "LineString", 'coordinates': geometry['paths'][0]}
+        else:
+            # GeoJSON wants counter-clockwise outer rings.
+            shape = {'type': "Polygon", 'coordinates': [ring[::-1] for ring in geometry['rings']]}
+        return {'type': "Feature", 'id': feature['attributes']['OBJECTID'], 'properties': feature['attributes'], 'geometry': shape}
+
+
+    def _json(self, body):
+        return 200, {'Content-Type': "application/json; charset=utf-8"}, json.dumps(body).encode("utf-8")
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    mock = None
+    protocol_version = "HTTP/1.1" # Keep-alive, like a real server behind a pooled session.
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_GET(self):
+        mock = self.mock
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if mock.latency or mock.jitter:
+            time.sleep(mock.latency + mock.jitter * random.random())
+        status, headers, body = mock.route(url.path.rstrip("/"), params)
+        with mock._lock:
+            mock.stats['requests'] += 1
+            mock.stats['bytes'] += len(body)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a mock ArcGIS services directory until Ctrl+C.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--features", type=int, default=5000)
+    parser.add_argument("--vertices", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit", type=float, default=None)
+    args = parser.parse_args()
+
+    with ARCGIS_MockServer(features=args.features, vertices=args.vertices, latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit, port=args.port) as server:
+        print(f"Mock ArcGIS server on {server.url}{server.item}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
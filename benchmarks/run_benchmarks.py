@@ -0,0 +1,259 @@
+'''
+Offline benchmarks of the downloader against benchmarks/mock_arcgis_server.py:
+
+    download_layer[...]  ARCGIS_Client.downloading_layer of one layer (json / geojson, sequential / parallel pages)
+    assigning_geometry   Esri json -> shapely geometries of a whole layer
+    write_*              output writers (csv, geojson, GeoParquet, GeoJSONSeq) of that layer
+    etl_crawl            scripts/run_etl_pipeline.run_all over the whole mock directory
+
+Reports seconds, throughput (features/s, MB/s of the server responses) and
+the peak python memory (tracemalloc) of each benchmark. Results can be saved
+with --save and checked against a previous run with --compare, the script
+exits with 1 when a benchmark got slower than --tolerance.
+
+    python benchmarks/run_benchmarks.py --features 20000 --vertices 64 --latency 0.02
+'''
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import importlib.util
+import tracemalloc
+import contextlib
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Nothing is written to the real outputs/ (read by src/config.py at import).
+OUTPUTS_DIR = os.environ.setdefault('ARCGIS_OUTPUTS_DIR', tempfile.mkdtemp(prefix="arcgis_benchmarks_"))
+
+import pandas as pd
+import geopandas as gpd
+
+from mock_arcgis_server import ARCGIS_MockServer
+from src.arcgis_client import ARCGIS_Client
+from src.utils import assigning_geometry
+from src.writers import GeoJSONSeqWriter, write_geoparquet
+
+
+class Benchmark:
+    '''
+    Times a callable (best of repeat runs) and records its peak python memory.
+    '''
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.results = []
+
+
+    def measure(self, name: str, function, features: int = None, nbytes=None, repeat: int = 1, setup=None):
+        """
+        function() is timed repeat times, then run once more under tracemalloc
+        (setup() before each run, not timed).
+        nbytes: bytes processed per run, or a callable returning them after the runs.
+        """
+        seconds = []
+        for _ in range(max(1, repeat)):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            with self._output():
+                function()
+            seconds.append(time.perf_counter() - start)
+
+        # tracemalloc slows python code down a lot, memory gets its own run.
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        with self._output():
+            function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        best = min(seconds)
+        if callable(nbytes):
+            nbytes = nbytes()
+        result = {
+            'name': name,
+            'seconds': round(best, 4),
+            'features': features,
+            'features_per_s': round(features / best, 1) if features else None,
+            'mb_per_s': round(nbytes / 1e6 / best, 2) if nbytes else None,
+            'peak_memory_mb': round(peak / 1e6, 2),
+            }
+        self.results.append(result)
+        print(f"{name:<40} {best:>9.3f}s {self._format(result['features_per_s'], 'feat/s'):>18} {self._format(result['mb_per_s'], 'MB/s'):>12} {result['peak_memory_mb']:>9.1f} MB peak")
+        return result
+
+
+    def _output(self):
+        # The client prints every page, keep the report readable.
+        return contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+    @staticmethod
+    def _format(value, unit):
+        return "-" if value is None else f"{value:,.0f} {unit}" if value >= 100 else f"{value:.2f} {unit}"
+
+
+def make_client(server, **options):
+
+    options.setdefault('backoff', 0.05)
+    return ARCGIS_Client(base_url=server.url, item=server.item, **options)
+
+
+def first_layer(client):
+    """
+    (project, sub_folder, layer) of the first mock layer, with its output directories.
+    """
+    client.create_projects_directories()
+    project = client.project_list[0]
+    client.querying_projects(project)
+    client.create_main_folder_directories(project)
+    sub_folder = client.sub_folder_list[0]
+    client.querying_sub_folder(project, sub_folder)
+    client.create_layer_directories(project, sub_folder)
+    return project, sub_folder, client.layers_list[0]
+
+
+def bench_download(bench, server, repeat, page_workers=(1, 4), query_formats=("json", "geojson")):
+
+    n_features = server.layer_count(0)
+    for query_format in query_formats:
+        for workers in page_workers:
+            client = make_client(server, page_workers=workers, query_format=query_format, output_formats=('parquet',))
+            with contextlib.redirect_stdout(io.StringIO()):
+                layer = first_layer(client)
+            start_bytes = server.stats['bytes']
+            bench.measure(
+                f"download_layer[{query_format}, page_workers={workers}]",
+                lambda: client.downloading_layer(*layer),
+                features=n_features,
+                nbytes=lambda: (server.stats['bytes'] - start_bytes) / (repeat + 1),
+                repeat=repeat,
+                )
+
+
+def bench_geometry_and_writers(bench, server, repeat):
+
+    features = server.layer_features(0)
+    n_features = len(features)
+
+    def frame():
+        df = pd.json_normalize(features)
+        df.columns = df.columns.str.lower()
+        return df
+
+    state = {}
+    bench.measure("assigning_geometry", lambda: state.update(df=assigning_geometry(state['df'])), features=n_features, repeat=repeat, setup=lambda: state.update(df=frame()))
+
+    gdf = gpd.GeoDataFrame(state['df'].drop(columns=[x for x in state['df'].columns if x in ['rings', 'paths', 'x', 'y']]), geometry='geometry', crs="EPSG:4326")
+    directory = os.path.join(OUTPUTS_DIR, "writers")
+    os.makedirs(directory, exist_ok=True)
+    path = lambda extension: os.path.join(directory, f"layer{extension}")
+
+    def geojsonseq():
+        writer = GeoJSONSeqWriter(path(".geojsonl"))
+        for start in range(0, len(gdf), server.max_record_count):
+            writer.write(gdf.iloc[start:start + server.max_record_count])
+        writer.close()
+
+    writers = [
+        ("write_csv", ".csv", lambda: gdf.to_csv(path(".csv"), index=False)),
+        ("write_geojson", ".geojson", lambda: gdf.to_file(path(".geojson"), driver='GeoJSON')),
+        ("write_geoparquet", ".parquet", lambda: write_geoparquet(gdf, path(".parquet"))),
+        ("write_geojsonseq[pages]", ".geojsonl", geojsonseq),
+        ]
+    for name, extension, function in writers:
+        bench.measure(name, function, features=n_features, nbytes=lambda: os.path.getsize(path(extension)), repeat=repeat)
+
+
+def bench_crawl(bench, server, workers):
+    """
+    The whole scripts/run_etl_pipeline.py run over every mock project.
+    """
+    spec = importlib.util.spec_from_file_location("run_etl_pipeline", os.path.join(BASE_DIR, "scripts", "run_etl_pipeline.py"))
+    pipeline = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pipeline)
+
+    start_bytes = server.stats['bytes']
+    bench.measure(
+        f"etl_crawl[{server.n_layers()} layers, workers={workers}]",
+        lambda: pipeline.run_all(workers=workers, base_url=server.url, item=server.item, backoff=0.05, output_formats=['parquet']),
+        features=server.total_features(),
+        nbytes=lambda: server.stats['bytes'] - start_bytes,
+        )
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Returns the names of the benchmarks slower than the baseline by more than tolerance (share).
+    """
+    with open(baseline_path) as f:
+        baseline = {x['name']: x for x in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        if result['name'] not in baseline:
+            continue
+        before = baseline[result['name']]['seconds']
+        change = (result['seconds'] - before) / before if before else 0
+        flag = ""
+        if change > tolerance:
+            regressions.append(result['name'])
+            flag = "  <-- REGRESSION"
+        print(f"{result['name']:<40} {before:>9.3f}s -> {result['seconds']:>9.3f}s ({change:+.0%}){flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks against a local mock ArcGIS server.")
+    parser.add_argument("--only", type=str, nargs="+", choices=["download", "geometry", "crawl"], default=["download", "geometry", "crawl"])
+    parser.add_argument("--features", type=int, default=5000, help="Features per layer")
+    parser.add_argument("--vertices", type=int, default=32, help="Vertices per ring / path")
+    parser.add_argument("--geometry_type", type=str, choices=["polygon", "polyline", "point"], default="polygon")
+    parser.add_argument("--max_record_count", type=int, default=1000)
+    parser.add_argument("--folders", type=int, default=2)
+    parser.add_argument("--services", type=int, default=2, help="Services per folder")
+    parser.add_argument("--layers", type=int, default=2, help="Layers per service")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Share of queries answered with an error")
+    parser.add_argument("--rate_limit", type=float, default=None, help="Queries per second before answering 429")
+    parser.add_argument("--workers", type=int, default=4, help="Layers downloaded at the same time in the crawl")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the best one is kept")
+    parser.add_argument("--save", type=str, default=None, help="Write the results to this json")
+    parser.add_argument("--compare", type=str, default=None, help="Results json of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown (share) reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Show the client output")
+    args = parser.parse_args()
+
+    server = ARCGIS_MockServer(
+        folders=args.folders, services_per_folder=args.services, layers_per_service=args.layers,
+        features=args.features, max_record_count=args.max_record_count, vertices=args.vertices,
+        geometry_type=args.geometry_type, latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+        )
+    bench = Benchmark(verbose=args.verbose)
+    print(f"Mock server: {server.n_layers()} layers x {args.features} {args.geometry_type}s ({args.vertices} vertices), outputs in {OUTPUTS_DIR}")
+    try:
+        with server:
+            if "download" in args.only:
+                bench_download(bench, server, args.repeat)
+            if "geometry" in args.only:
+                bench_geometry_and_writers(bench, server, args.repeat)
+            if "crawl" in args.only:
+                bench_crawl(bench, server, args.workers)
+            print(f"Server: {server.stats}")
+    finally:
+        if os.path.basename(OUTPUTS_DIR).startswith("arcgis_benchmarks_"):
+            shutil.rmtree(OUTPUTS_DIR, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({'arguments': vars(args), 'results': bench.results}, f, indent=2)
+    if args.compare:
+        regressions = compare(bench.results, args.compare, args.tolerance)
+        if regressions:
+            sys.exit(1)
@@ -1,51 +1,42 @@
+import os
 import sys
+import json
 import argparse
 
 sys.path.insert(0, "/".join(sys.path[0].split("/")[:-1]))
 
 from src.arcgis_client import ARCGIS_Client, projects
+from src.engine import ARCGIS_DownloadEngine
+from src.config import BASE_URL, SERVICES_ITEM
+from src.metrics import ARCGIS_Metrics, METRICS_DIR
+from src.response_cache import ARCGIS_ResponseCache, CACHE_DIR
+from src.spatial_index import ARCGIS_SpatialIndex
 
 
-def run_all():
+def run_all(workers=1, per_host=4, **client_options):
 
-    client = ARCGIS_Client()
-    client.retrieve_arcgis_gis_projects()
+    client = ARCGIS_Client(**client_options)
+    with ARCGIS_DownloadEngine(client, workers=workers, per_host=per_host) as engine:
+        engine.collect_jobs(projects=projects if projects else None)
+        engine.run()
 
-    for project in projects:
-        client.create_projects_directories()
-        client.querying_projects(project=project)
-        client.create_main_folder_directories(project=project)
-        for sub_folder in client.sub_folder_list:
-            client.querying_sub_folder(project=project, sub_folder=sub_folder)
-            client.create_layer_directories(project=project, sub_folder=sub_folder)
-            for layer in client.layers_list:
-                try:
-                    client.downloading_layer(
-                        project=project, sub_folder=sub_folder, layer=layer
-                    )
-                except Exception as e:
-                    print(f"Error downloading layer {layer}: {e}")
 
+def run_map_server(project, workers=1, per_host=4, **client_options):
 
-def run_map_server(project):
+    client = ARCGIS_Client(**client_options)
+    with ARCGIS_DownloadEngine(client, workers=workers, per_host=per_host) as engine:
+        engine.collect_jobs(projects=[project])
+        engine.run()
 
-    client = ARCGIS_Client()
-    client.retrieve_arcgis_gis_projects()
 
-    client.create_projects_directories()
-    client.querying_projects(project=project)
-    client.create_main_folder_directories(project=project)
-
-    for sub_folder in client.sub_folder_list:
-        client.querying_sub_folder(project=project, sub_folder=sub_folder)
-        client.create_layer_directories(project=project, sub_folder=sub_folder)
-        for layer in client.layers_list:
-            try:
-                client.downloading_layer(
-                    project=project, sub_folder=sub_folder, layer=layer
-                )
-            except Exception as e:
-                print(f"Error downloading layer {layer}: {e}")
+def json_option(value):
+    """
+    A json file path or an inline json string -> python object.
+    """
+    if os.path.exists(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
 
 
 if __name__ == "__main__":
@@ -55,11 +46,90 @@ if __name__ == "__main__":
     parser.add_argument(
         "--project", type=str, help="Name of the project to run", default=None
     )
+    parser.add_argument(
+        "--base_url", type=str, help="ArcGIS server, e.g. https://minesportal.arcgis.pe", default=BASE_URL
+    )
+    parser.add_argument(
+        "--item", type=str, help="Services directory path on the server", default=SERVICES_ITEM
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Number of layers downloaded at the same time", default=1
+    )
+    parser.add_argument(
+        "--per_host", type=int, help="Max concurrent layers against the same host", default=4
+    )
+    parser.add_argument(
+        "--page_workers", type=int, help="Pages of a single layer fetched at the same time", default=1
+    )
+    parser.add_argument(
+        "--output_formats", type=str, nargs="+", choices=["csv", "geojson", "parquet"], help="Formats written per layer", default=["csv", "geojson"]
+    )
+    parser.add_argument(
+        "--stream_format", type=str, choices=["geojsonseq", "parquet"], help="Write each page to disk as it arrives (bounded memory)", default=None
+    )
+    parser.add_argument(
+        "--query_format", type=str, choices=["auto", "json", "geojson", "pbf"], help="Query response format, auto picks the most compact the server supports", default="auto"
+    )
+    parser.add_argument(
+        "--max_allowable_offset", type=float, help="Server-side generalization tolerance (degrees)", default=None
+    )
+    parser.add_argument(
+        "--geometry_precision", type=int, help="Decimals kept in the coordinates", default=None
+    )
+    parser.add_argument(
+        "--quantization_tolerance", type=float, help="Quantize geometries on the server with this tolerance (degrees)", default=None
+    )
+    parser.add_argument(
+        "--layer_geometry_options", type=json_option, help='Per layer geometry options on top of the ones above, a json file or string: {"project/service/layer" or layer name: {"max_allowable_offset": ..., "geometry_precision": ..., "quantization_tolerance": ...}}', default=None
+    )
+    parser.add_argument(
+        "--tiled", action="store_true", help="Query layers by an adaptive quadtree of envelopes instead of offset paging"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true", help="Skip layers unchanged since the last run, merge edits where possible"
+    )
+    parser.add_argument(
+        "--resumable", action="store_true", help="Checkpoint every page, resume interrupted layers and skip finished ones"
+    )
+    parser.add_argument(
+        "--metrics_dir", type=str, help="Where the JSON-lines run report and the Prometheus textfile are written", default=METRICS_DIR
+    )
+    parser.add_argument(
+        "--transform_workers", type=int, help="Processes normalizing / building geometries / encoding pages while downloading, e.g. the number of cores (0: in the download threads)", default=0
+    )
+    parser.add_argument(
+        "--pipeline_depth", type=int, help="Pages in flight per layer between download and write (default 2 x transform_workers)", default=None
+    )
+    parser.add_argument(
+        "--cache", action="store_true", help="Keep the server responses in an on-disk cache and answer from it when fresh"
+    )
+    parser.add_argument(
+        "--offline", action="store_true", help="Answer only from the response cache, never hit the server (implies --cache)"
+    )
+    parser.add_argument(
+        "--cache_dir", type=str, help="Response cache directory", default=CACHE_DIR
+    )
+    parser.add_argument(
+        "--cache_size_gb", type=float, help="Response cache size cap, least recently used entries are evicted", default=2.0
+    )
+    parser.add_argument(
+        "--spatial_index", action="store_true", help="Keep the spatial index of the outputs (per layer + layer extents) up to date after every layer, for ARCGIS_SpatialIndex queries"
+    )
     args = parser.parse_args()
 
+    geometry_options = dict(
+        max_allowable_offset=args.max_allowable_offset,
+        geometry_precision=args.geometry_precision,
+        quantization_tolerance=args.quantization_tolerance,
+    )
+    cache = None
+    if args.cache or args.offline:
+        cache = ARCGIS_ResponseCache(args.cache_dir, max_bytes=int(args.cache_size_gb * 1024 ** 3), offline=args.offline)
+    client_options = dict(base_url=args.base_url, item=args.item, page_workers=args.page_workers, output_formats=args.output_formats, stream_format=args.stream_format, query_format=args.query_format, incremental=args.incremental, resumable=args.resumable, tiled=args.tiled, geometry_options=geometry_options, layer_geometry_options=args.layer_geometry_options, metrics=ARCGIS_Metrics.to_directory(args.metrics_dir), cache=cache, transform_workers=args.transform_workers, pipeline_depth=args.pipeline_depth, spatial_index=ARCGIS_SpatialIndex() if args.spatial_index else None)
+
     if args.project:
         print(f"Running project: {args.project}")
-        run_map_server(project=args.project)
+        run_map_server(project=args.project, workers=args.workers, per_host=args.per_host, **client_options)
     else:
         print("Running all projects...")
-        run_all()
+        run_all(workers=args.workers, per_host=args.per_host, **client_options)
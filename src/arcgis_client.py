@@ -1,34 +1,206 @@
 import os
 import pandas as pd 
 import numpy as np
-import logging
 import datetime
-import re
+import time
 import json
+import hashlib
+import contextlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from bs4 import BeautifulSoup
 import geopandas as gpd
+import shapely
 
-from .config import OUTPUTS_DIR
-from .utils import assigning_geometry, ad_hoc_attributes_tweaks
+from .config import OUTPUTS_DIR, BASE_URL, SERVICES_ITEM
+from .utils import assigning_geometry, ad_hoc_attributes_tweaks, read_layer, dequantize_features
 from .decorators import retry
 from .logger_config import setup_logger
+from .layer_job import LayerJob
+from .http_session import ARCGIS_Session, DEFAULT_TIMEOUT
+from .writers import open_stream_writer, write_geoparquet, STREAM_EXTENSIONS, OUTPUT_EXTENSIONS
+from .manifest import SyncManifest, layer_fingerprint, has_edit_metadata
+from .checkpoints import PageJournal, CHECKPOINTS_PATH
+from .catalog import ARCGIS_Catalog
+from .tiling import ARCGIS_TiledQuery
+from .pbf import decode_feature_collection, decode_geojson
+from .rate_control import AdaptivePageSize, ARCGIS_ServerError, ARCGIS_QueryError, is_client_error, is_rejected_query, is_throttled, backoff_delay, retry_after_seconds
+from .metrics import ARCGIS_Metrics
+from .response_cache import ARCGIS_ResponseCache
+from .pipeline import ARCGIS_PagePipeline, transform_pool
 
 logger = setup_logger()
 
 
 projects = []
+QUERY_FORMATS = ['auto', 'json', 'geojson', 'pbf']
+# Throttling / 5xx / ArcGIS server errors, dropped connections, timeouts and
+# truncated bodies. Rejected queries (ARCGIS_QueryError) fail fast.
+RETRYABLE_ERRORS = (
+    ARCGIS_ServerError,
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+    )
+
+
+def normalize_frame(df, name_lower, phase=None):
+    """
+    Normalized features (json_normalize / decoded pages) -> the layer frame
+    fetch_frame builds: lower case columns, geometry built and the layer
+    tweaks applied. rings / paths / x / y are kept (the csv has them).
+    phase(name): optional context manager timing the "normalize" / "geometry" steps.
+    """
+    if phase is None:
+        phase = lambda name: contextlib.nullcontext()
+    with phase('normalize'):
+        df.columns = df.columns.str.lower()
+    with phase('geometry'):
+        df = assigning_geometry(df)
+    with phase('normalize'):
+        df = ad_hoc_attributes_tweaks(df, name_lower)
+    return df
+
+
+def features_to_geodataframe(features, name_lower, phase=None):
+    """
+    Esri json features (one page) -> GeoDataFrame in EPSG:4326, with the same
+    cleanup downloading_layer applies to a whole layer (normalize_frame) and
+    the rings / paths / x / y columns dropped. Pages decoded from pbf / geojson
+    are already a DataFrame with a geometry column.
+    """
+    df = normalize_frame(page_frame(features), name_lower, phase)
+    if 'geometry' not in df.columns:
+        df['geometry'] = None
+
+    to_drop = [x for x in df.columns if x in ['rings', 'paths', 'x', 'y']]
+    gdf = gpd.GeoDataFrame(df.drop(columns=to_drop), geometry='geometry', crs="EPSG:4326")
+    return gdf
+
+
+def page_frame(features):
+    """
+    One page of features -> DataFrame (a copy for decoded pages, which are already one).
+    """
+    return features.copy() if isinstance(features, pd.DataFrame) else pd.json_normalize(features)
+
+
+def add_page(all_features: list, page_features):
+    """
+    Json pages are lists of features, decoded (pbf / geojson) pages are DataFrames.
+    Empty decoded pages are left out (their columns would turn ints into floats).
+    """
+    if isinstance(page_features, pd.DataFrame):
+        if len(page_features) > 0:
+            all_features.append(page_features)
+    else:
+        all_features.extend(page_features)
+
+
+def merge_pages(first: dict, second: dict):
+
+    features = []
+    add_page(features, first['features'])
+    add_page(features, second['features'])
+    if isinstance(first['features'], pd.DataFrame):
+        features = pd.concat(features, ignore_index=True) if features else first['features']
+    return dict(first, features=features)
+
+
+def layer_fields(fields: list, metadata: dict):
+    """
+    Fields of the pages completed with the layer metadata ones (length, domain...),
+    pbf pages only carry name, type and alias. No fields in the pages (geojson): the metadata ones.
+    """
+    known = {field.get('name'): field for field in (metadata or {}).get('fields') or []}
+    if not fields:
+        return list(known.values())
+    return [dict(field, **known.get(field.get('name'), {})) for field in fields]
+
+
+def features_to_frame(all_features: list):
+
+    if len(all_features) > 0 and isinstance(all_features[0], pd.DataFrame):
+        return pd.concat(all_features, ignore_index=True)
+    return pd.json_normalize(all_features)
 
 
 class ARCGIS_Client:
     '''
     base_url example: "https://minesportal.minem.pe"
     item example: "/server/rest/services"
+    catalog_ttl: seconds the crawled services catalog is reused before crawling again.
+    page_workers: > 1 plans every page of a layer up front and fetches them
+                  concurrently (see get_request_parallel).
+    session: shared pooled session used by every request, one is built if not given.
+    timeout: (connect, read) seconds for every request.
+    output_formats: formats written per layer, any of "csv", "geojson" (default both)
+                    and "parquet" (GeoParquet, see parquet_compression / parquet_row_group_size).
+    stream_format: None (default, whole layer in memory -> output_formats), "geojsonseq"
+                   or "parquet" to write each page to disk as it arrives.
+    incremental: skip layers unchanged since the last run and merge edits where
+                 possible, tracked in a SyncManifest (see sync_job).
+    query_format: "auto" (default) negotiates pbf > geojson > json with the server,
+                  or force one of "json", "geojson", "pbf".
+    geometry_options: lighter geometry for every layer, keys max_allowable_offset
+                      (degrees), geometry_precision (decimals) and quantization_tolerance (degrees).
+    layer_geometry_options: {layer label / name: geometry_options} overrides per layer.
+    tiled: query the layer as an adaptive quadtree of envelopes over its extent
+           instead of offset paging (see src/tiling.py), tile_max_depth levels at most.
+    page_retries: attempts per page (with backoff) before the layer download fails.
+    backoff: base seconds of the exponential backoff between attempts.
+    cache: ARCGIS_ResponseCache answering catalog / metadata / query GETs from disk
+           (see src/response_cache.py), e.g. to reprocess a crawl without the server.
+    transform_workers: > 0 runs the normalize / geometry / encoding work of every
+                       page in a pool of that many processes (shared by every layer)
+                       while the pages keep downloading, see src/pipeline.py.
+                       pipeline_depth pages at most are in flight per layer.
+    metrics: ARCGIS_Metrics collecting per request / per layer metrics (see src/metrics.py),
+             an in-memory one (totals only) if not given.
+    resumable: checkpoint every page so a layer interrupted midway (crash, retries
+               exhausted) continues where it stopped on the next run, and finished
+               layers are skipped (see iter_pages_checkpointed). Pages are fetched
+               sequentially in this mode.
     '''
-    def __init__(self, base_url: str, item: str):
+    def __init__(self, base_url: str = BASE_URL, item: str = SERVICES_ITEM, catalog_ttl: int = 24 * 3600, page_workers: int = 1, session: ARCGIS_Session = None, timeout=DEFAULT_TIMEOUT, output_formats=('csv', 'geojson'), parquet_compression: str = "zstd", parquet_row_group_size: int = 50000, stream_format: str = None, incremental: bool = False, resumable: bool = False, query_format: str = 'auto', page_retries: int = 5, backoff: float = 1.0, geometry_options: dict = None, layer_geometry_options: dict = None, tiled: bool = False, tile_max_depth: int = 8, metrics: ARCGIS_Metrics = None, cache: ARCGIS_ResponseCache = None, transform_workers: int = 0, pipeline_depth: int = None, spatial_index=None):
+        if stream_format is not None and stream_format not in STREAM_EXTENSIONS:
+            raise Exception(f"stream_format must be one of {list(STREAM_EXTENSIONS)}")
+        if query_format not in QUERY_FORMATS:
+            raise Exception(f"query_format must be one of {QUERY_FORMATS}")
         self.base_url = base_url
+        self.query_format = query_format
+        self.page_retries = page_retries
+        self.geometry_options = geometry_options or {}
+        self.tiled = tiled
+        self.tile_max_depth = tile_max_depth
+        self.metrics = metrics if metrics is not None else ARCGIS_Metrics()
+        self.layer_geometry_options = layer_geometry_options or {}
+        self.backoff = backoff
+        self.page_workers = page_workers
+        unknown = [x for x in output_formats if x not in OUTPUT_EXTENSIONS]
+        if unknown:
+            raise Exception(f"Unknown output formats {unknown}, options: {list(OUTPUT_EXTENSIONS)}")
+        self.output_formats = tuple(output_formats)
+        self.parquet_compression = parquet_compression
+        self.parquet_row_group_size = parquet_row_group_size
+        self.stream_format = stream_format
+        self.transform_workers = transform_workers or 0
+        self.pipeline_depth = pipeline_depth or 2 * max(1, self.transform_workers)
+        self._transform_pool = None
+        self._transform_pool_lock = threading.Lock()
+        self.spatial_index = spatial_index # ARCGIS_SpatialIndex updated after every layer (see index_job).
+        self.manifest = SyncManifest() if incremental else None
+        self.checkpoints = SyncManifest(CHECKPOINTS_PATH) if resumable else None
+        if session is None:
+            session = ARCGIS_Session(pool_size=max(10, page_workers), timeout=timeout, cache=cache)
+        elif cache is not None:
+            session.cache = cache
+        self.session = session
         self.item = item
         self.url_1 = f"{base_url}{item}/"
+        self.catalog = ARCGIS_Catalog(base_url, item, session, ttl=catalog_ttl, workers=max(8, page_workers))
         self.url = None
         self.feature_params = None
         self.to_scrape_1 = None
@@ -36,26 +208,14 @@ class ARCGIS_Client:
         self.to_scrape_final = None
 
 
-    def retrieve_arcgis_gis_projects(self):
+    def retrieve_arcgis_gis_projects(self, refresh: bool = False):
         """
-        This function retrieves the GIS projects from the ARCGIS website.
+        This function retrieves the GIS projects (folders) from the ARCGIS services
+        directory, through the cached catalog (see src/catalog.py).
         """
-
-        response = requests.get(self.url_1)
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        links = soup.find_all("a")
-        to_scrape_1 = {}
-        starting_str = "/server/rest/services/"
-
-        for link in links:
-            if link.get("href").startswith(starting_str):
-                url_ = link.get("href")
-                name_ = link.text
-                to_scrape_1[name_] = url_
-        
-        self.to_scrape_1 = to_scrape_1
-        self.project_list = list(to_scrape_1.keys())
+        catalog = self.catalog.load(refresh=refresh)
+        self.to_scrape_1 = {project: f"{self.catalog.item}/{project}" for project in catalog.keys()}
+        self.project_list = list(self.to_scrape_1.keys())
         print("Attributes to_scrape_1 and project_list have been created.")
     
 
@@ -83,26 +243,12 @@ class ARCGIS_Client:
         if self.to_scrape_1 is None:
             self.retrieve_arcgis_gis_projects()
         
-        item = self.to_scrape_1[project]
         self.project = project
+        self.url = f"{self.base_url}{self.to_scrape_1[project]}/"
 
-        self.url = f"https://minesportal.arcgis.pe{item}/"
-        response = requests.get(self.url)
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        links = soup.find_all("a")
-        to_scrape_2 = {}
-        starting_str = item
-
-        for link in links:
-            if link.get("href").startswith(starting_str):
-                url_ = link.get("href")
-                name_ = link.text
-                to_scrape_2[name_] = url_
-        
-        self.to_scrape_2 = to_scrape_2
-        self.sub_folder_list = list(to_scrape_2.keys())
-        self.sub_folder_list = [x.split("/")[1] for x in self.sub_folder_list if len(x.split("/")) > 1]
+        services = self.catalog.services(project)
+        self.to_scrape_2 = {f"{project}/{name}": service['path'] for name, service in services.items()}
+        self.sub_folder_list = list(services.keys())
         print("Attributes to_scrape_2 and sub_folder_list have been created.")
 
 
@@ -129,32 +275,11 @@ class ARCGIS_Client:
 
         self.project = project
         self.sub_folder = sub_folder
-        item = self.to_scrape_2[f"{project}/{sub_folder}"]
-
-        self.url = f"https://minesportal.arcgis.pe{item}/"
-        response = requests.get(self.url)
-        soup = BeautifulSoup(response.content, "html.parser")
+        self.url = f"{self.base_url}{self.to_scrape_2[f'{project}/{sub_folder}']}/"
 
-        links = soup.find_all("a")
-        to_scrape_3 = {}
-        starting_str = item
-
-        for link in links:
-            if link.get("href").startswith(starting_str):
-                url_ = link.get("href")
-                name_ = link.text
-                to_scrape_3[name_] = url_
-        
-        first_bit = "/".join(self.url.split("/")[3:]).rstrip("/")
-        pattern =  rf"/{first_bit}/\d+$"
-        to_scrape_final = {}
-
-        for name, value in to_scrape_3.items():
-            if re.match(pattern, value):
-                to_scrape_final[name] = value
-
-        self.to_scrape_final = to_scrape_final
-        self.layers_list = list(to_scrape_final.keys())
+        layers = self.catalog.layers(project, sub_folder)
+        self.to_scrape_final = {name: layer['path'] for name, layer in layers.items()}
+        self.layers_list = list(self.to_scrape_final.keys())
         print("Attributes to_scrape_3 and layers_list have been created.")
 
 
@@ -172,28 +297,62 @@ class ARCGIS_Client:
                 os.mkdir(os.path.join(OUTPUTS_DIR, project, sub_folder, f"{name}"))
                 print(f"Created directory for {project}/{sub_folder}/{name}")
 
-    @retry(retries=4)
-    def downloading_layer(self, project: str, sub_folder: str, layer: str):
-
+    def make_layer_job(self, project: str, sub_folder: str, layer: str):
+        """
+        Builds the LayerJob (per-layer state) used to download a layer.
+        """
         if self.to_scrape_1 is None:
             self.retrieve_arcgis_gis_projects()
         if self.to_scrape_2 is None:
             self.querying_projects(project)
         if self.to_scrape_final is None:
             self.querying_sub_folder(project, sub_folder)
-        
-        self.querying_item = self.to_scrape_final[layer]
-        self.url = f"https://minesportal.arcgis.pe{self.querying_item}/query"
-        name_lower = layer.lower().strip().replace(" ","_")
-        self.name_lower = name_lower
-        self.name = layer
-
-        max_record_count = self.get_metadata_max_records_to_query(self.url)
-        if self.name_lower == 'area':
-            max_record_count = 100
-
-        self.feature_params = {
-            'f': 'json', # Fromat we want.
+
+        job = LayerJob(project, sub_folder, layer, self.to_scrape_final[layer], self.base_url)
+        if (self.manifest is None) and (self.checkpoints is None):
+            # Incremental / resumable runs need fresh edit dates, they ask for the metadata again.
+            job.metadata = self.catalog.layer_metadata(project, sub_folder, layer)
+        return job
+
+
+    def downloading_layer(self, project: str, sub_folder: str, layer: str):
+
+        job = self.make_layer_job(project, sub_folder, layer)
+        try:
+            self.download_job(job)
+        except Exception as e:
+            self.metrics.layer_finished(job.label, 'failed', str(e))
+            raise
+        self.metrics.layer_finished(job.label, 'skipped' if job.skipped else 'done')
+        self.index_job(job)
+
+        # Keep the last downloaded layer reachable from the client (notebook usage).
+        self.querying_item = job.querying_item
+        self.url = job.url
+        self.name = job.name
+        self.name_lower = job.name_lower
+        self.feature_params = job.feature_params
+        self.all_features = job.all_features
+        self.fields = job.fields
+        self.df = job.df
+        self.gdf = job.gdf
+        return job
+
+
+    @retry(retries=4)
+    def download_job(self, job: LayerJob):
+        """
+        Downloads a layer. All the state lives in the job, so this can run
+        for several layers at once (see src/engine.py). Pages that used up
+        their own retries (query_with_retries) or were rejected by the server
+        are not started over by @retry.
+        """
+        max_record_count = self.get_metadata_max_records_to_query(job.url, job)
+        # Heavy layers shrink their pages on their own (see iter_pages).
+        job.sizer = AdaptivePageSize(max_record_count)
+
+        job.feature_params = {
+            'f': self.negotiate_format(job), # Fromat we want.
             'returnGeometry': "true", # We want the coordinates.
             'where': "('1' = '1')", # We want to query everything within the ID we have selected.
             'spatialRel': "esriSpatialRelIntersects",
@@ -202,89 +361,813 @@ class ARCGIS_Client:
             'resultOffset': 0,  # Starting at the first record
             'resultRecordCount': max_record_count  # Number of records to fetch per request
             }
-        
-        self.get_request_with_paginating(self.url, self.feature_params)
-        self.df = pd.json_normalize(self.all_features)
+        job.feature_params.update(self.generalization_params(job))
 
-        with open(os.path.join(OUTPUTS_DIR, project, sub_folder, f"{layer}", f"{name_lower}_fields.json"), "w") as f:
-            json.dump(self.fields, f)
-        
-        self.df.columns = self.df.columns.str.lower()
-        self.df = assigning_geometry(self.df)
-        #### A function to change the thingies we need.
-        self.df = ad_hoc_attributes_tweaks(self.df, name_lower)        
-        self.df.to_csv(os.path.join(OUTPUTS_DIR, project, sub_folder, f"{layer}", f"{name_lower}.csv"), index=False)
-
-        to_drop = [x for x in self.df.columns if x in ['rings', 'paths', 'x', 'y']]
-        self.gdf = gpd.GeoDataFrame(self.df, geometry='geometry')
-        self.gdf = self.gdf.drop(columns=to_drop)
-        self.gdf.set_crs(epsg=4326, inplace=True)
-        self.gdf = self.gdf.astype({col: str for col in [x for x in self.gdf.select_dtypes('object').columns if 'geometry' not in x]})
-        self.gdf.to_file(os.path.join(OUTPUTS_DIR, project, sub_folder, f"{layer}", f"{name_lower}.geojson"), driver='GeoJSON')
-        print(f"Saved {project}, {sub_folder}, {layer}, {name_lower}")
-
-
-    def get_request_with_paginating(self, url, feature_params):
-
-        if self.url is None:
-            self.url = url
-        if self.feature_params is None:
-            self.feature_params = feature_params
+        if (self.manifest is not None) or (self.checkpoints is not None):
+            job.feature_count = self.get_feature_count(job.url, job.feature_params['where'], label=job.label)
+            job.content = self.content_marker(job)
+            job.fingerprint = layer_fingerprint(job.metadata or {}, job.feature_count, job.content)
+
+        if self.checkpoints is not None:
+            checkpoint = self.checkpoints.get(job.label)
+            if (checkpoint is not None) and (checkpoint.get('status') == 'done') and (checkpoint.get('fingerprint') == job.fingerprint) \
+                and all(os.path.exists(x) for x in self.output_paths(job)):
+                job.skipped = True
+                print(f"Already downloaded, skipping {job.label}")
+                return job
+
+        if self.manifest is not None:
+            return self.sync_job(job)
+        return self.fetch_and_save(job)
+
+
+    def generalization_params(self, job: LayerJob):
+        """
+        Query params asking the server for lighter geometry, from geometry_options
+        with the layer_geometry_options entry of the layer (label, name or name_lower) on top.
+        """
+        options = dict(self.geometry_options)
+        for key in [job.label, job.name, job.name_lower]:
+            options.update(self.layer_geometry_options.get(key, {}))
+
+        params = {}
+        if options.get('max_allowable_offset') is not None:
+            params['maxAllowableOffset'] = options['max_allowable_offset']
+        if options.get('geometry_precision') is not None:
+            params['geometryPrecision'] = int(options['geometry_precision'])
+        if options.get('quantization_tolerance') is not None:
+            # Dequantized in query() (json) or by the pbf decoder. The grid covers the
+            # layer extent (in the layer spatial reference, as the server expects it).
+            extent = (job.metadata or {}).get('extent') or {}
+            if not all(isinstance(extent.get(x), (int, float)) for x in ['xmin', 'ymin', 'xmax', 'ymax']):
+                extent = {'xmin': -180, 'ymin': -90, 'xmax': 180, 'ymax': 90, 'spatialReference': {'wkid': 4326}}
+            params['quantizationParameters'] = json.dumps({
+                'mode': "view",
+                'originPosition': "upperLeft",
+                'tolerance': options['quantization_tolerance'],
+                'extent': {key: extent[key] for key in ['xmin', 'ymin', 'xmax', 'ymax', 'spatialReference'] if key in extent},
+                })
+        return params
+
+
+    def fetch_and_save(self, job: LayerJob):
+        """
+        Queries job.feature_params and writes the layer outputs.
+        """
+        if self.stream_format is not None:
+            self.stream_job(job)
+        else:
+            self.fetch_frame(job)
+            self.save_outputs(job)
+        self.finish_checkpoint(job)
+        return job
+
+
+    def fetch_frame(self, job: LayerJob):
+        """
+        Queries job.feature_params and builds job.df (normalized, with geometry).
+        """
+        if self.transform_workers > 0:
+            return self.fetch_frame_pipelined(job)
+
+        with self.metrics.phase(job.label, 'download'):
+            if self.checkpoints is not None:
+                job.all_features, job.fields = [], []
+                for data in self.iter_pages_checkpointed(job):
+                    add_page(job.all_features, data['features'])
+                    if 'fields' in data:
+                        job.fields = data['fields']
+            elif self.tiled:
+                job.all_features, job.fields = [], []
+                for data in self.tiled_query(job).iter_pages():
+                    add_page(job.all_features, data['features'])
+                    if 'fields' in data:
+                        job.fields = data['fields']
+            elif self.page_workers > 1:
+                job.all_features, job.fields = self.get_request_parallel(job.url, job.feature_params, job, self.page_workers)
+            else:
+                job.all_features, job.fields = self.get_request_with_paginating(job.url, job.feature_params, job)
+
+        with self.metrics.phase(job.label, 'normalize'):
+            job.df = features_to_frame(job.all_features)
+            oid_field = self._object_id_field(job.metadata or {})
+            if self.tiled and (oid_field is not None) and (f"attributes.{oid_field}" in job.df.columns):
+                job.df = job.df.sort_values(f"attributes.{oid_field}", ignore_index=True) # Tiles finish in any order.
+            self.save_fields(job, job.fields)
+
+        #### A function to change the thingies we need (ad_hoc_attributes_tweaks).
+        job.df = normalize_frame(job.df, job.name_lower, phase=lambda name: self.metrics.phase(job.label, name))
+        return job.df
+
+
+    def fetch_frame_pipelined(self, job: LayerJob):
+        """
+        fetch_frame() with the pages normalized in the process pool as they
+        arrive (same frame, see normalize_frame).
+        """
+        frames = []
+        pipeline = self.page_pipeline(job, write=lambda df, n_features: frames.append(df))
+        pipeline.run(self.page_source(job, parallel=True))
+
+        job.all_features = []
+        with self.metrics.phase(job.label, 'normalize'):
+            job.df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+            oid_field = self._object_id_field(job.metadata or {})
+            if self.tiled and (oid_field is not None) and (f"attributes.{oid_field.lower()}" in job.df.columns):
+                job.df = job.df.sort_values(f"attributes.{oid_field.lower()}", ignore_index=True) # Tiles finish in any order.
+        self.save_fields(job, pipeline.fields)
+        return job.df
+
+
+    def save_fields(self, job: LayerJob, fields: list):
+        """
+        job.fields (see layer_fields) -> <layer>_fields.json.
+        """
+        job.fields = layer_fields(fields, job.metadata)
+        with open(job.output_path("_fields.json"), "w") as f:
+            json.dump(job.fields, f)
+
+
+    def page_source(self, job: LayerJob, parallel: bool = False):
+        """
+        The pages of job, from the checkpoint journal, the tiles or offset paging.
+        parallel: with page_workers > 1 the pages are fetched concurrently and
+                  handed out as they arrive (see iter_pages_parallel).
+        """
+        if self.checkpoints is not None:
+            return self.iter_pages_checkpointed(job)
+        if self.tiled:
+            return self.tiled_query(job).iter_pages()
+        if parallel and self.page_workers > 1:
+            return self.iter_pages_parallel(job.url, job.feature_params, job, self.page_workers)
+        return self.iter_pages(job.url, job.feature_params, job.label, job.sizer)
+
+
+    def page_pipeline(self, job: LayerJob, write, stream_format: str = None):
+
+        def on_timings(timings):
+            for name, seconds in timings.items():
+                self.metrics.add_phase_time(job.label, name, seconds)
+
+        return ARCGIS_PagePipeline(
+            self.transform_executor(),
+            job.name_lower,
+            write,
+            depth=self.pipeline_depth,
+            stream_format=stream_format,
+            phase=lambda name: self.metrics.phase(job.label, name),
+            on_timings=on_timings,
+            )
+
+
+    def transform_executor(self):
+        """
+        The process pool of the transform stage, started on first use.
+        """
+        with self._transform_pool_lock:
+            if self._transform_pool is None:
+                self._transform_pool = transform_pool(self.transform_workers)
+            return self._transform_pool
+
+
+    def close(self):
+        """
+        Stops the transform processes (if any) and the pooled connections.
+        """
+        with self._transform_pool_lock:
+            if self._transform_pool is not None:
+                self._transform_pool.shutdown(cancel_futures=True)
+                self._transform_pool = None
+        self.session.close()
+
+
+    def iter_pages_checkpointed(self, job: LayerJob):
+        """
+        iter_pages() that can be resumed: every page is appended to a journal
+        next to the outputs and the next resultOffset is saved in
+        self.checkpoints. If the previous attempt (same fingerprint and query)
+        died midway, the journal pages are replayed and the download continues
+        from the saved offset. Mark the layer done with finish_checkpoint().
+        """
+        journal = PageJournal(job.output_path(".pages.jsonl"))
+        checkpoint = self.checkpoints.get(job.label)
+        resume = (checkpoint is not None) and (checkpoint.get('status') == 'in_progress') \
+            and (checkpoint.get('fingerprint') == job.fingerprint) and (checkpoint.get('where') == job.feature_params['where']) \
+            and journal.exists()
+
+        if resume:
+            journal.truncate(checkpoint['pages'])
+            job.feature_params['resultOffset'] = checkpoint['next_offset']
+            job.feature_params['resultRecordCount'] = checkpoint['page_size']
+            print(f"Resuming {job.label} at offset {checkpoint['next_offset']} ({checkpoint['pages']} pages on disk)")
+            yield from journal.replay()
+            if checkpoint.get('complete'):
+                return
+            n_pages = checkpoint['pages']
+        else:
+            journal.remove()
+            journal.truncate(0)
+            n_pages = 0
+
+        for data in self.iter_pages(job.url, job.feature_params, job.label, job.sizer):
+            journal.append(data)
+            n_pages += 1
+            complete = self.is_last_page(data, job.feature_params['resultRecordCount'])
+            self.checkpoints.update(job.label, {
+                'status': 'in_progress',
+                'fingerprint': job.fingerprint,
+                'where': job.feature_params['where'],
+                'page_size': job.feature_params['resultRecordCount'],
+                'next_offset': job.feature_params['resultOffset'] + len(data['features']),
+                'pages': n_pages,
+                'complete': complete,
+                'journal': journal.path,
+                })
+            yield data
+
+
+    def finish_checkpoint(self, job: LayerJob):
+
+        if self.checkpoints is None:
+            return
+        PageJournal(job.output_path(".pages.jsonl")).remove()
+        self.checkpoints.update(job.label, {
+            'status': 'done',
+            'fingerprint': job.fingerprint,
+            'outputs': self.output_paths(job),
+            })
+
+
+    def save_outputs(self, job: LayerJob):
+        """
+        Writes job.df in every format of self.output_formats (csv, geojson, parquet).
+        """
+        with self.metrics.phase(job.label, 'write'):
+            self._save_outputs(job)
+        print(f"Saved {job.project}, {job.sub_folder}, {job.name}, {job.name_lower}")
+
+
+    def _save_outputs(self, job: LayerJob):
+
+        if 'csv' in self.output_formats:
+            job.df.to_csv(job.output_path(".csv"), index=False)
+
+        to_drop = [x for x in job.df.columns if x in ['rings', 'paths', 'x', 'y']]
+        job.gdf = gpd.GeoDataFrame(job.df, geometry='geometry')
+        job.gdf = job.gdf.drop(columns=to_drop)
+        job.gdf.set_crs(epsg=4326, inplace=True)
+        if 'parquet' in self.output_formats:
+            write_geoparquet(job.gdf, job.output_path(".parquet"), compression=self.parquet_compression, row_group_size=self.parquet_row_group_size)
+        if 'geojson' in self.output_formats:
+            geojson = job.gdf.astype({col: str for col in [x for x in job.gdf.select_dtypes('object').columns if 'geometry' not in x]})
+            geojson.to_file(job.output_path(".geojson"), driver='GeoJSON')
+
+
+    def sync_job(self, job: LayerJob):
+        """
+        Incremental download against self.manifest:
+        - Same fingerprint (edit dates, serverGens, feature count, or the
+          content_marker when the metadata has no edit info) as the last
+          successful run: the layer is skipped.
+        - The layer has an edit-date field: only features edited since the last
+          sync are fetched and merged into the existing outputs.
+        - Otherwise (or when the merge doesn't add up): full download.
+        """
+        metadata = job.metadata or {}
+        count = job.feature_count
+        fingerprint = job.fingerprint
+        entry = self.manifest.get(job.label)
+        outputs = self.output_paths(job)
+
+        if (entry is not None) and (entry.get('fingerprint') == fingerprint) and all(os.path.exists(x) for x in outputs):
+            job.skipped = True
+            print(f"Unchanged, skipping {job.label}")
+            return job
+
+        edit_field = metadata.get('editFieldsInfo', {}).get('editDateField')
+        oid_field = self._object_id_field(metadata)
+        synced = False
+        if (entry is not None) and entry.get('last_edit_date') and edit_field and oid_field and (self.stream_format is None) \
+            and (('csv' in self.output_formats) or ('parquet' in self.output_formats)) and all(os.path.exists(x) for x in outputs):
+            synced = self.merge_edits(job, edit_field, oid_field, entry['last_edit_date'], count)
+        if synced:
+            self.finish_checkpoint(job)
+        else:
+            self.fetch_and_save(job)
+
+        self.manifest.update(job.label, {
+            'fingerprint': fingerprint,
+            'feature_count': count,
+            'last_edit_date': self.last_edit_date(job),
+            'outputs': outputs,
+            'synced_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            })
+        return job
+
+
+    def content_marker(self, job: LayerJob):
+        """
+        Server side content check for layers whose metadata has no edit dates
+        nor serverGens: the max of the edit-date field if the layer has one,
+        a hash of the ObjectIDs otherwise (catches deletes / inserts with the
+        same count). None when the metadata already tells the edits.
+        """
+        metadata = job.metadata or {}
+        if has_edit_metadata(metadata):
+            return None
+        where = job.feature_params['where']
+        edit_field = (metadata.get('editFieldsInfo') or {}).get('editDateField')
+        if edit_field:
+            max_edit_date = self.get_max_value(job.url, edit_field, where, label=job.label)
+            if max_edit_date is not None:
+                return {'max_edit_date': max_edit_date}
+        object_ids = self.get_object_ids(job.url, where, label=job.label)
+        if object_ids is not None:
+            return {'object_ids': hashlib.sha1(json.dumps(sorted(object_ids)).encode()).hexdigest()}
+        return None
+
+
+    def last_edit_date(self, job: LayerJob):
+        """
+        Server side time of the last edit (ms), where the next merge_edits
+        starts from: editingInfo.lastEditDate, or the max of the edit-date field.
+        None if the server tells neither (the next changed run is a full download).
+        """
+        metadata = job.metadata or {}
+        last_edit_date = (metadata.get('editingInfo') or {}).get('lastEditDate')
+        if last_edit_date is None:
+            last_edit_date = (job.content or {}).get('max_edit_date')
+        return last_edit_date
+
+
+    def merge_edits(self, job: LayerJob, edit_field: str, oid_field: str, since_ms: int, count: int):
+        """
+        Fetches the features edited after since_ms and merges them (by ObjectID)
+        into the existing csv/geojson. Returns False if the merged layer doesn't
+        match the server feature count (deletes), so a full download is done.
+        """
+        since = datetime.datetime.fromtimestamp(since_ms / 1000, tz=datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        where = job.feature_params['where']
+        job.feature_params['where'] = f"({where}) AND ({edit_field} > TIMESTAMP '{since}')"
+        try:
+            edited = self.fetch_frame(job)
+        finally:
+            job.feature_params['where'] = where
+            job.feature_params['resultOffset'] = 0
+
+        oid_col = f"attributes.{oid_field.lower()}"
+        previous = self.read_previous_output(job)
+        if (len(edited) > 0) and (oid_col not in edited.columns or oid_col not in previous.columns):
+            return False
+        if len(edited) > 0:
+            previous = previous[~previous[oid_col].isin(edited[oid_col])]
+
+        merged = pd.concat([previous, edited], ignore_index=True)
+        if (count is not None) and (len(merged) != count):
+            print(f"Merged {len(merged)} features but the server has {count}, full download of {job.label}")
+            return False
+        job.df = merged
+        self.save_outputs(job)
+        print(f"Merged {len(edited)} edited features into {job.label}")
+        return True
+
+
+    def read_previous_output(self, job: LayerJob):
+        """
+        Layer as saved by the last run, parquet if there is one (typed), csv otherwise.
+        """
+        if 'parquet' in self.output_formats:
+            return pd.DataFrame(read_layer(job.output_path(".parquet")))
+        previous = pd.read_csv(job.output_path(".csv"))
+        previous['geometry'] = shapely.from_wkt(previous['geometry'].where(previous['geometry'].notna(), None))
+        return previous
+
+
+    def index_job(self, job: LayerJob):
+        """
+        Adds the outputs of a downloaded layer to self.spatial_index (unchanged
+        files are not indexed again). An indexing error doesn't fail the layer.
+        """
+        if self.spatial_index is None:
+            return
+        try:
+            self.spatial_index.index_job(self.output_paths(job))
+        except Exception as e:
+            print(f"Error indexing layer {job.label}: {e}")
+            logger.error(f"Error indexing layer {job.label}: {e}")
+
+
+    def output_paths(self, job: LayerJob):
+
+        if self.stream_format is not None:
+            return [job.output_path(STREAM_EXTENSIONS[self.stream_format])]
+        return [job.output_path(OUTPUT_EXTENSIONS[x]) for x in self.output_formats]
+
+
+    def get_feature_count(self, url, where="1=1", extra: dict = None, label: str = None):
+
+        try:
+            params = dict({'f': 'json', 'where': where, 'returnCountOnly': "true"}, **(extra or {}))
+            return self.query(url, params, label).get('count')
+        except Exception:
+            return None
+
+
+    def get_max_value(self, url, field: str, where="1=1", label: str = None):
+        """
+        Max of field over the features matching where (outStatistics), None if the server can't tell.
+        """
+        try:
+            params = {
+                'f': 'json',
+                'where': where,
+                'returnGeometry': "false",
+                'outStatistics': json.dumps([{'statisticType': "max", 'onStatisticField': field, 'outStatisticFieldName': "max_value"}]),
+                }
+            features = self.query(url, params, label).get('features') or []
+            attributes = {k.lower(): v for k, v in features[0].get('attributes', {}).items()} if features else {}
+            return attributes.get('max_value')
+        except Exception:
+            return None
+
+
+    def get_object_ids(self, url, where="1=1", label: str = None):
+        """
+        ObjectIDs of the features matching where (returnIdsOnly), None if the server can't tell.
+        """
+        try:
+            return self.query(url, {'f': 'json', 'where': where, 'returnIdsOnly': "true"}, label).get('objectIds')
+        except Exception:
+            return None
+
+
+    def stream_job(self, job: LayerJob):
+        """
+        Bounded-memory download: every page is normalized and appended to the
+        output as soon as it arrives, only one page is held in memory.
+        Output is {name}.geojsonl (GeoJSONSeq) or {name}.parquet (GeoParquet row groups).
+        With transform_workers the pages are normalized and encoded in the process
+        pool and a writer thread appends them (see page_pipeline).
+        """
+        writer = open_stream_writer(job.output_path(STREAM_EXTENSIONS[self.stream_format]), self.stream_format, fields=(job.metadata or {}).get('fields'))
+        fields = []
+        n_features = 0
+        phase = lambda name: self.metrics.phase(job.label, name)
+        try:
+            pages = self.page_source(job)
+            if self.transform_workers > 0:
+                # Pages come back encoded from the pool, the writer thread only appends them.
+                def write(encoded, n_features):
+                    with phase('write'):
+                        writer.write_encoded(encoded)
+
+                pipeline = self.page_pipeline(job, write, stream_format=self.stream_format)
+                n_features = pipeline.run(pages)
+                fields = pipeline.fields
+            else:
+                while True:
+                    with phase('download'):
+                        data = next(pages, None)
+                    if data is None:
+                        break
+                    if 'fields' in data:
+                        fields = data['fields']
+                    if len(data['features']) == 0:
+                        continue
+                    gdf = features_to_geodataframe(data['features'], job.name_lower, phase)
+                    with phase('write'):
+                        writer.write(gdf)
+                    n_features += len(data['features'])
+        finally:
+            with phase('write'):
+                writer.close()
+
+        self.save_fields(job, fields)
+        print(f"Saved {job.project}, {job.sub_folder}, {job.name}, {job.name_lower} ({n_features} features streamed)")
+        return job
+
+
+    def tiled_query(self, job: LayerJob):
+
+        return ARCGIS_TiledQuery(self, job, workers=max(4, self.page_workers), max_depth=self.tile_max_depth)
+
+
+    def get_request_with_paginating(self, url, feature_params, job: LayerJob = None):
+        """
+        Pages through the query endpoint. When a job is given, the features and
+        fields are only returned (not stored on self) so concurrent jobs don't clash.
+        """
+        if job is None:
+            if self.url is None:
+                self.url = url
+            if self.feature_params is None:
+                self.feature_params = feature_params
+            feature_params = self.feature_params
+            label = f"{self.project}/{self.sub_folder}/{self.name}"
+        else:
+            label = job.label
         
-        self.all_features = []
-        self.fields = []
+        all_features = []
+        fields = []
+
+        for data in self.iter_pages(url, feature_params, label, job.sizer if job is not None else None):
+            add_page(all_features, data['features'])
+            # Add fields alias, etc
+            if 'fields' in data:
+                fields = data['fields']
+        if job is None:
+            self.all_features = all_features
+            self.fields = fields
+        return all_features, fields
+
+
+    def query(self, url, params, label: str = None, attempt: int = 0):
+        """
+        GET on a /query endpoint, decoded according to params['f'] (json, geojson or pbf).
+        Latency, bytes, features... are recorded in self.metrics under label (the layer).
+        """
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self.session.get(url, params=params)
+            data = self.decode_response(response, url, params)
+        except Exception as e:
+            self.record_request(label or url, params, start, response, attempt, error=e)
+            raise
+        self.record_request(label or url, params, start, response, attempt, data=data)
+        return data
+
+
+    def record_request(self, label, params, start, response, attempt, data=None, error=None):
+
+        if params.get('returnCountOnly') == "true":
+            kind = 'count'
+        elif params.get('returnIdsOnly') == "true":
+            kind = 'ids'
+        else:
+            kind = 'query'
+        self.metrics.record_request(
+            label,
+            kind,
+            latency=time.perf_counter() - start,
+            nbytes=len(response.content) if response is not None else 0,
+            features=len(data['features']) if (data is not None) and ('features' in data) else None,
+            retries=attempt,
+            page_size=params.get('resultRecordCount'),
+            status=response.status_code if response is not None else None,
+            error=None if error is None else f"{type(error).__name__}: {error}",
+            )
+
+
+    def decode_response(self, response, url, params):
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise ARCGIS_ServerError(f"HTTP {response.status_code} from {url}", response.status_code, retry_after_seconds(response))
+        if is_client_error(response.status_code):
+            raise ARCGIS_QueryError(f"HTTP {response.status_code} from {url}", response.status_code)
+        try:
+            if params.get('f') == 'pbf' and not response.content[:1] == b"{":
+                return decode_feature_collection(response.content)
+            data = response.json()
+        except Exception as e:
+            # Cut short by the server / the connection, asking again usually works.
+            raise ARCGIS_ServerError(f"Truncated or invalid body from {url}: {e}", response.status_code) from e
+        if 'error' in data:
+            # ArcGIS answers errors (timeouts, too much data, invalid queries...) with HTTP 200.
+            code = data['error'].get('code')
+            if is_rejected_query(data['error']):
+                raise ARCGIS_QueryError(f"{url}: {data['error']}", code)
+            raise ARCGIS_ServerError(f"{url}: {data['error']}", code, retry_after_seconds(response))
+        if params.get('f') == 'geojson':
+            return decode_geojson(data)
+        if ('transform' in data) and ('features' in data):
+            dequantize_features(data['features'], data.pop('transform'))
+        return data
+
+
+    def query_with_retries(self, url, params, label: str, on_failure=None, retries: int = None):
+        """
+        query() retried at page level with exponential backoff + jitter, honouring
+        Retry-After. on_failure(params) can adjust the page before the next attempt
+        (not called when throttled, a smaller page doesn't help there).
+        Only RETRYABLE_ERRORS are retried, rejected queries fail at once.
+        retries: attempts for the errors a smaller page may fix (default page_retries),
+                 throttled pages always get page_retries.
+        """
+        retries = self.page_retries if retries is None else retries
+        attempt = 0
+        failures = 0
+        while True:
+            try:
+                return self.query(url, params, label, attempt)
+            except RETRYABLE_ERRORS as e:
+                throttled = is_throttled(e)
+                if not throttled:
+                    failures += 1
+                if (attempt >= self.page_retries) or (failures > retries):
+                    # The page had its attempts, the layer level @retry of download_job doesn't start them over.
+                    e.retryable = False
+                    raise
+                if (on_failure is not None) and not throttled:
+                    on_failure(params)
+                delay = backoff_delay(attempt, self.backoff, retry_after=getattr(e, 'retry_after', None))
+                print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Page failed ({e}), retrying in {delay:.1f}s ({label})")
+                logger.warning(f"Page failed ({e}), retrying in {delay:.1f}s ({label})")
+                time.sleep(delay)
+                attempt += 1
+
+
+    @staticmethod
+    def is_last_page(data, requested: int):
+        """
+        A short page is the last one, unless the server says it cut it (exceededTransferLimit).
+        """
+        n_features = len(data['features'])
+        return (n_features == 0) or ((n_features < requested) and not data.get('exceededTransferLimit', False))
+
+
+    def negotiate_format(self, job: LayerJob):
+        """
+        Most compact query format the layer supports (pbf > geojson > json), from
+        'supportedQueryFormats' in its metadata. Journaled (resumable) downloads
+        keep json, their pages are stored as they come.
+        """
+        if self.query_format != 'auto':
+            return self.query_format
+        if self.checkpoints is not None:
+            return 'json'
+        supported = [x.strip().lower() for x in (job.metadata or {}).get('supportedQueryFormats', "").split(",")]
+        for query_format in ['pbf', 'geojson']:
+            if query_format in supported:
+                return query_format
+        return 'json'
+
+
+    def iter_pages(self, url, feature_params, label: str, sizer: AdaptivePageSize = None):
+        """
+        Yields the json of every resultOffset page (only one page in memory at a time).
+        The page size adapts AIMD-style: halved when a page fails, grown back after
+        successes. The offset moves by what the server actually returned.
+        """
+        if sizer is None:
+            sizer = AdaptivePageSize(feature_params['resultRecordCount'])
+        feature_params['resultRecordCount'] = min(feature_params['resultRecordCount'], sizer.size)
+
+        def shrink(params):
+            params['resultRecordCount'] = sizer.failure()
 
         while True:
             # Make the request
-            self.response = requests.get(url, params=self.feature_params)
-            data = self.response.json() 
+            data = self.query_with_retries(url, feature_params, label, on_failure=shrink)
             # Add features to the list
             if 'features' in data:
-                self.all_features.extend(data['features'])
-                print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(data['features'])} features ({self.project}/{self.sub_folder}/{self.name})")
-                logger.setLevel(logging.INFO)
-                logger.info(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(data['features'])} features ({self.project}/{self.sub_folder}/{self.name})")
+                print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(data['features'])} features ({label})")
+                logger.info(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(data['features'])} features ({label})")
             else:
                 break
-            # Check if the number of records fetched is less than the limit
-            if len(data['features']) < self.feature_params['resultRecordCount']:
+            yield data
+            requested = feature_params['resultRecordCount']
+            if self.is_last_page(data, requested):
                 break
+            n_features = len(data['features'])
+            if n_features < requested:
+                sizer.cap(n_features)
             # Update the offset for the next query
-            self.feature_params['resultOffset'] += self.feature_params['resultRecordCount']
-        # Add fields alias, etc
-        if 'fields' in data:
-            self.fields = data['fields']
-        return self.all_features, self.fields
+            feature_params['resultOffset'] += n_features
+            feature_params['resultRecordCount'] = sizer.success()
+
 
+    def get_request_parallel(self, url, feature_params, job: LayerJob, workers: int = 4):
+        """
+        Every page of iter_pages_parallel put back together in order.
+        """
+        all_features = []
+        fields = []
+        for data in self.iter_pages_parallel(url, feature_params, job, workers):
+            add_page(all_features, data.get('features', []))
+            if not fields and 'fields' in data:
+                fields = data['fields']
+        return all_features, fields
 
-    def get_metadata_max_records_to_query(self, url_query):
 
-        # Try and get it if stated:
+    def plan_pages(self, url, feature_params, job: LayerJob):
+        """
+        Asks the server how many features there are (or which ObjectIDs) and
+        plans the query params of every page. If the service has no pagination
+        support it batches by ObjectID ranges instead of resultOffset.
+        None when the server doesn't give the count.
+        """
+        metadata = job.metadata or {}
+        supports_pagination = metadata.get('advancedQueryCapabilities', {}).get('supportsPagination', metadata.get('supportsPagination', True))
+        page_size = feature_params['resultRecordCount']
+        oid_field = self._object_id_field(metadata)
+
+        base_params = {k: v for k, v in feature_params.items() if k not in ['resultOffset', 'resultRecordCount']}
+        pages = []
+        if supports_pagination:
+            count = self.get_feature_count(url, feature_params['where'], label=job.label)
+            if count is None:
+                return None
+            for offset in range(0, count, page_size):
+                params = dict(base_params, resultOffset=offset, resultRecordCount=page_size)
+                if oid_field is not None:
+                    params['orderByFields'] = oid_field # Stable order between pages.
+                pages.append(params)
+        else:
+            data = self.query(url, {'f': 'json', 'where': feature_params['where'], 'returnIdsOnly': "true"}, job.label)
+            oid_field = data.get('objectIdFieldName', oid_field)
+            object_ids = sorted(data.get('objectIds') or [])
+            for i in range(0, len(object_ids), page_size):
+                batch = object_ids[i:i + page_size]
+                where = f"({feature_params['where']}) AND ({oid_field} >= {batch[0]} AND {oid_field} <= {batch[-1]})"
+                pages.append(dict(base_params, where=where))
+        return pages
+
+
+    def iter_pages_parallel(self, url, feature_params, job: LayerJob, workers: int = 4, window: int = None):
+        """
+        Plans every page up front (see plan_pages) and fetches them concurrently,
+        yielding each page in order as soon as it (and the ones before it) arrived.
+        At most window pages (default 2 * workers) are downloaded ahead of
+        the consumer, memory stays bounded.
+        """
+        pages = self.plan_pages(url, feature_params, job)
+        if pages is None:
+            yield from self.iter_pages(url, feature_params, job.label, job.sizer)
+            return
+        window = window or 2 * workers
+
+        print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Fetching {len(pages)} pages with {workers} workers ({job.label})")
+        executor = ThreadPoolExecutor(max_workers=workers)
         try:
-            response = requests.get("/".join(url_query.split("/")[:-1])+"?f=json").json()
-            with open(os.path.join(OUTPUTS_DIR, self.project, self.sub_folder, f"{self.name}", f"{self.name_lower}_metadata.json"), "w") as f:
-                json.dump(response, f)
-            value = int(response['maxRecordCount'])
-        except:
-            value = 1000
-        return value
+            pending = iter(pages)
+            futures = [executor.submit(self._fetch_page, url, params, job.label) for params in itertools.islice(pending, window)]
+            while futures:
+                data = futures.pop(0).result()
+                for params in itertools.islice(pending, 1):
+                    futures.append(executor.submit(self._fetch_page, url, params, job.label))
+                yield data
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+    def _fetch_page(self, url, params, label, min_size: int = 10):
+        """
+        One planned page with page-level retries. An offset page that keeps failing
+        is split in two halves, a page the server cut short is completed.
+        """
+        size = params.get('resultRecordCount')
+        splittable = (size is not None) and (size > min_size)
+        try:
+            # A page that can be split doesn't insist much on errors, halves are cheaper.
+            # Throttled it waits as long as any page (see query_with_retries).
+            data = self.query_with_retries(url, params, label, retries=1 if splittable else None)
+        except RETRYABLE_ERRORS as e:
+            if (not splittable) or is_throttled(e):
+                raise
+            half = size // 2
+            print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Splitting page at offset {params['resultOffset']} ({label})")
+            first = self._fetch_page(url, dict(params, resultRecordCount=half), label, min_size)
+            second = self._fetch_page(url, dict(params, resultOffset=params['resultOffset'] + half, resultRecordCount=size - half), label, min_size)
+            return merge_pages(first, second)
+
+        if 'features' not in data:
+            raise Exception(f"Page without features for {label}: {data}")
+        n_features = len(data['features'])
+        if ('resultRecordCount' in params) and (0 < n_features < params['resultRecordCount']) and data.get('exceededTransferLimit'):
+            rest = dict(params, resultOffset=params['resultOffset'] + n_features, resultRecordCount=params['resultRecordCount'] - n_features)
+            data = merge_pages(data, self._fetch_page(url, rest, label, min_size))
+        logger.info(f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(data['features'])} features ({label})")
+        return data
 
 
-    def get_max_records_to_query_option2(self, url_query):
+    @staticmethod
+    def _object_id_field(metadata):
 
-        response = requests.get("/".join(url_query.split("/")[:-1]))
-        soup = BeautifulSoup(response.content, "html.parser")
+        if metadata.get('objectIdField'):
+            return metadata['objectIdField']
+        for field in metadata.get('fields') or []:
+            if field.get('type') == 'esriFieldTypeOID':
+                return field['name']
+        return None
+
+
+    def get_metadata_max_records_to_query(self, url_query, job: LayerJob = None):
 
         # Try and get it if stated:
         try:
-            for div in soup.find_all("div"):
-                if "MaxRecordCount" in div.get_text():
-                    text = div.get_text()
-                    # Extract the value after 'MaxRecordCount:'
-                    start_index = text.find("MaxRecordCount:") + len("MaxRecordCount:")
-                    value = text[start_index:].split('<br/>')[0].strip().split("\n")[0]
-                    value = int(value)
+            if (job is not None) and (job.metadata is not None):
+                response = job.metadata # Already in the catalog.
+            else:
+                response = self.session.get("/".join(url_query.split("/")[:-1])+"?f=json").json()
+            if job is None:
+                path = os.path.join(OUTPUTS_DIR, self.project, self.sub_folder, f"{self.name}", f"{self.name_lower}_metadata.json")
+            else:
+                job.metadata = response
+                path = job.output_path("_metadata.json")
+            with open(path, "w") as f:
+                json.dump(response, f)
+            value = int(response['maxRecordCount'])
         except:
             value = 1000
-        
         return value
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import OUTPUTS_DIR
+from .logger_config import setup_logger
+
+logger = setup_logger()
+
+
+CATALOG_DIR = os.path.join(OUTPUTS_DIR, "catalog")
+QUERYABLE_SERVICES = ['MapServer', 'FeatureServer']
+ROOT_PROJECT = "_root"
+
+
+class ARCGIS_Catalog:
+    '''
+    Crawls the services directory through the REST json endpoints:
+        {item}?f=json                      -> folders + root services
+        {item}/{folder}?f=json             -> services of a folder
+        {item}/{service}/{type}/layers?f=json -> every layer metadata of a service in one call
+    Folders and services are crawled concurrently and the result is persisted
+    to CATALOG_DIR, reused while it is younger than ttl seconds.
+
+    catalog: {project (folder): {service: {"type", "path", "layers": {layer name: {"id", "path", "metadata"}}}}}
+    Paths are relative to base_url, e.g. "/server/rest/services/Folder/Service/MapServer/3".
+    '''
+    def __init__(self, base_url: str, item: str, session, ttl: int = 24 * 3600, workers: int = 8, catalog_dir: str = CATALOG_DIR):
+        self.base_url = base_url.rstrip("/")
+        self.item = "/" + item.strip("/")
+        self.session = session
+        self.ttl = ttl
+        self.workers = workers
+        key = hashlib.sha1(f"{self.base_url}{self.item}".encode()).hexdigest()[:16]
+        self.path = os.path.join(catalog_dir, f"catalog_{key}.json")
+        self.catalog = None
+        self.created = None
+
+
+    def load(self, refresh: bool = False):
+        """
+        Returns the catalog, from disk if it is fresh enough, crawling otherwise.
+        """
+        if self.catalog is not None and not refresh and not self._expired(self.created):
+            return self.catalog
+        if not refresh and os.path.exists(self.path):
+            with open(self.path) as f:
+                cached = json.load(f)
+            if not self._expired(cached['created']):
+                self.catalog, self.created = cached['catalog'], cached['created']
+                return self.catalog
+        return self.crawl()
+
+
+    def crawl(self):
+
+        start = time.time()
+        root = self._get_json(self.item)
+        services = [(ROOT_PROJECT, service) for service in root.get('services', [])]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            folders = list(executor.map(lambda folder: (folder, self._get_folder(folder)), root.get('folders', [])))
+            failed = [folder for folder, content in folders if content is None]
+            for folder, content in [x for x in folders if x[1] is not None]:
+                services.extend((folder, service) for service in content.get('services', []))
+
+            services = self._pick_services(services)
+            layers = list(executor.map(lambda x: self._get_layers(x[2]), services))
+            failed.extend(path for (project, name, path), service_layers in zip(services, layers) if service_layers is None)
+
+        catalog = {folder: {} for folder in root.get('folders', [])}
+        for (project, name, path), service_layers in zip(services, layers):
+            catalog.setdefault(project, {})[name] = {
+                'type': path.split("/")[-1],
+                'path': path,
+                'layers': service_layers or {},
+                }
+
+        self.catalog = catalog
+        self.created = time.time()
+        n_layers = sum(len(s['layers']) for p in catalog.values() for s in p.values())
+        print(f"Catalog crawled: {len(catalog)} projects, {len(services)} services, {n_layers} layers in {time.time() - start:.1f}s")
+        if len(failed) > 0:
+            # Not persisted, the next run crawls again instead of missing these folders / services for ttl seconds.
+            print(f"{len(failed)} folders or services could not be listed ({failed}), the catalog is not saved to disk.")
+            logger.warning(f"{len(failed)} folders or services could not be listed ({failed}), the catalog is not saved to disk.")
+            return catalog
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({'base_url': self.base_url, 'item': self.item, 'created': self.created, 'catalog': catalog}, f)
+        return catalog
+
+
+    def projects(self):
+        return list(self.load().keys())
+
+
+    def services(self, project: str):
+        return self.load()[project]
+
+
+    def layers(self, project: str, service: str):
+        return self.load()[project][service]['layers']
+
+
+    def layer_metadata(self, project: str, service: str, layer: str):
+        return self.layers(project, service)[layer].get('metadata')
+
+
+    def _expired(self, created):
+        return (created is None) or (time.time() - created > self.ttl)
+
+
+    def _pick_services(self, services):
+        """
+        One queryable service per name (MapServer preferred over FeatureServer).
+        Returns [(project, short name, path)].
+        """
+        picked = {}
+        for project, service in services:
+            if service.get('type') not in QUERYABLE_SERVICES:
+                continue
+            name = service['name'].split("/")[-1]
+            key = (project, name)
+            if key in picked and QUERYABLE_SERVICES.index(picked[key]['type']) <= QUERYABLE_SERVICES.index(service['type']):
+                continue
+            picked[key] = service
+        return [(project, name, f"{self.item}/{service['name']}/{service['type']}") for (project, name), service in picked.items()]
+
+
+    def _get_folder(self, folder):
+        """
+        Services of a folder, None if it can't be listed (logged, the crawl goes on).
+        """
+        try:
+            return self._get_json(f"{self.item}/{folder}")
+        except Exception as e:
+            print(f"Could not list the services of folder {folder}: {e}")
+            logger.error(f"Could not list the services of folder {folder}: {e}")
+            return None
+
+
+    def _get_layers(self, service_path):
+        """
+        Layers of a service, None if they can't be listed (logged, the crawl goes on).
+        """
+        try:
+            content = self._get_json(f"{service_path}/layers")
+        except Exception as e:
+            print(f"Could not list the layers of {service_path}: {e}")
+            logger.error(f"Could not list the layers of {service_path}: {e}")
+            return None
+        layers = {}
+        for layer in content.get('layers', []) + content.get('tables', []):
+            if layer.get('type') == 'Group Layer':
+                continue # Nothing to query, its sub-layers are listed on their own.
+            name = layer['name']
+            if name in layers:
+                # Same name, another layer id: both are kept, the later one keyed with its id.
+                name = f"{layer['name']}_{layer['id']}"
+                logger.warning(f"Layer name '{layer['name']}' repeated in {service_path}, layer {layer['id']} listed as '{name}'")
+            layers[name] = {
+                'id': layer['id'],
+                'path': f"{service_path}/{layer['id']}",
+                'metadata': layer,
+                }
+        return layers
+
+
+    def _get_json(self, path):
+
+        data = self.session.get(f"{self.base_url}{path}", params={'f': 'json'}).json()
+        if 'error' in data:
+            raise Exception(f"{path}: {data['error']}")
+        return data
@@ -0,0 +1,60 @@
+import os
+import json
+
+from .config import OUTPUTS_DIR
+
+
+CHECKPOINTS_PATH = os.path.join(OUTPUTS_DIR, "download_checkpoints.json")
+
+
+class PageJournal:
+    '''
+    Append-only file with the raw json of every page already downloaded for a
+    layer (one page per line), so an interrupted download can be resumed
+    without asking the server for those pages again.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+    def truncate(self, n_pages: int):
+        """
+        Keeps the first n_pages lines (the ones the checkpoint knows about). A
+        crash between writing a page and saving the checkpoint leaves one extra.
+        """
+        if not self.exists():
+            open(self.path, "w").close()
+            return
+        with open(self.path, "rb+") as f:
+            for _ in range(n_pages):
+                if not f.readline():
+                    raise Exception(f"Journal {self.path} has less than {n_pages} pages.")
+            f.truncate(f.tell())
+
+
+    def append(self, data: dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(data))
+            f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def replay(self):
+        """
+        Yields the pages stored so far, one at a time.
+        """
+        if not self.exists():
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
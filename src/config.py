@@ -1,9 +1,13 @@
 import os
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
-OUTPUTS_DIR = os.path.join(BASE_DIR, 'outputs')
+OUTPUTS_DIR = os.environ.get('ARCGIS_OUTPUTS_DIR', os.path.join(BASE_DIR, 'outputs')) # Overridable, e.g. benchmarks/ write to a temp dir.
 NOTEBOOKS_DIR = os.path.join(BASE_DIR, 'notebooks')
 LOG_DIR = os.path.join(BASE_DIR, 'logs')
 RASTER_DIR = os.path.join(BASE_DIR, 'rasters')
 MAP_RASTER_DIR = os.path.join(BASE_DIR, 'maps_raster')
-SHAPEFILE_DIR = os.path.join(BASE_DIR, 'shapefiles')
\ No newline at end of file
+SHAPEFILE_DIR = os.path.join(BASE_DIR, 'shapefiles')
+
+# Default ArcGIS server crawled by scripts/run_etl_pipeline.py
+BASE_URL = "https://minesportal.arcgis.pe"
+SERVICES_ITEM = "/server/rest/services"
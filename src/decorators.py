@@ -1,6 +1,9 @@
+import time
 import functools
 
-def retry(retries=4):
+from .rate_control import backoff_delay
+
+def retry(retries=4, backoff=1.0, max_delay=60.0):
     def decorator_retry(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):      
@@ -9,8 +12,13 @@ def retry(retries=4):
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
+                    if getattr(e, 'retryable', True) is False:
+                        raise # e.g. offline cache misses, the next attempt can't do better.
                     print(f"Attempt {attempt + 1} failed: {e}")
                     last_exception = e
+                    if attempt < retries - 1:
+                        # Exponential backoff with jitter, or what the server asked for.
+                        time.sleep(backoff_delay(attempt, backoff, max_delay, getattr(e, 'retry_after', None)))
             raise last_exception
         return wrapper
     return decorator_retry
@@ -0,0 +1,121 @@
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .logger_config import setup_logger
+
+logger = setup_logger()
+
+
+class ARCGIS_DownloadEngine:
+    '''
+    Runs many ARCGIS_Client.download_job() at once on a bounded thread pool.
+
+    workers: global number of layers being downloaded at the same time.
+    per_host: max number of those layers hitting the same host at the same time.
+
+    Use it as a context manager (or call close()) to stop the client transform
+    processes and pooled connections once the downloads are done.
+    '''
+    def __init__(self, client, workers: int = 8, per_host: int = 4):
+        self.client = client
+        self.workers = max(1, int(workers))
+        self.per_host = max(1, min(int(per_host), self.workers))
+        # Every job may have page_workers requests in flight against its host.
+        pool_size = self.per_host * max(1, client.page_workers)
+        if client.session.pool_size < pool_size:
+            client.session.set_pool_size(pool_size)
+        self._host_limits = {}
+        self._host_lock = threading.Lock()
+        self.jobs = []
+        self.done = []
+        self.failed = {}
+
+
+    def collect_jobs(self, projects=None):
+        """
+        Walks projects -> sub-folders -> layers (sequentially, it is a handful of
+        requests) creating the output directories and one LayerJob per layer.
+        """
+        client = self.client
+        if client.to_scrape_1 is None:
+            client.retrieve_arcgis_gis_projects()
+        client.create_projects_directories()
+
+        if projects is None:
+            projects = client.project_list
+
+        jobs = []
+        for project in projects:
+            client.querying_projects(project=project)
+            client.create_main_folder_directories(project=project)
+            for sub_folder in client.sub_folder_list:
+                client.querying_sub_folder(project=project, sub_folder=sub_folder)
+                client.create_layer_directories(project=project, sub_folder=sub_folder)
+                for layer in client.layers_list:
+                    jobs.append(client.make_layer_job(project, sub_folder, layer))
+
+        self.jobs = jobs
+        print(f"Collected {len(jobs)} layers to download.")
+        return jobs
+
+
+    def _host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+
+    def _run_job(self, job):
+        with self._host_semaphore(job.url):
+            self.client.download_job(job)
+            self.client.metrics.layer_finished(job.label, 'skipped' if job.skipped else 'done')
+            self.client.index_job(job)
+            # The frames are already on disk, don't keep every layer in memory.
+            job.all_features, job.df, job.gdf = [], None, None
+        return job
+
+
+    def run(self, jobs=None):
+        """
+        Downloads the jobs concurrently. Errors of a layer don't stop the others,
+        they are collected in self.failed ({label: exception}). The client
+        metrics (run report, Prometheus textfile) are written at the end.
+        """
+        if jobs is None:
+            jobs = self.jobs if self.jobs else self.collect_jobs()
+
+        self.done = []
+        self.failed = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._run_job, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    self.done.append(future.result())
+                except Exception as e:
+                    self.failed[job.label] = e
+                    self.client.metrics.layer_finished(job.label, 'failed', str(e))
+                    print(f"Error downloading layer {job.label}: {e}")
+                    logger.error(f"Error downloading layer {job.label}: {e}")
+
+        print(f"Downloaded {len(self.done)} layers, {len(self.failed)} failed.")
+        self.client.metrics.finish()
+        return self.done, self.failed
+
+
+    def close(self):
+        """
+        Closes the client (transform process pool, pooled connections).
+        """
+        self.client.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
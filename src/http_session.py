@@ -0,0 +1,46 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_TIMEOUT = (10, 120)  # (connect, read) seconds
+
+
+class ARCGIS_Session(requests.Session):
+    '''
+    requests.Session with a connection pool sized to the client concurrency,
+    keep-alive, gzip/deflate negotiation and a default timeout for every call.
+    cache: optional ARCGIS_ResponseCache (src/response_cache.py) answering GETs
+           from disk when it can.
+    '''
+    def __init__(self, pool_size: int = 10, timeout=DEFAULT_TIMEOUT, cache=None):
+        super().__init__()
+        self.timeout = timeout
+        self.cache = cache
+        self.headers.update({
+            'Accept-Encoding': "gzip, deflate",
+            'Connection': "keep-alive",
+            })
+        self.set_pool_size(pool_size)
+
+
+    def set_pool_size(self, pool_size: int):
+        """
+        (Re)mounts the adapters so up to pool_size connections per host are kept alive.
+        """
+        self.pool_size = max(1, int(pool_size))
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if (self.cache is None) or (method.upper() != "GET"):
+            return super().request(method, url, **kwargs)
+
+        params = kwargs.get('params')
+        response = self.cache.get(method, url, params)
+        if response is None:
+            response = super().request(method, url, **kwargs)
+            self.cache.put(method, url, params, response)
+        return response
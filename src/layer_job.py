@@ -0,0 +1,46 @@
+import os
+
+from .config import OUTPUTS_DIR
+
+
+class LayerJob:
+    '''
+    Holds everything that belongs to the download of one layer (query url, params,
+    features, dataframes...), so that one ARCGIS_Client can download several
+    layers at the same time without them overwriting each other.
+    '''
+    def __init__(self, project: str, sub_folder: str, layer: str, querying_item: str, host: str):
+        self.project = project
+        self.sub_folder = sub_folder
+        self.name = layer
+        self.name_lower = layer.lower().strip().replace(" ","_")
+        self.querying_item = querying_item
+        self.url = f"{host}{querying_item}/query"
+        self.output_dir = os.path.join(OUTPUTS_DIR, project, sub_folder, f"{layer}")
+        self.feature_params = None
+        self.metadata = None
+        self.sizer = None
+        self.all_features = []
+        self.fields = []
+        self.df = None
+        self.gdf = None
+        self.skipped = False
+        self.feature_count = None
+        self.fingerprint = None
+        self.content = None
+
+
+    @property
+    def label(self):
+        return f"{self.project}/{self.sub_folder}/{self.name}"
+
+
+    def output_path(self, suffix: str):
+        """
+        Path inside the layer directory, e.g. suffix='.geojson' or '_fields.json'.
+        """
+        return os.path.join(self.output_dir, f"{self.name_lower}{suffix}")
+
+
+    def __repr__(self):
+        return f"LayerJob({self.label})"
@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+import threading
+
+from .config import OUTPUTS_DIR
+
+
+MANIFEST_PATH = os.path.join(OUTPUTS_DIR, "sync_manifest.json")
+
+
+def layer_fingerprint(metadata: dict, feature_count=None, content=None):
+    """
+    Hash of what tells us a layer changed upstream: the edit dates and
+    serverGens of the layer metadata plus the feature count. content: server
+    side content check for layers without edit metadata (see
+    ARCGIS_Client.content_marker), otherwise an equal count would pass for unchanged.
+    """
+    editing_info = metadata.get('editingInfo') or {}
+    key = {
+        'lastEditDate': editing_info.get('lastEditDate'),
+        'schemaLastEditDate': editing_info.get('schemaLastEditDate'),
+        'dataLastEditDate': editing_info.get('dataLastEditDate'),
+        'serverGens': metadata.get('serverGens'),
+        'feature_count': feature_count,
+        }
+    if content is not None:
+        key['content'] = content
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def has_edit_metadata(metadata: dict):
+    """
+    True when the layer metadata itself tells when the data changed (edit dates or serverGens).
+    """
+    editing_info = metadata.get('editingInfo') or {}
+    return any(editing_info.get(x) for x in ['lastEditDate', 'dataLastEditDate']) or bool(metadata.get('serverGens'))
+
+
+class SyncManifest:
+    '''
+    JSON file {layer label: entry} with the state of the last successful sync
+    of every layer. Safe to share between the threads of the download engine.
+    '''
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+
+    def get(self, label: str):
+        with self._lock:
+            return self.entries.get(label)
+
+
+    def update(self, label: str, entry: dict):
+        with self._lock:
+            self.entries[label] = entry
+            self._save()
+
+
+    def remove(self, label: str):
+        with self._lock:
+            self.entries.pop(label, None)
+            self._save()
+
+
+    def _save(self):
+        # Write to a temporary file and swap it, a crash never leaves half a manifest.
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import uuid
+import datetime
+import threading
+import contextlib
+
+from .config import OUTPUTS_DIR
+
+
+METRICS_DIR = os.path.join(OUTPUTS_DIR, "metrics")
+PHASES = ['download', 'normalize', 'geometry', 'write']
+
+
+class ARCGIS_Metrics:
+    '''
+    Structured instrumentation of a run, safe to share between threads.
+
+    Every request (latency, bytes, features, retries, page size, status) is
+    appended to a JSON-lines run report as it happens (nothing is kept in
+    memory but the per-layer totals). finish() adds one line per layer
+    (totals + seconds per phase: download, normalize, geometry, write) and a
+    run summary, and writes the Prometheus textfile (node_exporter
+    textfile collector).
+
+    report_path: JSON-lines file, None to keep only the totals.
+    textfile_path: Prometheus .prom file, None to skip it.
+    '''
+    def __init__(self, report_path: str = None, textfile_path: str = None, run_id: str = None):
+        self.run_id = run_id or datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + "-" + uuid.uuid4().hex[:6]
+        self.report_path = report_path
+        self.textfile_path = textfile_path
+        self.started = time.time()
+        self.layers = {}
+        self._lock = threading.Lock()
+        self._report = None
+
+
+    @classmethod
+    def to_directory(cls, directory: str = METRICS_DIR):
+        """
+        Report and textfile in directory: run_<run id>.jsonl and arcgis_downloader.prom.
+        """
+        metrics = cls()
+        metrics.report_path = os.path.join(directory, f"run_{metrics.run_id}.jsonl")
+        metrics.textfile_path = os.path.join(directory, "arcgis_downloader.prom")
+        return metrics
+
+
+    def _layer(self, label):
+        # Called under the lock.
+        if label not in self.layers:
+            self.layers[label] = {
+                'requests': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'features': 0,
+                'request_seconds': 0.0, 'phases': {phase: 0.0 for phase in PHASES},
+                'status': None, 'error': None,
+                }
+        return self.layers[label]
+
+
+    def record_request(self, label: str, kind: str, latency: float, nbytes: int = 0, features: int = None, retries: int = 0, page_size: int = None, status=None, error: str = None):
+        """
+        kind: "query" (features), "count" or "ids". retries: attempt number of this request (0 = first).
+        """
+        with self._lock:
+            layer = self._layer(label)
+            layer['requests'] += 1
+            layer['retries'] += int(retries > 0)
+            layer['errors'] += int(error is not None)
+            layer['bytes'] += nbytes
+            layer['features'] += features or 0
+            layer['request_seconds'] += latency
+            self._write({
+                'type': "request",
+                'run_id': self.run_id,
+                'time': round(time.time(), 3),
+                'layer': label,
+                'kind': kind,
+                'latency': round(latency, 4),
+                'bytes': nbytes,
+                'features': features,
+                'retries': retries,
+                'page_size': page_size,
+                'status': status,
+                'error': error,
+                })
+
+
+    @contextlib.contextmanager
+    def phase(self, label: str, name: str):
+        """
+        with metrics.phase(job.label, "geometry"): ...   (adds up if entered several times)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(label, name, time.perf_counter() - start)
+
+
+    def add_phase_time(self, label: str, name: str, seconds: float):
+        """
+        For time measured elsewhere, e.g. in the transform worker processes.
+        """
+        with self._lock:
+            phases = self._layer(label)['phases']
+            phases[name] = phases.get(name, 0.0) + seconds
+
+
+    def layer_finished(self, label: str, status: str, error: str = None):
+        """
+        status: "done", "skipped" or "failed".
+        """
+        with self._lock:
+            layer = self._layer(label)
+            layer['status'] = status
+            layer['error'] = error
+
+
+    def summary(self):
+
+        with self._lock:
+            layers = {label: dict(layer, phases=dict(layer['phases'])) for label, layer in self.layers.items()}
+        elapsed = time.time() - self.started
+        totals = {key: sum(layer[key] for layer in layers.values()) for key in ['requests', 'errors', 'retries', 'bytes', 'features']}
+        statuses = [layer['status'] for layer in layers.values()]
+        return {
+            'type': "run",
+            'run_id': self.run_id,
+            'started': round(self.started, 3),
+            'seconds': round(elapsed, 3),
+            'layers': len(layers),
+            'layers_done': statuses.count('done'),
+            'layers_skipped': statuses.count('skipped'),
+            'layers_failed': statuses.count('failed'),
+            **totals,
+            'features_per_second': round(totals['features'] / elapsed, 2) if elapsed > 0 else None,
+            'phases': {phase: round(sum(layer['phases'].get(phase, 0.0) for layer in layers.values()), 3) for phase in PHASES},
+            }, layers
+
+
+    def finish(self):
+        """
+        Appends the layer lines + run summary to the report and writes the
+        Prometheus textfile. Returns the run summary.
+        """
+        run, layers = self.summary()
+        with self._lock:
+            for label, layer in layers.items():
+                record = {'type': "layer", 'run_id': self.run_id, 'layer': label}
+                record.update(layer)
+                record['phases'] = {phase: round(seconds, 4) for phase, seconds in layer['phases'].items()}
+                record['features_per_second'] = self._throughput(layer)
+                self._write(record)
+            self._write(run)
+            if self._report is not None:
+                self._report.close()
+                self._report = None
+        if self.textfile_path is not None:
+            self.write_textfile(run, layers)
+        print(f"Run {self.run_id}: {run['features']} features, {run['bytes'] / 1e6:.1f} MB, {run['requests']} requests ({run['retries']} retries) in {run['seconds']:.1f}s")
+        return run
+
+
+    def write_textfile(self, run: dict, layers: dict):
+        """
+        Prometheus text exposition format, swapped in atomically (the collector may read it any time).
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                labels = ",".join(f'{key}="{_escape(value_)}"' for key, value_ in labels.items())
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+        metric("arcgis_run_timestamp_seconds", "gauge", "End of the last run.", [({}, round(time.time(), 3))])
+        metric("arcgis_run_duration_seconds", "gauge", "Duration of the last run.", [({}, run['seconds'])])
+        metric("arcgis_run_features_per_second", "gauge", "Features downloaded per second in the last run.", [({}, run['features_per_second'])])
+        metric("arcgis_run_layers", "gauge", "Layers of the last run by status.", [({'status': status}, run[f"layers_{status}"]) for status in ['done', 'skipped', 'failed']])
+        metric("arcgis_run_phase_seconds", "gauge", "Seconds spent per phase in the last run (summed over layers).", [({'phase': phase}, seconds) for phase, seconds in run['phases'].items()])
+
+        for key, help_text in [('features', "Features downloaded"), ('bytes', "Response bytes"), ('requests', "Requests sent"), ('retries', "Retried requests"), ('errors', "Failed requests")]:
+            metric(f"arcgis_layer_{key}", "gauge", f"{help_text} per layer in the last run.", [({'layer': label}, layer[key]) for label, layer in layers.items()])
+        metric("arcgis_layer_request_seconds", "gauge", "Seconds waiting for responses per layer in the last run.", [({'layer': label}, round(layer['request_seconds'], 4)) for label, layer in layers.items()])
+        metric("arcgis_layer_features_per_second", "gauge", "Features per second of request time per layer in the last run.", [({'layer': label}, self._throughput(layer)) for label, layer in layers.items()])
+        metric("arcgis_layer_phase_seconds", "gauge", "Seconds per phase per layer in the last run.", [({'layer': label, 'phase': phase}, round(seconds, 4)) for label, layer in layers.items() for phase, seconds in layer['phases'].items()])
+        metric("arcgis_layer_success", "gauge", "1 if the layer was downloaded or skipped as unchanged, 0 if it failed.", [({'layer': label}, int(layer['status'] != 'failed')) for label, layer in layers.items() if layer['status'] is not None])
+
+        os.makedirs(os.path.dirname(self.textfile_path) or ".", exist_ok=True)
+        tmp_path = f"{self.textfile_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.textfile_path)
+
+
+    @staticmethod
+    def _throughput(layer):
+        return round(layer['features'] / layer['request_seconds'], 2) if layer['request_seconds'] > 0 else None
+
+
+    def _write(self, record):
+        # Called under the lock.
+        if self.report_path is None:
+            return
+        if self._report is None:
+            os.makedirs(os.path.dirname(self.report_path) or ".", exist_ok=True)
+            self._report = open(self.report_path, "a", encoding="utf-8")
+        self._report.write(json.dumps(record, default=str))
+        self._report.write("\n")
+        self._report.flush()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
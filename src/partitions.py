@@ -0,0 +1,89 @@
+'''
+Partitioned work on GeoDataFrames for ARCGIS_Shapefiler:
+
+- write_partitions: one file per key value, the frame split once (groupby)
+  and the partitions written in parallel.
+- parallel_dissolve: dissolve by key (or of the whole frame), the unions done
+  per key / per spatial chunk in a process pool and merged after.
+'''
+import os
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+
+def write_partitions(gdf, key: str, output_dir: str, filename=None, driver: str = "ESRI Shapefile", extension: str = ".shp", workers: int = None):
+    """
+    Writes gdf split by the values of key, output_dir/{filename(value)}{extension}
+    per value (filename: default str(value)). The frame is grouped once, the
+    writes run in a thread pool (GDAL releases the GIL while writing).
+    Returns the written paths.
+    """
+    filename = str if filename is None else filename
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(os.path.join(output_dir, f"{filename(value)}{extension}"), part) for value, part in gdf.groupby(key, sort=False)]
+    workers = min(len(jobs), workers or min(8, multiprocessing.cpu_count() * 2))
+    if workers <= 1:
+        for path, part in jobs:
+            part.to_file(path, driver=driver)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(part.to_file, path, driver=driver) for path, part in jobs]:
+                future.result()
+    return [path for path, _ in jobs]
+
+
+def union_wkb(wkb):
+    """
+    Runs in the pool: union of a chunk of geometries (WKB) -> WKB.
+    """
+    return shapely.to_wkb(shapely.union_all(shapely.from_wkb(wkb)))
+
+
+def parallel_dissolve(gdf, by=None, workers: int = None, chunk_size: int = 5000, min_features: int = 20000):
+    """
+    gdf.dissolve(by) (other columns: first value), with the unions done in a
+    process pool: every key (the whole frame when by is None) is cut into
+    spatially compact chunks of chunk_size features (Hilbert order), the chunks
+    unioned in parallel and the partial unions of each key unioned at the end.
+    Frames under min_features features (or workers=1) use gdf.dissolve directly.
+    """
+    workers = multiprocessing.cpu_count() if workers is None else max(1, workers)
+    if (len(gdf) < min_features) or (workers == 1):
+        return gdf.dissolve(by=by).reset_index() if by is not None else gdf.dissolve()
+
+    geometry_name = gdf.geometry.name
+    crs = gdf.crs
+    # Other columns: first value in file order, like gdf.dissolve (before the Hilbert sort).
+    attributes = gdf.drop(columns=geometry_name)
+    attributes = attributes.iloc[[0]].reset_index(drop=True) if by is None else attributes.groupby(by, sort=True).first()
+    gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+    gdf = gdf.iloc[np.argsort(gdf.geometry.hilbert_distance(), kind="stable")]
+    if by is None:
+        groups = {None: np.arange(len(gdf))}
+    else:
+        groups = gdf.groupby(by, sort=False).indices # key -> row positions (Hilbert ordered)
+
+    tasks = []
+    wkb = shapely.to_wkb(gdf.geometry.values)
+    for key, positions in groups.items():
+        for start in range(0, len(positions), chunk_size):
+            tasks.append((key, wkb[positions[start:start + chunk_size]]))
+
+    partial = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for (key, _), result in zip(tasks, executor.map(union_wkb, [chunk for _, chunk in tasks])):
+            partial.setdefault(key, []).append(shapely.from_wkb(result))
+    unions = {key: shapely.union_all(parts) if len(parts) > 1 else parts[0] for key, parts in partial.items()}
+
+    if by is None:
+        dissolved = gpd.GeoDataFrame(attributes, geometry=[unions.get(None)], crs=crs)
+    else:
+        dissolved = gpd.GeoDataFrame(attributes, geometry=[unions.get(key) for key in attributes.index], crs=crs)
+    if dissolved.geometry.name != geometry_name:
+        dissolved = dissolved.rename_geometry(geometry_name)
+    dissolved = dissolved[[geometry_name] + [col for col in dissolved.columns if col != geometry_name]]
+    return dissolved if by is None else dissolved.reset_index()
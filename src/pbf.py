@@ -0,0 +1,522 @@
+'''
+Decoder for the Esri protobuf feature collections returned by /query?f=pbf
+(esriPBuffer.FeatureCollectionPBuffer). Written against the wire format so no
+generated protobuf classes are needed.
+
+The features are decoded columnar with numpy: the feature messages are found
+in one go (see _message_run), their fields are read one field of every
+feature per step (see _scan_fields, a python loop per attribute, not per
+feature), and values / coordinates of a page are decoded as whole arrays.
+Geometries are built in bulk by the same functions as the json path
+(utils.polygons_from_parts / linestrings_from_parts).
+'''
+import struct
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from .utils import polygons_from_parts, linestrings_from_parts
+
+
+# FeatureCollectionPBuffer.GeometryType
+GEOMETRY_POINT = 0
+GEOMETRY_MULTIPOINT = 1
+GEOMETRY_POLYLINE = 2
+GEOMETRY_POLYGON = 3
+GEOMETRY_NONE = 127
+
+# FeatureCollectionPBuffer.QuantizeOriginPostion
+ORIGIN_UPPER_LEFT = 0
+
+# FeatureCollectionPBuffer.FieldType, by enum value.
+FIELD_TYPES = ['esriFieldTypeSmallInteger', 'esriFieldTypeInteger', 'esriFieldTypeSingle', 'esriFieldTypeDouble',
+               'esriFieldTypeString', 'esriFieldTypeDate', 'esriFieldTypeOID', 'esriFieldTypeGeometry',
+               'esriFieldTypeBlob', 'esriFieldTypeRaster', 'esriFieldTypeGUID', 'esriFieldTypeGlobalID',
+               'esriFieldTypeXML']
+
+# protobuf wire types
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = 0, 1, 2, 5
+
+# FeatureResult.features (field 15, length delimited), a one byte key.
+FEATURE_KEY = (15 << 3) | LENGTH_DELIMITED
+
+# FeatureCollectionPBuffer.Value fields
+VALUE_STRING, VALUE_FLOAT, VALUE_DOUBLE, VALUE_SINT, VALUE_UINT, VALUE_INT64, VALUE_UINT64, VALUE_SINT64, VALUE_BOOL = range(1, 10)
+INTEGER_VALUES = [VALUE_SINT, VALUE_UINT, VALUE_INT64, VALUE_UINT64, VALUE_SINT64]
+NUMERIC_VALUES = INTEGER_VALUES + [VALUE_FLOAT, VALUE_DOUBLE]
+
+
+def _read_varint(buffer, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _read_field(buffer, pos):
+    """
+    The field at pos -> (field number, wire type, value, position after it).
+    Length delimited values are returned as (start, end) offsets into buffer, to avoid copies.
+    """
+    key, pos = _read_varint(buffer, pos)
+    number, wire_type = key >> 3, key & 0x7
+    if wire_type == VARINT:
+        value, pos = _read_varint(buffer, pos)
+    elif wire_type == LENGTH_DELIMITED:
+        length, pos = _read_varint(buffer, pos)
+        value = (pos, pos + length)
+        pos += length
+    elif wire_type == FIXED64:
+        value = buffer[pos:pos + 8]
+        pos += 8
+    elif wire_type == FIXED32:
+        value = buffer[pos:pos + 4]
+        pos += 4
+    else:
+        raise Exception(f"Unsupported protobuf wire type {wire_type}")
+    return number, wire_type, value, pos
+
+
+def _iter_fields(buffer, start=0, end=None):
+    """
+    Yields (field number, wire type, value) of a message (see _read_field).
+    """
+    pos = start
+    end = len(buffer) if end is None else end
+    while pos < end:
+        number, wire_type, value, pos = _read_field(buffer, pos)
+        yield number, wire_type, value
+
+
+def _varints(data):
+    """
+    Concatenated varints (uint8 array) -> uint64 numpy array, without a python loop per value.
+    """
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.r_[0, ends[:-1] + 1]
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    chunks = (data & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(chunks, starts)
+
+
+def _zigzags(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def _packed_varints(buffer, start, end):
+    """
+    Packed varint array -> uint64 numpy array.
+    """
+    return _varints(np.frombuffer(buffer, dtype=np.uint8, count=end - start, offset=start))
+
+
+def _varints_at(data, positions):
+    """
+    The varints starting at positions of data (uint8 array), all at once ->
+    (uint64 values, positions after them).
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    window = data[np.minimum(positions[:, None] + np.arange(10), len(data) - 1)]
+    size = np.argmax(window < 0x80, axis=1) + 1
+    chunks = (window & 0x7F).astype(np.uint64) << (7 * np.arange(10, dtype=np.uint64))
+    chunks[np.arange(10) >= size[:, None]] = 0
+    return chunks.sum(axis=1, dtype=np.uint64), positions + size
+
+
+def _ranges(starts, lengths):
+    """
+    Indices of the byte ranges [start, start + length) one after the other.
+    """
+    offsets = np.r_[0, np.cumsum(lengths)]
+    return np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+
+def _string(buffer, span):
+    return bytes(buffer[span[0]:span[1]]).decode("utf-8")
+
+
+def _strings(data, starts, ends):
+    """
+    utf-8 payloads -> object array of str, built by pyarrow in one go when it's installed.
+    """
+    lengths = ends - starts
+    offsets = np.r_[0, np.cumsum(lengths)]
+    gathered = data[_ranges(starts, lengths)]
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raw = gathered.tobytes()
+        strings = np.empty(len(lengths), dtype=object)
+        strings[:] = [raw[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+        return strings
+    array = pa.LargeStringArray.from_buffers(len(lengths), pa.py_buffer(offsets.astype(np.int64)), pa.py_buffer(gathered))
+    return array.to_numpy(zero_copy_only=False)
+
+
+def _fixed(data, starts, dtype):
+    """
+    Fixed size values (float / double) starting at starts -> float64 array.
+    """
+    dtype = np.dtype(dtype)
+    raw = data[starts[:, None] + np.arange(dtype.itemsize)]
+    return np.ascontiguousarray(raw).view(dtype).ravel().astype(float)
+
+
+def _double(raw):
+    return struct.unpack("<d", raw)[0]
+
+
+def _decode_message(buffer, span, doubles=()):
+    """
+    Small messages (Scale, Translate, Transform...) -> {field number: value}.
+    """
+    out = {}
+    for number, wire_type, value in _iter_fields(buffer, span[0], span[1]):
+        out[number] = _double(value) if (wire_type == FIXED64 and number in doubles) else value
+    return out
+
+
+def _decode_transform(buffer, span):
+
+    transform = {'origin': ORIGIN_UPPER_LEFT, 'scale': (1.0, 1.0), 'translate': (0.0, 0.0)}
+    for number, wire_type, value in _iter_fields(buffer, span[0], span[1]):
+        if number == 1:
+            transform['origin'] = value
+        elif number == 2:
+            scale = _decode_message(buffer, value, doubles=(1, 2))
+            transform['scale'] = (scale.get(1, 1.0), scale.get(2, 1.0))
+        elif number == 3:
+            translate = _decode_message(buffer, value, doubles=(1, 2))
+            transform['translate'] = (translate.get(1, 0.0), translate.get(2, 0.0))
+    return transform
+
+
+def _message_run(data, pos, end, key):
+    """
+    The length delimited fields with the same one byte key one after the other
+    from pos (e.g. the features of a FeatureResult) -> (payload starts, payload
+    ends, position after the run). Every byte equal to key is a possible field
+    start, the run is the chain of "next field" jumps from pos, followed by
+    pointer doubling (log steps, not a python loop per field).
+    """
+    candidates = pos + np.flatnonzero(data[pos:end] == key)
+    length, starts = _varints_at(data, candidates + 1)
+    after = starts + length.astype(np.int64)
+    # Candidate where each field ends, len(candidates) (the end of the run) when none.
+    last = len(candidates)
+    jump = np.searchsorted(candidates, after)
+    jump[(jump < last) & (candidates[np.minimum(jump, last - 1)] != after)] = last
+    jump[after > end] = last
+    jump = np.r_[jump, last]
+
+    chain = np.array([0])
+    while chain[-1] != last:
+        chain = np.r_[chain, jump[chain]]
+        jump = jump[jump]
+    chain = chain[chain != last]
+    return starts[chain], after[chain], int(after[chain[-1]])
+
+
+def _scan_fields(data, starts, ends):
+    """
+    The fields of many messages at once, reading one field of every message per
+    step. Returns a dict of arrays with a row per field, in message then field
+    order: message (index into starts), step (its position in the message),
+    number, wire_type, value (varints) and start / end (the others' payload).
+    """
+    columns = {name: [] for name in ['message', 'step', 'number', 'wire_type', 'value', 'start', 'end']}
+    message = np.arange(len(starts))
+    pos = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    step = 0
+    while True:
+        active = pos < ends[message]
+        message, pos = message[active], pos[active]
+        if len(message) == 0:
+            break
+        key, pos = _varints_at(data, pos)
+        number, wire_type = (key >> np.uint64(3)).astype(np.int64), (key & np.uint64(7)).astype(np.int64)
+        if not np.isin(wire_type, [VARINT, FIXED64, LENGTH_DELIMITED, FIXED32]).all():
+            raise Exception(f"Unsupported protobuf wire type {set(wire_type.tolist()) - {VARINT, FIXED64, LENGTH_DELIMITED, FIXED32}}")
+        value = np.zeros(len(pos), dtype=np.uint64)
+        start, end = pos.copy(), pos.copy()
+        is_varint = wire_type == VARINT
+        if is_varint.any():
+            value[is_varint], end[is_varint] = _varints_at(data, pos[is_varint])
+        is_delimited = wire_type == LENGTH_DELIMITED
+        if is_delimited.any():
+            length, start[is_delimited] = _varints_at(data, pos[is_delimited])
+            end[is_delimited] = start[is_delimited] + length.astype(np.int64)
+        end[wire_type == FIXED64] += 8
+        end[wire_type == FIXED32] += 4
+
+        for name, values in zip(columns, [message, np.full(len(message), step), number, wire_type, value, start, end]):
+            columns[name].append(values)
+        pos = end
+        step += 1
+
+    if not columns['message']:
+        return {name: np.empty(0, dtype=np.uint64 if name == 'value' else np.int64) for name in columns}
+    columns = {name: np.concatenate(values) for name, values in columns.items()}
+    order = np.lexsort((columns['step'], columns['message']))
+    return {name: values[order] for name, values in columns.items()}
+
+
+def decode_feature_collection(content: bytes):
+    """
+    Decodes a /query?f=pbf response into a page dict like the json ones:
+        {'features': DataFrame ('attributes.<field>' columns + shapely 'geometry'),
+         'fields': [{'name', 'type', 'alias'}], 'exceededTransferLimit': bool}
+    Count / ObjectID responses return {'count': n} / {'objectIdFieldName', 'objectIds'}.
+    """
+    buffer = memoryview(content)
+    query_result = None
+    for number, wire_type, value in _iter_fields(buffer):
+        if number == 2:
+            query_result = value
+    if query_result is None:
+        raise Exception("Not an Esri FeatureCollectionPBuffer payload.")
+
+    for number, wire_type, value in _iter_fields(buffer, *query_result):
+        if number == 1:
+            return _decode_feature_result(buffer, value)
+        if number == 2:
+            return {'count': _decode_message(buffer, value).get(1, 0)}
+        if number == 3:
+            ids = {'objectIdFieldName': None, 'objectIds': []}
+            for n, wt, v in _iter_fields(buffer, *value):
+                if n == 1:
+                    ids['objectIdFieldName'] = _string(buffer, v)
+                elif n == 3:
+                    ids['objectIds'] = _packed_varints(buffer, *v).tolist()
+            return ids
+    return {'features': pd.DataFrame({'geometry': []}), 'fields': []}
+
+
+def _decode_field(buffer, span):
+    """
+    Field message -> {'name', 'type', 'alias'} like the json fields (+ 'domain'
+    when the server sends one). fieldType 0 (SmallInteger) is left out of the
+    message by proto3, hence the default.
+    """
+    message = _decode_message(buffer, span)
+    field_type = message.get(2, 0)
+    field = {
+        'name': _string(buffer, message[1]) if 1 in message else None,
+        'type': FIELD_TYPES[field_type] if field_type < len(FIELD_TYPES) else None,
+        'alias': _string(buffer, message[3]) if 3 in message else None,
+        }
+    domain = _string(buffer, message[5]) if 5 in message else ""
+    if domain:
+        field['domain'] = domain
+    return field
+
+
+def _decode_feature_result(buffer, span):
+
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    geometry_type = GEOMETRY_NONE
+    transform = {'origin': ORIGIN_UPPER_LEFT, 'scale': (1.0, 1.0), 'translate': (0.0, 0.0)}
+    has_z = has_m = False
+    exceeded = False
+    fields = []
+    feature_starts, feature_ends = [], []
+
+    pos, end = span
+    while pos < end:
+        if buffer[pos] == FEATURE_KEY:
+            starts, ends, pos = _message_run(data, pos, end, FEATURE_KEY)
+            feature_starts.append(starts)
+            feature_ends.append(ends)
+            continue
+        number, wire_type, value, pos = _read_field(buffer, pos)
+        if number == 7:
+            geometry_type = value
+        elif number == 9:
+            exceeded = bool(value)
+        elif number == 10:
+            has_z = bool(value)
+        elif number == 11:
+            has_m = bool(value)
+        elif number == 12:
+            transform = _decode_transform(buffer, value)
+        elif number == 13:
+            fields.append(_decode_field(buffer, value))
+
+    starts = np.concatenate(feature_starts) if feature_starts else np.empty(0, dtype=np.int64)
+    ends = np.concatenate(feature_ends) if feature_ends else np.empty(0, dtype=np.int64)
+    n = len(starts)
+    names = [field['name'] for field in fields]
+    rows = _scan_fields(data, starts, ends)
+
+    # Feature.attributes (1): the n-th one of a feature is the n-th field.
+    is_attribute = rows['number'] == 1
+    attribute_feature = rows['message'][is_attribute]
+    first = np.r_[True, attribute_feature[1:] != attribute_feature[:-1]] if len(attribute_feature) else np.empty(0, dtype=bool)
+    position = np.arange(len(attribute_feature))
+    attribute_index = position - np.maximum.accumulate(np.where(first, position, 0))
+    known = attribute_index < len(names)
+    columns = _decode_values(data, rows['start'][is_attribute][known], rows['end'][is_attribute][known], attribute_feature[known], attribute_index[known], n, len(names))
+
+    # Feature.geometry (2), the last one wins like in protobuf.
+    is_geometry = rows['number'] == 2
+    geometry_feature, geometry_index = np.unique(rows['message'][is_geometry][::-1], return_index=True)
+    geometry_rows = np.flatnonzero(is_geometry)[::-1][geometry_index]
+    geometries = np.full(n, None, dtype=object)
+    if len(geometry_feature) and geometry_type in (GEOMETRY_POINT, GEOMETRY_MULTIPOINT, GEOMETRY_POLYLINE, GEOMETRY_POLYGON):
+        geometries[geometry_feature] = _decode_geometries(data, rows['start'][geometry_rows], rows['end'][geometry_rows], geometry_type, transform, 2 + int(has_z) + int(has_m))
+
+    frame = pd.DataFrame({f"attributes.{name}": values for name, values in zip(names, columns)}, index=pd.RangeIndex(n))
+    frame['geometry'] = geometries
+    return {'features': frame, 'fields': fields, 'exceededTransferLimit': exceeded}
+
+
+def _decode_values(data, starts, ends, feature, column, n_features, n_columns):
+    """
+    Value messages of every attribute of a page (with their feature and column)
+    -> one array per column, decoded per Value type in bulk. Features without
+    the value (or an empty Value, a null) get None / NaN, like json_normalize.
+    """
+    rows = _scan_fields(data, starts, ends)
+    rows = {name: values[rows['step'] == 0] for name, values in rows.items()} # A Value holds one field.
+    kind = rows['number']
+    feature, column = feature[rows['message']], column[rows['message']]
+
+    decoded = np.full(len(kind), None, dtype=object)
+    numbers = np.full(len(kind), np.nan)
+    integers = np.zeros(len(kind), dtype=np.int64)
+    value = rows['value']
+    for number in np.unique(kind):
+        mask = kind == number
+        if number == VALUE_STRING:
+            decoded[mask] = _strings(data, rows['start'][mask], rows['end'][mask])
+        elif number == VALUE_BOOL:
+            decoded[mask] = value[mask] != 0
+        elif number in (VALUE_FLOAT, VALUE_DOUBLE):
+            numbers[mask] = _fixed(data, rows['start'][mask], "<f4" if number == VALUE_FLOAT else "<f8")
+            decoded[mask] = numbers[mask]
+        elif number in INTEGER_VALUES:
+            # int64 are two's complement varints, unsigned ones (ids, counts) stay under 2**63.
+            integers[mask] = _zigzags(value[mask]) if number in (VALUE_SINT, VALUE_SINT64) else value[mask].view(np.int64)
+            numbers[mask] = integers[mask]
+            decoded[mask] = integers[mask]
+
+    order = np.lexsort((feature, column))
+    bounds = np.searchsorted(column[order], np.arange(n_columns + 1))
+    out = []
+    for j in range(n_columns):
+        index = order[bounds[j]:bounds[j + 1]]
+        kinds = np.unique(kind[index])
+        complete = len(index) == n_features
+        if complete and len(kinds) and np.isin(kinds, INTEGER_VALUES).all():
+            values = np.empty(n_features, dtype=np.int64)
+            values[feature[index]] = integers[index]
+        elif len(kinds) and np.isin(kinds, NUMERIC_VALUES).all():
+            values = np.full(n_features, np.nan)
+            values[feature[index]] = numbers[index]
+        elif complete and len(kinds) and (kinds == VALUE_BOOL).all():
+            values = np.empty(n_features, dtype=bool)
+            values[feature[index]] = value[index] != 0
+        else:
+            values = np.full(n_features, None, dtype=object)
+            values[feature[index]] = decoded[index]
+        out.append(values)
+    return out
+
+
+def _decode_geometries(data, starts, ends, geometry_type, transform, stride):
+    """
+    Geometry messages -> shapely geometries, all at once. Coordinates are zigzag
+    deltas from the previous vertex of the same part in the quantized space of
+    the transform, the first vertex of every part is relative to the origin
+    (like the paths / rings of quantized Esri json, see utils.dequantize_features).
+    """
+    n = len(starts)
+    rows = _scan_fields(data, starts, ends)
+    packed = rows['wire_type'] == LENGTH_DELIMITED
+
+    def packed_field(number, decode):
+        # Every packed array of the field in one buffer -> (values, count per message).
+        mask = packed & (rows['number'] == number)
+        lengths = rows['end'][mask] - rows['start'][mask]
+        raw = data[_ranges(rows['start'][mask], lengths)]
+        counts = np.zeros(n, dtype=np.int64)
+        if len(raw):
+            terminators = np.r_[0, np.cumsum(raw < 0x80)]
+            offsets = np.r_[0, np.cumsum(lengths)]
+            np.add.at(counts, rows['message'][mask], terminators[offsets[1:]] - terminators[offsets[:-1]])
+        return decode(_varints(raw)), counts
+
+    lengths, n_lengths = packed_field(2, lambda values: values.astype(np.int64))
+    coords, n_coords = packed_field(3, _zigzags)
+    n_vertices = n_coords // stride
+    coords = coords[:n_vertices.sum() * stride].reshape(-1, stride)[:, :2] if len(coords) else np.empty((0, 2), dtype=np.int64)
+    vertex_start = np.cumsum(n_vertices) - n_vertices
+
+    # Parts: the lengths of the message, or a single part with every vertex.
+    single = (n_lengths == 0) & (n_vertices > 0)
+    part_message = np.r_[np.repeat(np.arange(n), n_lengths), np.flatnonzero(single)]
+    part_size = np.r_[lengths, n_vertices[single]]
+    order = np.argsort(part_message, kind="stable")
+    part_message, part_size = part_message[order], part_size[order]
+    if not np.array_equal(np.bincount(part_message, weights=part_size, minlength=n).astype(np.int64), n_vertices):
+        raise Exception("Invalid pbf geometry: part lengths don't add up to the coordinates.")
+
+    # The running sum starts over at every part.
+    xy = np.cumsum(coords, axis=0)
+    part_start = np.cumsum(part_size) - part_size
+    before = np.r_[[[0, 0]], xy][part_start]
+    xy = (xy - np.repeat(before, part_size, axis=0)).astype(float)
+    (x_scale, y_scale), (x_translate, y_translate) = transform['scale'], transform['translate']
+    xy[:, 0] = x_translate + xy[:, 0] * x_scale
+    if transform['origin'] == ORIGIN_UPPER_LEFT:
+        xy[:, 1] = y_translate - xy[:, 1] * y_scale
+    else:
+        xy[:, 1] = y_translate + xy[:, 1] * y_scale
+
+    if geometry_type == GEOMETRY_POINT:
+        geometries = np.full(n, None, dtype=object)
+        has_point = n_vertices > 0
+        geometries[has_point] = shapely.points(xy[vertex_start[has_point]])
+        return geometries
+    if geometry_type == GEOMETRY_MULTIPOINT:
+        geometries = np.full(n, None, dtype=object)
+        vertex_message = np.repeat(np.arange(n), n_vertices)
+        present, index = np.unique(vertex_message, return_inverse=True)
+        if len(present):
+            geometries[present] = shapely.multipoints(shapely.points(xy), indices=index)
+        return geometries
+
+    min_points = 4 if geometry_type == GEOMETRY_POLYGON else 2
+    keep = part_size >= min_points
+    xy = xy[np.repeat(keep, part_size)]
+    if geometry_type == GEOMETRY_POLYGON:
+        return polygons_from_parts(xy, part_message[keep], part_size[keep], n)
+    return linestrings_from_parts(xy, part_message[keep], part_size[keep], n)
+
+
+def decode_geojson(data: dict):
+    """
+    /query?f=geojson response -> page dict with the same layout as decode_feature_collection.
+    """
+    features = data.get('features', [])
+    frame = pd.json_normalize([feature.get('properties') or {} for feature in features])
+    frame.columns = [f"attributes.{col}" for col in frame.columns]
+    frame['geometry'] = [shapely.geometry.shape(f['geometry']) if f.get('geometry') else None for f in features]
+    return {
+        'features': frame,
+        'fields': [],
+        'exceededTransferLimit': bool((data.get('properties') or {}).get('exceededTransferLimit', data.get('exceededTransferLimit', False))),
+        }
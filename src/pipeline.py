@@ -0,0 +1,135 @@
+import time
+import queue
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .writers import encode_page
+
+
+def transform_page(features, name_lower: str, stream_format: str = None):
+    """
+    Runs in a transform worker process: one page of features -> the normalized
+    frame fetch_frame would build for it (see normalize_frame), or a
+    GeoDataFrame encoded for the stream writer when stream_format is given.
+    Returns (result, n features, {phase: seconds}).
+    """
+    from .arcgis_client import features_to_geodataframe, normalize_frame, page_frame
+
+    timings = {}
+
+    @contextlib.contextmanager
+    def phase(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+    if stream_format is None:
+        df = normalize_frame(page_frame(features), name_lower, phase)
+        return df, len(df), timings
+    gdf = features_to_geodataframe(features, name_lower, phase)
+    with phase('write'): # Encoding is the CPU part of writing.
+        encoded = encode_page(gdf, stream_format)
+    return encoded, len(gdf), timings
+
+
+def transform_pool(workers: int):
+    """
+    Process pool for transform_page. Spawned (not forked) workers, the pool is
+    created from the download threads and forking a threaded process can deadlock.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+class ARCGIS_PagePipeline:
+    '''
+    Staged processing of the pages of one layer:
+
+        fetch (calling thread) -> transform (process pool) -> write (writer thread)
+
+    Every page is handed to the pool as soon as it arrives, so the next page
+    downloads while the previous ones are normalized / geometry-built /
+    encoded, and a writer thread persists the results in page order. The
+    queue between fetch and write holds at most depth pages in flight: when
+    the pool or the writer fall behind, fetching blocks (backpressure) and
+    memory stays bounded. Layers downloaded at the same time share the pool,
+    so every core can be busy during a crawl.
+
+    write(result, n_features): called in the writer thread, in page order.
+    phase(name): context manager timing the fetch stage ("download").
+    on_timings({phase: seconds}): transform timings measured in the workers.
+    '''
+    def __init__(self, executor, name_lower: str, write, depth: int = 4, stream_format: str = None, phase=None, on_timings=None):
+        self.executor = executor
+        self.name_lower = name_lower
+        self.write = write
+        self.stream_format = stream_format
+        self.phase = phase if phase is not None else (lambda name: contextlib.nullcontext())
+        self.on_timings = on_timings
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.error = None
+        self.n_features = 0
+        self.fields = []
+
+
+    def run(self, pages):
+        """
+        Consumes the page dicts of pages, returns the number of features written.
+        The fields of the last page listing them are kept in self.fields.
+        """
+        pages = iter(pages)
+        writer = threading.Thread(target=self._write_loop, daemon=True)
+        writer.start()
+        try:
+            while self.error is None:
+                with self.phase('download'):
+                    data = next(pages, None)
+                if data is None:
+                    break
+                if 'fields' in data:
+                    self.fields = data['fields']
+                if len(data['features']) == 0:
+                    continue
+                future = self.executor.submit(transform_page, data['features'], self.name_lower, self.stream_format)
+                self._put(future)
+        finally:
+            self._put(None)
+            writer.join()
+        if self.error is not None:
+            raise self.error
+        return self.n_features
+
+
+    def _put(self, item):
+        # Blocks while the queue is full. If the writer failed it only drains the
+        # queue, pages are dropped but the final None always gets through.
+        while True:
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if (self.error is not None) and (item is not None):
+                    item.cancel()
+                    return
+
+
+    def _write_loop(self):
+
+        while True:
+            future = self.queue.get()
+            if future is None:
+                return
+            if self.error is not None:
+                future.cancel() # Draining after a failure.
+                continue
+            try:
+                result, n_features, timings = future.result()
+                if self.on_timings is not None:
+                    self.on_timings(timings)
+                self.write(result, n_features)
+                self.n_features += n_features
+            except BaseException as e:
+                self.error = e
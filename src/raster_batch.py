@@ -0,0 +1,176 @@
+'''
+Batch rasterization helpers: a common grid (CRS + transform + shape) shared by
+many layers, and the per-layer work run in the worker processes of
+ARCGIS_BatchRasterize (src/rasterizer.py). Kept free of plotting imports so
+the workers start fast.
+'''
+import os
+import json
+import math
+
+import numpy as np
+
+from .utils import read_layer
+
+
+class RasterGrid:
+    '''
+    Common grid of a batch: every layer is burnt with the same CRS, transform
+    and shape so the rasters align pixel to pixel (and can be stacked).
+    Bounds are snapped to multiples of pixel_size.
+    '''
+    def __init__(self, bounds, pixel_size: float, crs: str = "EPSG:4326"):
+        minx, miny, maxx, maxy = bounds
+        self.pixel_size = pixel_size
+        self.crs = crs
+        self.bounds = (
+            math.floor(minx / pixel_size) * pixel_size,
+            math.floor(miny / pixel_size) * pixel_size,
+            math.ceil(maxx / pixel_size) * pixel_size,
+            math.ceil(maxy / pixel_size) * pixel_size,
+            )
+        self.width = max(1, int(round((self.bounds[2] - self.bounds[0]) / pixel_size)))
+        self.height = max(1, int(round((self.bounds[3] - self.bounds[1]) / pixel_size)))
+
+
+    @property
+    def transform(self):
+        from rasterio.transform import from_origin
+        return from_origin(self.bounds[0], self.bounds[3], self.pixel_size, self.pixel_size)
+
+
+    def to_dict(self):
+        return {'bounds': list(self.bounds), 'pixel_size': self.pixel_size, 'crs': self.crs}
+
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data['bounds'], data['pixel_size'], data['crs'])
+
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+    def __repr__(self):
+        return f"RasterGrid({self.width}x{self.height} px of {self.pixel_size}, bounds={self.bounds}, crs={self.crs})"
+
+
+def layer_bounds(file_path: str, crs: str):
+    """
+    Runs in the pool: total bounds of a layer in crs (nan for empty layers).
+    """
+    gdf = read_layer(file_path)
+    if gdf.crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    return tuple(gdf.total_bounds)
+
+
+def rasterize_layer(file_path: str, attribute_col: str, legend_col: str, grid: dict, output_path: str, all_touched: bool = True, fill=0, merge_alg=None, block_size: int = None, cog: bool = True):
+    """
+    Runs in the pool: burns one layer onto the grid (RasterGrid.to_dict()) and
+    writes it to output_path (a COG with overviews if cog). block_size: burn and
+    write it block by block (see src/raster_tiles.py), bounded memory for big grids.
+    Returns (output_path, legend {legend value: attribute value}, dtype name).
+    """
+    import rasterio
+    from rasterio import features
+    from rasterio.crs import CRS
+    from rasterio.enums import MergeAlg
+    from .raster_tiles import rasterize_tiled, write_cog
+
+    grid = RasterGrid.from_dict(grid)
+    merge_alg = MergeAlg.replace if merge_alg is None else merge_alg
+    gdf = read_layer(file_path)
+    if gdf.crs is not None and gdf.crs != grid.crs:
+        gdf = gdf.to_crs(grid.crs)
+    gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+
+    legend = dict(gdf[[legend_col, attribute_col]].drop_duplicates().values)
+    dtype = np.dtype(gdf[attribute_col].dtype).name
+    tags = {'legend': json.dumps(legend, default=str)}
+
+    if block_size is not None:
+        rasterize_tiled(
+            gdf.geometry.values, gdf[attribute_col].values, grid.transform, grid.width, grid.height, output_path,
+            crs=CRS.from_user_input(grid.crs), dtype=dtype, fill=fill, all_touched=all_touched,
+            merge_alg=merge_alg, block_size=block_size, workers=1, tags=tags, cog=cog,
+            )
+        return output_path, legend, dtype
+
+    rasterized = features.rasterize(
+        zip(gdf.geometry, gdf[attribute_col]),
+        out_shape=(grid.height, grid.width),
+        transform=grid.transform,
+        all_touched=all_touched,
+        fill=fill,
+        merge_alg=merge_alg,
+        dtype=dtype,
+        )
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    if cog:
+        write_cog(rasterized, output_path, grid.transform, CRS.from_user_input(grid.crs), nodata=fill, tags=tags)
+        return output_path, legend, dtype
+    with rasterio.open(
+        output_path, "w", driver="GTiff", height=grid.height, width=grid.width, count=1, dtype=dtype,
+        crs=CRS.from_user_input(grid.crs), transform=grid.transform, nodata=fill, compress="deflate",
+    ) as dst:
+        dst.write(rasterized, 1)
+        dst.update_tags(**tags)
+    return output_path, legend, dtype
+
+
+def stack_rasters(paths: list, output_path: str, names: list = None, legends: list = None, block_size: int = 1024, compress: str = "deflate", cog: bool = True):
+    """
+    Aligned single-band rasters -> one multi-band GeoTIFF (band i = paths[i]),
+    copied block by block (then converted to a COG if cog). Bands are named
+    after names and tagged with their legend.
+    """
+    import rasterio
+    from rasterio.windows import Window
+    from .raster_tiles import block_windows, to_cog
+
+    final_path = output_path
+    if cog:
+        output_path = f"{final_path}.{os.getpid()}.tmp.tif"
+
+    sources = [rasterio.open(path) for path in paths]
+    try:
+        first = sources[0]
+        for src in sources[1:]:
+            if (src.transform != first.transform) or (src.shape != first.shape) or (src.crs != first.crs):
+                raise Exception(f"{src.name} is not on the grid of {first.name}, can't stack them.")
+        dtype = np.result_type(*[src.dtypes[0] for src in sources]).name
+        profile = dict(
+            driver="GTiff", width=first.width, height=first.height, count=len(sources), dtype=dtype,
+            crs=first.crs, transform=first.transform, nodata=first.nodata, tiled=True,
+            blockxsize=block_size, blockysize=block_size, compress=compress, BIGTIFF="IF_SAFER",
+            )
+        with rasterio.open(output_path, "w", **profile) as dst:
+            for col_off, row_off, width, height in block_windows(first.width, first.height, block_size):
+                window = Window(col_off, row_off, width, height)
+                for band, src in enumerate(sources, start=1):
+                    dst.write(src.read(1, window=window).astype(dtype, copy=False), band, window=window)
+            for band in range(1, len(sources) + 1):
+                if names is not None:
+                    dst.set_band_description(band, names[band - 1])
+                if legends is not None:
+                    dst.update_tags(band, legend=json.dumps(legends[band - 1], default=str))
+            if names is not None:
+                dst.update_tags(bands=json.dumps(names))
+    finally:
+        for src in sources:
+            src.close()
+    if cog:
+        try:
+            to_cog(output_path, final_path, compress=compress)
+        finally:
+            os.remove(output_path)
+    return final_path
@@ -0,0 +1,189 @@
+'''
+Tiled rasterization: the raster is cut in blocks, only the geometries
+intersecting a block (found with an STRtree) are burnt into it, blocks are
+burnt in a process pool and written windowed to a tiled, compressed GeoTIFF.
+Memory is bounded by the block size (times the blocks in flight), not by the
+raster size. write_cog / to_cog turn the outputs into Cloud-Optimized GeoTIFFs.
+'''
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import shapely
+
+
+def block_windows(width: int, height: int, block_size: int):
+    """
+    (col_off, row_off, width, height) of the blocks covering the raster, row by row.
+    """
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off)
+
+
+def burn_block(wkb, values, block_transform, shape, fill, dtype, all_touched: bool, merge_alg):
+    """
+    Runs in the pool: geometries (WKB) + values -> array of the block.
+    """
+    from rasterio import features
+
+    if len(wkb) == 0:
+        return np.full(shape, fill, dtype=dtype)
+    geometries = shapely.from_wkb(wkb)
+    return features.rasterize(
+        zip(geometries, values),
+        out_shape=shape,
+        transform=block_transform,
+        all_touched=all_touched,
+        fill=fill,
+        merge_alg=merge_alg,
+        dtype=dtype,
+        )
+
+
+def rasterize_tiled(geometries, values, transform, width: int, height: int, output_path: str, crs, dtype, fill=0, all_touched: bool = True, merge_alg=None, block_size: int = 1024, workers: int = None, compress: str = "deflate", tags: dict = None, cog: bool = False):
+    """
+    Burns geometries (array of shapely geometries) with values into a
+    width x height GeoTIFF at output_path, block_size x block_size blocks at
+    a time (block_size is also the TIFF tile size, a multiple of 16).
+    workers: processes burning blocks (None: all cores, 1: in this process).
+    cog: written to a temporary GeoTIFF first, then converted with to_cog.
+    Geometries keep their order inside a block, so MergeAlg.replace gives the
+    same result as one features.rasterize call over the whole raster.
+    """
+    import rasterio
+    from rasterio.enums import MergeAlg
+    from rasterio.windows import Window, transform as window_transform
+
+    if block_size % 16 != 0:
+        raise Exception("block_size must be a multiple of 16 (GeoTIFF tiles).")
+    merge_alg = MergeAlg.replace if merge_alg is None else merge_alg
+    dtype = np.dtype(dtype).name
+    geometries = np.asarray(geometries, dtype=object)
+    values = np.asarray(values)
+    tree = shapely.STRtree(geometries)
+    workers = multiprocessing.cpu_count() if workers is None else max(1, workers)
+
+    profile = dict(
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=1,
+        dtype=dtype,
+        crs=crs,
+        transform=transform,
+        nodata=fill,
+        tiled=True,
+        blockxsize=block_size,
+        blockysize=block_size,
+        compress=compress,
+        BIGTIFF="IF_SAFER",
+        )
+
+    def jobs():
+        for col_off, row_off, block_width, block_height in block_windows(width, height, block_size):
+            window = Window(col_off, row_off, block_width, block_height)
+            block_transform = window_transform(window, transform)
+            # Block bounds: upper left + lower right corners.
+            minx, maxy = block_transform * (0, 0)
+            maxx, miny = block_transform * (block_width, block_height)
+            index = np.sort(tree.query(shapely.box(min(minx, maxx), min(miny, maxy), max(minx, maxx), max(miny, maxy))))
+            args = (shapely.to_wkb(geometries[index]), values[index], block_transform, (block_height, block_width), fill, dtype, all_touched, merge_alg)
+            yield window, args
+
+    final_path = output_path
+    if cog:
+        output_path = f"{final_path}.{os.getpid()}.tmp.tif"
+
+    with rasterio.open(output_path, "w", **profile) as dst:
+        if workers == 1:
+            for window, args in jobs():
+                dst.write(burn_block(*args), 1, window=window)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                pending = {}
+                for window, args in jobs():
+                    if len(args[0]) == 0:
+                        dst.write(burn_block(*args), 1, window=window) # Empty block, not worth a round trip.
+                        continue
+                    # At most 2 blocks per worker in flight, memory stays bounded.
+                    if len(pending) >= 2 * workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            dst.write(future.result(), 1, window=pending.pop(future))
+                    pending[executor.submit(burn_block, *args)] = window
+                for future in list(pending):
+                    dst.write(future.result(), 1, window=pending.pop(future))
+        if tags:
+            dst.update_tags(**tags)
+    if cog:
+        try:
+            to_cog(output_path, final_path, compress=compress)
+        finally:
+            os.remove(output_path)
+    return final_path
+
+
+def to_cog(src_path, dst_path: str, block_size: int = 512, compress: str = "deflate", resampling: str = "mode", overviews: bool = True):
+    """
+    GeoTIFF (path, or an open rasterio dataset / MemoryFile dataset) -> Cloud-Optimized
+    GeoTIFF at dst_path: block_size tiles, compressed, internal overviews
+    (halving until they fit a tile) built with resampling ("mode" keeps the
+    categories of categorical rasters, "nearest" is faster). Tags are kept.
+    """
+    import rasterio
+    import rasterio.shutil
+
+    options = dict(
+        driver="COG",
+        BLOCKSIZE=block_size,
+        COMPRESS=compress.upper(),
+        OVERVIEWS="AUTO" if overviews else "NONE",
+        RESAMPLING=resampling.upper(),
+        BIGTIFF="IF_SAFER",
+        )
+    with rasterio.Env() as env:
+        if "COG" in env.drivers():
+            rasterio.shutil.copy(src_path, dst_path, **options)
+            return dst_path
+
+    # GDAL < 3.1, no COG driver: overviews on a tiled copy, then copied first in the file.
+    from rasterio.enums import Resampling
+
+    tmp_path = f"{dst_path}.{os.getpid()}.tmp.tif"
+    rasterio.shutil.copy(src_path, tmp_path, driver="GTiff", tiled=True, blockxsize=block_size, blockysize=block_size, compress=compress)
+    try:
+        with rasterio.open(tmp_path, "r+") as dst:
+            factors = []
+            factor = 2
+            while overviews and max(dst.width, dst.height) / factor >= block_size / 2:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                dst.build_overviews(factors, Resampling[resampling.lower()])
+        rasterio.shutil.copy(
+            tmp_path, dst_path, driver="GTiff", tiled=True, blockxsize=block_size, blockysize=block_size,
+            compress=compress, COPY_SRC_OVERVIEWS="YES", BIGTIFF="IF_SAFER",
+            )
+    finally:
+        os.remove(tmp_path)
+    return dst_path
+
+
+def write_cog(array, output_path: str, transform, crs, nodata=None, tags: dict = None, block_size: int = 512, compress: str = "deflate", resampling: str = "mode"):
+    """
+    In-memory 2D array -> Cloud-Optimized GeoTIFF (see to_cog), through a MemoryFile.
+    """
+    from rasterio.io import MemoryFile
+
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="GTiff", height=array.shape[0], width=array.shape[1], count=1, dtype=array.dtype,
+            crs=crs, transform=transform, nodata=nodata,
+        ) as dataset:
+            dataset.write(array, 1)
+            if tags:
+                dataset.update_tags(**tags)
+        with memfile.open() as dataset:
+            return to_cog(dataset, output_path, block_size=block_size, compress=compress, resampling=resampling)
@@ -1,6 +1,8 @@
 import os
 import glob
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import geopandas as gpd
 import numpy as np
@@ -10,24 +12,45 @@ from rasterio.enums import MergeAlg
 from rasterio.crs import CRS
 from rasterio.transform import from_bounds
 
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap, BoundaryNorm
-from matplotlib.colors import rgb2hex
-import plotly.express as px
-
 
 from .config import RASTER_DIR, OUTPUTS_DIR, MAP_RASTER_DIR
-from .utils import raster_categories_mapping, categories_mapping
-
-mapping = categories_mapping()
-mapping['long_filenames'] = mapping['level_2'] + "_" + mapping['filename']
-
-files = mapping['file_path'].unique().tolist()
-filenames = mapping['filename'].unique().tolist()
-long_filenames = mapping['long_filenames'].unique().tolist()
+from .utils import raster_categories_mapping, categories_mapping, read_layer
+from .raster_tiles import rasterize_tiled, write_cog
+from .raster_batch import RasterGrid, layer_bounds, rasterize_layer, stack_rasters
+
+CATALOG_NAMES = ['mapping', 'files', 'filenames', 'long_filenames']
+_catalog = None
+
+
+def catalog(refresh=False):
+    """
+    {mapping, files, filenames, long_filenames} of the downloaded layers, built
+    on first use (not at import) and kept for the process. refresh: build it again.
+    """
+    global _catalog
+    if (_catalog is None) or refresh:
+        mapping = categories_mapping()
+        mapping['long_filenames'] = mapping['level_2'] + "_" + mapping['filename']
+        _catalog = {
+            'mapping': mapping,
+            'files': mapping['file_path'].unique().tolist(),
+            'filenames': mapping['filename'].unique().tolist(),
+            'long_filenames': mapping['long_filenames'].unique().tolist(),
+            }
+    return _catalog
+
+
+def __getattr__(name):
+    # rasterizer.mapping / files / filenames / long_filenames still work, lazily.
+    if name in CATALOG_NAMES:
+        return catalog()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def generate_colors(length):
+    from matplotlib.colors import rgb2hex
+    import matplotlib.pyplot as plt
+
     # Use matplotlib's colormap to generate distinct colors
     cmap = plt.cm.get_cmap("viridis", length)  # "tab10" or another colormap
     colors = [rgb2hex(cmap(i)) for i in range(length)]
@@ -35,10 +58,86 @@ def generate_colors(length):
 
 
 
+def block_modes(blocks, padding=None):
+    """
+    (n, k) blocks -> most frequent value of every row (smallest one on ties):
+    sorted, the longest run of equal values taken. padding: (n, k) bool, True
+    for pixels outside the array, left out of the vote (sorted after the real
+    pixels and their runs never win).
+    """
+    position = np.arange(blocks.shape[1])
+    starts = np.ones(blocks.shape, dtype=bool)
+    if padding is None:
+        blocks = np.sort(blocks, axis=1)
+    else:
+        order = np.lexsort((blocks, padding), axis=1)
+        blocks = np.take_along_axis(blocks, order, axis=1)
+        padding = np.take_along_axis(padding, order, axis=1)
+    starts[:, 1:] = blocks[:, 1:] != blocks[:, :-1]
+    if padding is not None:
+        starts[:, 1:] |= padding[:, 1:] != padding[:, :-1]
+    run_start = np.maximum.accumulate(np.where(starts, position, 0), axis=1)
+    lengths = position - run_start
+    if padding is not None:
+        lengths[padding] = -1
+    longest = np.argmax(lengths, axis=1) # Last position of the longest run.
+    return blocks[np.arange(len(blocks)), longest]
+
+
+def mode_downsample(array, factor, chunk_pixels=4_000_000):
+    """
+    Categorical raster -> every factor x factor block replaced by its most
+    frequent value (smallest one on ties), see block_modes. Partial edge
+    blocks vote with their real pixels only. Done by strips of about
+    chunk_pixels input pixels, memory stays bounded.
+    """
+    if factor <= 1:
+        return array
+    height, width = array.shape
+    out_height, out_width = -(-height // factor), -(-width // factor)
+    full_width = width // factor # Output columns made of whole blocks.
+    out = np.empty((out_height, out_width), dtype=array.dtype)
+    strip = max(1, chunk_pixels // (factor * factor * out_width)) # Output rows per strip.
+    for row in range(0, out_height, strip):
+        rows = min(strip, out_height - row)
+        part = array[row * factor:(row + rows) * factor]
+        missing = rows * factor - part.shape[0]
+        if (missing == 0) and (full_width > 0):
+            blocks = part[:, :full_width * factor].reshape(rows, factor, full_width, factor).swapaxes(1, 2).reshape(-1, factor * factor)
+            out[row:row + rows, :full_width] = block_modes(blocks).reshape(rows, full_width)
+            first, part = full_width, part[:, full_width * factor:]
+        else:
+            first = 0
+        if part.shape[1] == 0:
+            continue
+        columns = out_width - first
+        pad = ((0, missing), (0, columns * factor - part.shape[1]))
+        padding = np.pad(np.zeros(part.shape, dtype=bool), pad, constant_values=True)
+        part = np.pad(part, pad)
+        reshape = lambda a: a.reshape(rows, factor, columns, factor).swapaxes(1, 2).reshape(-1, factor * factor)
+        out[row:row + rows, first:] = block_modes(reshape(part), reshape(padding)).reshape(rows, columns)
+    return out
+
+
+def category_labels(array, labels: dict, unknown="Unknown"):
+    """
+    Array of category values -> array of labels ({value: label}) through a
+    lookup table (searchsorted on the sorted categories), no Python call per pixel.
+    """
+    categories = np.array(sorted(labels))
+    table = np.array([labels[cat] for cat in categories] + [unknown], dtype=object)
+    if len(categories) == 0:
+        return np.full(array.shape, unknown, dtype=object)
+    index = np.searchsorted(categories, array)
+    index_in = np.minimum(index, len(categories) - 1)
+    index = np.where((index < len(categories)) & (categories[index_in] == array), index, len(categories))
+    return table[index]
+
+
 class ARCGIS_Rasterize:
     def __init__(self):
         self.file = None
-        self.files_list = filenames
+        self.files_list = catalog()['filenames']
         self.gdf = None
         self.rasterized = None
         self.raster_data = None
@@ -49,13 +148,14 @@ class ARCGIS_Rasterize:
         Select ARCGIS item.
         long file: {level_2}_{filename}
         """
+        long_filenames = catalog()['long_filenames']
         if long_file not in long_filenames:
             raise Exception(f"File '{long_file}' not found in the long_filenames.")
         tempo_index = long_filenames.index(long_file)
         self.file = "_".join(".".join(long_file.split(".")[:-1]).split("_")[1:])
-        self.file_path = files[tempo_index]
+        self.file_path = catalog()['files'][tempo_index]
         self.level_2 = ".".join(long_file.split(".")[:-1]).split("_")[0]
-        self.gdf = gpd.rarcgis_file(self.file_path)
+        self.gdf = read_layer(self.file_path)
         self.crs = CRS.from_epsg(self.gdf.crs.to_epsg())
 
 
@@ -99,14 +199,67 @@ class ARCGIS_Rasterize:
         self.rasterized = rasterized
 
 
-    def save_raster_file(self, output_path=None):
-        
+    def rasterize_tiled(self, output_path=None, block_size=1024, workers=None, all_touched=True, fill_value=0, merge_alg=MergeAlg.replace, compress="deflate", cog=True):
+        """
+        rasterize_vector() + save_raster_file() for large extents / fine pixel sizes:
+        the raster is burnt block_size x block_size pixels at a time (only the
+        geometries intersecting each block, through a spatial index) in a pool
+        of workers processes and written block by block to a tiled, compressed
+        GeoTIFF. Memory is bounded by the block size, self.rasterized is not filled.
+        cog: converted to a Cloud-Optimized GeoTIFF with overviews at the end.
+        """
+        if (self.gdf is None) or (self.geom_value is None) or (self.transform is None):
+            raise Exception(f"Run methods '.getting_vectors_data()' and 'geometry_input_attribute_col_and_legend_col()' before running this method.")
+
+        self.all_touched = all_touched
+        self.fill = fill_value
+        self.merge_alg = merge_alg
+        self.dtype = self.gdf[self.attribute_col].dtype
+        if output_path is None:
+            self.output_path = os.path.join(RASTER_DIR, f"{self.level_2}_{self.file}.tif")
+        else:
+            self.output_path = output_path
+
+        rasterize_tiled(
+            self.gdf.geometry.values,
+            self.gdf[self.attribute_col].values,
+            self.transform,
+            self.width,
+            self.height,
+            self.output_path,
+            crs=self.crs,
+            dtype=self.dtype,
+            fill=self.fill,
+            all_touched=self.all_touched,
+            merge_alg=self.merge_alg,
+            block_size=block_size,
+            workers=workers,
+            compress=compress,
+            tags={'legend': json.dumps(self.category_mapping)},
+            cog=cog,
+            )
+        print(f"Raster {self.file} saved (tiled) with CRS: {self.crs}")
+
+
+    def save_raster_file(self, output_path=None, cog=True, compress="deflate", resampling="mode"):
+        """
+        cog: Cloud-Optimized GeoTIFF (512 px tiles, compressed, internal overviews
+        built with resampling) so open_raster_with_legend can read only the
+        blocks / overview level it needs. cog=False: plain GeoTIFF.
+        """
         if (self.rasterized is None):
             raise Exception(f"'.rasterize_vector()' method has not been run.")           
         if output_path is None:
             self.output_path = os.path.join(RASTER_DIR, f"{self.level_2}_{self.file}.tif")
         else:
             self.output_path = output_path
+        if cog:
+            write_cog(
+                self.rasterized, self.output_path, self.transform, self.crs,
+                tags={'legend': json.dumps(self.category_mapping)}, compress=compress, resampling=resampling,
+                )
+            print(f"Raster {self.file} saved (COG) with CRS: {self.crs}")
+            return
         # Save the raster to a GeoTIFF file
         with rasterio.open(
             self.output_path,
@@ -125,7 +278,19 @@ class ARCGIS_Rasterize:
         print(f"Raster {self.file} saved with CRS: {self.crs}")
 
 
-    def open_raster_with_legend(self, path=None):
+    def open_raster_with_legend(self, path=None, window=None, bbox=None, resolution=None, band=1, resampling="nearest"):
+        """
+        Reads the raster (or a part of it) into self.raster_data, its legend
+        tag into self.legend / self.categories / self.labels.
+        window: rasterio Window or (col_off, row_off, width, height).
+        bbox: (minx, miny, maxx, maxy) in the raster CRS, instead of window.
+        resolution: target pixel size (raster CRS units), the band is read
+                    decimated with resampling; on a COG GDAL serves it from the
+                    closest overview, so only the blocks needed are read.
+        self.raster_transform / self.raster_bounds describe what was read.
+        """
+        from rasterio.enums import Resampling
+        from rasterio.windows import Window, from_bounds as window_from_bounds
 
         if path is None:
             try:
@@ -133,8 +298,31 @@ class ARCGIS_Rasterize:
             except:
                 raise Exception("No path given and instance has no self.output_path attribute.")
         with rasterio.open(path) as src:
-            self.raster_data = src.rarcgis(1)
-            self.metadata = src.tags()
+            full = Window(0, 0, src.width, src.height)
+            if bbox is not None:
+                window = window_from_bounds(*bbox, transform=src.transform)
+            elif (window is not None) and not isinstance(window, Window):
+                window = Window(*window)
+            if window is None:
+                window = full
+            else:
+                window = window.round_offsets().round_lengths().intersection(full)
+
+            out_shape = None
+            if resolution is not None:
+                x_res, y_res = src.res
+                out_shape = (
+                    max(1, int(round(window.height * y_res / resolution))),
+                    max(1, int(round(window.width * x_res / resolution))),
+                    )
+                if (out_shape[0] >= window.height) and (out_shape[1] >= window.width):
+                    out_shape = None # Never upsampled.
+            self.raster_data = src.read(band, window=window, out_shape=out_shape, resampling=Resampling[resampling])
+            self.raster_transform = src.window_transform(window)
+            if out_shape is not None:
+                self.raster_transform = self.raster_transform * self.raster_transform.scale(window.width / out_shape[1], window.height / out_shape[0])
+            self.raster_bounds = src.window_bounds(window)
+            self.metadata = src.tags(band) if "legend" in src.tags(band) else src.tags()
             if "legend" in self.metadata:
                 # Parse the legend
                 self.legend = json.loads(self.metadata["legend"])
@@ -143,11 +331,33 @@ class ARCGIS_Rasterize:
                 self.labels = {v: k for k, v in self.legend.items()}
 
 
-    def plot_raster(self, legend=True):
-        
+    def display_data(self, max_pixels):
+        """
+        self.raster_data mode-downsampled by the smallest integer factor that
+        leaves at most max_pixels pixels (the array itself if it already fits).
+        """
+        if self.raster_data is None:
+            raise Exception(f"'.open_raster_with_legend()' method has not been run.")
+        height, width = self.raster_data.shape
+        factor = max(1, int(np.sqrt(height * width / max_pixels)))
+        while -(-height // factor) * -(-width // factor) > max_pixels:
+            factor += 1
+        if factor > 1:
+            print(f"Raster {self.raster_data.shape} downsampled (mode) by {factor} for display.")
+        return mode_downsample(self.raster_data, factor)
+
+
+    def plot_raster(self, legend=True, max_pixels=4_000_000):
+        """
+        max_pixels: the raster is mode-downsampled to at most this many pixels first.
+        """
+        import matplotlib.pyplot as plt
+        from matplotlib.colors import ListedColormap, BoundaryNorm
+
         if self.raster_data is None:
             raise Exception(f"'.open_raster_with_legend()' method has not been run.")  
 
+        raster_data = self.display_data(max_pixels)
         num_categories = len(self.categories)
         colors = generate_colors(num_categories)
         cmap = ListedColormap(colors[:len(self.categories)])  # Match number of categories
@@ -155,7 +365,7 @@ class ARCGIS_Rasterize:
 
         # Plot the raster
         plt.figure(figsize=(10, 8))
-        plt.imshow(self.raster_data, cmap=cmap, interpolation='nearest')
+        plt.imshow(raster_data, cmap=cmap, interpolation='nearest')
         plt.colorbar(label="Categories")
         plt.title("Rasterized Categories with Legend")
 
@@ -176,16 +386,21 @@ class ARCGIS_Rasterize:
         plt.show()
 
 
-    def plotly_raster(self, save=False, show=True):
+    def plotly_raster(self, save=False, show=True, max_pixels=250_000):
+        """
+        max_pixels: the raster is mode-downsampled to at most this many pixels
+        before building the figure. The HTML holds a value and a hover label per
+        pixel, so its size is bounded by max_pixels whatever the raster size.
+        """
+        import plotly.express as px
 
-        category_labels = {cat: self.labels[cat] for cat in self.categories}
+        raster_data = self.display_data(max_pixels)
         category_map = {cat: self.labels[cat] for cat in self.categories}
         color_scale = px.colors.qualitative.Set3
-        category_map = {cat: self.labels[cat] for cat in self.categories}
-        hover_text = np.vectorize(lambda val: category_map.get(val, "Unknown"))(self.raster_data)
+        hover_text = category_labels(raster_data, category_map)
 
         fig = px.imshow(
-            self.raster_data,
+            raster_data,
             color_continuous_scale=color_scale,
             title="Rasterized Categories"
         )
@@ -194,7 +409,7 @@ class ARCGIS_Rasterize:
             coloraxis_colorbar=dict(
                 title="Categories",
                 tickvals=self.categories,
-                ticktext=[category_labels[cat] for cat in self.categories]
+                ticktext=[category_map[cat] for cat in self.categories]
             )
         )
         # Hide the color bar (color axis)
@@ -225,4 +440,105 @@ class ARCGIS_Rasterize:
         
         if show == True:
             # Show the plot
-            fig.show()
\ No newline at end of file
+            fig.show()
+
+
+class ARCGIS_BatchRasterize:
+    '''
+    Many long_filenames rasterized onto one common grid (same CRS, transform
+    and shape), as a set of aligned rasters and optionally a multi-band stack.
+    Layers are burnt in parallel worker processes, the grid is computed once
+    (union of the layers bounds, or given) and shared by all of them.
+
+    layers: {long_file: (attribute_col, legend_col)}, or a list of long_filenames
+            all using attribute_col and legend_col.
+    grid: RasterGrid (e.g. RasterGrid.load(path) of a previous batch) to reuse, else
+          computed from the layers with pixel_size, crs and bounds (None: union of the layers).
+    '''
+    def __init__(self, layers, attribute_col=None, legend_col=None, pixel_size=0.01, crs="EPSG:4326", bounds=None, grid=None, workers=None):
+        if not isinstance(layers, dict):
+            if (attribute_col is None) or (legend_col is None):
+                raise Exception("Give attribute_col and legend_col, or layers as {long_file: (attribute_col, legend_col)}.")
+            layers = {long_file: (attribute_col, legend_col) for long_file in layers}
+        long_filenames, files = catalog()['long_filenames'], catalog()['files']
+        missing = [long_file for long_file in layers if long_file not in long_filenames]
+        if len(missing) > 0:
+            raise Exception(f"Files {missing} not found in the long_filenames.")
+        self.layers = layers
+        self.file_paths = {long_file: files[long_filenames.index(long_file)] for long_file in layers}
+        self.pixel_size = pixel_size
+        self.crs = crs
+        self.bounds = bounds
+        self.grid = grid
+        self.workers = multiprocessing.cpu_count() if workers is None else max(1, workers)
+        self.outputs = {}
+        self.legends = {}
+
+
+    def _executor(self):
+        return ProcessPoolExecutor(max_workers=min(self.workers, len(self.layers)), mp_context=multiprocessing.get_context("spawn"))
+
+
+    def compute_grid(self, executor=None):
+        """
+        Common grid of the batch, computed once (layer bounds read in the pool).
+        """
+        if self.grid is not None:
+            return self.grid
+        if self.bounds is None:
+            if executor is None:
+                with self._executor() as executor:
+                    return self.compute_grid(executor)
+            all_bounds = np.array(list(executor.map(layer_bounds, self.file_paths.values(), [self.crs] * len(self.layers))))
+            all_bounds = all_bounds[~np.isnan(all_bounds).any(axis=1)]
+            if len(all_bounds) == 0:
+                raise Exception("All the layers are empty, can't compute a grid.")
+            self.bounds = (all_bounds[:, 0].min(), all_bounds[:, 1].min(), all_bounds[:, 2].max(), all_bounds[:, 3].max())
+        self.grid = RasterGrid(self.bounds, self.pixel_size, self.crs)
+        print(f"Batch grid: {self.grid}")
+        return self.grid
+
+
+    def rasterize(self, output_dir=None, all_touched=True, fill_value=0, merge_alg=MergeAlg.replace, block_size=None, cog=True):
+        """
+        Every layer burnt onto the grid into output_dir/{long_file}.tif (aligned
+        rasters, COGs if cog), the grid saved next to them (grid.json) to reuse it.
+        block_size: burn each layer block by block (bounded memory, big grids).
+        Returns {long_file: raster path}.
+        """
+        output_dir = os.path.join(RASTER_DIR, "batch") if output_dir is None else output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        with self._executor() as executor:
+            grid = self.compute_grid(executor)
+            grid.save(os.path.join(output_dir, "grid.json"))
+            futures = {}
+            for long_file, (attribute_col, legend_col) in self.layers.items():
+                output_path = os.path.join(output_dir, f"{os.path.splitext(long_file)[0]}.tif")
+                futures[long_file] = executor.submit(
+                    rasterize_layer, self.file_paths[long_file], attribute_col, legend_col, grid.to_dict(),
+                    output_path, all_touched, fill_value, merge_alg, block_size, cog,
+                    )
+            for long_file, future in futures.items():
+                output_path, legend, _ = future.result()
+                self.outputs[long_file] = output_path
+                self.legends[long_file] = legend
+                print(f"Raster {long_file} saved on the batch grid.")
+        return self.outputs
+
+
+    def stack(self, output_path=None, block_size=1024, compress="deflate", cog=True):
+        """
+        The aligned rasters of .rasterize() as one multi-band GeoTIFF, a band per
+        layer (in the layers order) described with its long_file and tagged with its legend.
+        """
+        if len(self.outputs) == 0:
+            raise Exception(f"'.rasterize()' method has not been run.")
+        if output_path is None:
+            output_path = os.path.join(os.path.dirname(next(iter(self.outputs.values()))), "stack.tif")
+        names = list(self.outputs)
+        stack_rasters(
+            [self.outputs[name] for name in names], output_path,
+            names=names, legends=[self.legends[name] for name in names], block_size=block_size, compress=compress, cog=cog,
+            )
+        print(f"Stack of {len(names)} bands saved: {output_path}")
+        return output_path
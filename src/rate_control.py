@@ -0,0 +1,122 @@
+import re
+import time
+import random
+import threading
+import email.utils
+
+
+# Messages of ArcGIS errors (code 400 included) for queries the server gave up on,
+# too heavy a page: retried and shrunk, unlike the invalid queries.
+SERVER_TIMEOUT_MESSAGES = re.compile(r"unable to complete operation|timed? ?out|time limit|execution time", re.IGNORECASE)
+
+
+class ARCGIS_ServerError(Exception):
+    '''
+    Error page from the server (HTTP 429/5xx or an ArcGIS {"error": ...} body).
+    retry_after: seconds asked by the server (Retry-After header), if any.
+    '''
+    def __init__(self, message: str, status_code: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class ARCGIS_QueryError(Exception):
+    '''
+    Request rejected by the server (HTTP 4xx or an ArcGIS {"error": ...} body with
+    a 4xx code, e.g. 400 Invalid query): the same request, or a smaller page,
+    fails the same way, so it is never retried.
+    '''
+    retryable = False
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_client_error(status_code):
+    """
+    4xx codes that won't go away by retrying (408 timeouts and 429 throttling do).
+    """
+    return (status_code is not None) and (400 <= int(status_code) < 500) and (int(status_code) not in [408, 429])
+
+
+def is_rejected_query(error: dict):
+    """
+    ArcGIS {"error": ...} body of a query that fails the same way when retried:
+    a 4xx code, but not the timeouts answered with one ("Unable to complete operation"...).
+    """
+    if not is_client_error(error.get('code')):
+        return False
+    text = " ".join([str(error.get('message') or "")] + [str(detail) for detail in error.get('details') or []])
+    return SERVER_TIMEOUT_MESSAGES.search(text) is None
+
+
+def is_throttled(error):
+    """
+    The server asks to slow down (429, or 503 with a Retry-After): waiting helps, a smaller page doesn't.
+    """
+    status_code = getattr(error, 'status_code', None)
+    return (status_code == 429) or ((status_code == 503) and (getattr(error, 'retry_after', None) is not None))
+
+
+def retry_after_seconds(response):
+    """
+    Retry-After header (delta seconds or an HTTP date) -> seconds, None if absent.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0, retry_after: float = None):
+    """
+    Exponential backoff with full jitter. A Retry-After from the server wins.
+    """
+    if retry_after is not None:
+        return min(cap, retry_after)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptivePageSize:
+    '''
+    AIMD page size controller: halves the page size when a page times out or
+    comes back as an error, grows it again additively after successes, never
+    above the layer maxRecordCount.
+    '''
+    def __init__(self, max_size: int, min_size: int = 10, increase: int = None):
+        self.max_size = max(1, int(max_size))
+        self.min_size = max(1, min(int(min_size), self.max_size))
+        self.increase = increase if increase is not None else max(1, self.max_size // 10)
+        self.size = self.max_size
+        self._lock = threading.Lock()
+
+
+    def success(self):
+        with self._lock:
+            self.size = min(self.max_size, self.size + self.increase)
+            return self.size
+
+
+    def failure(self):
+        with self._lock:
+            self.size = max(self.min_size, self.size // 2)
+            return self.size
+
+
+    def cap(self, size: int):
+        """
+        The server returned less than asked (exceededTransferLimit): that's its real limit.
+        """
+        with self._lock:
+            self.max_size = max(self.min_size, min(self.max_size, int(size)))
+            self.size = min(self.size, self.max_size)
+            return self.size
@@ -0,0 +1,238 @@
+import os
+import re
+import json
+import time
+import gzip
+import hashlib
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .config import OUTPUTS_DIR
+
+
+CACHE_DIR = os.path.join(OUTPUTS_DIR, "http_cache")
+# Seconds an entry is served for, per endpoint type (None: never expires).
+DEFAULT_TTLS = {
+    'catalog': 24 * 3600, # services directory, folders, service pages
+    'metadata': 24 * 3600, # layer metadata (/MapServer/3, /MapServer/layers)
+    'query': 7 * 24 * 3600, # /query pages
+    'probe': 0, # /query counts, ObjectIDs and statistics: they tell incremental syncs what changed.
+                # Stored for offline replays, never served online by default.
+    }
+PROBE_PARAMS = ['returnCountOnly', 'returnIdsOnly', 'outStatistics']
+ERROR_BODY = re.compile(rb'^\s*\{\s*"error"\s*:') # ArcGIS {"error": ...} answers, whatever the spacing.
+KEPT_HEADERS = ['Content-Type', 'Retry-After', 'Last-Modified', 'ETag'] # The body is stored decoded, no Content-Encoding.
+
+
+class ARCGIS_CacheMiss(Exception):
+    '''
+    Offline mode and the response isn't cached. Not worth retrying.
+    '''
+    retryable = False
+
+
+def endpoint_type(url: str, params=None):
+    """
+    "probe" (count / ids / statistics queries), "query", "metadata" or "catalog"
+    from the path and parameters of a REST url.
+    """
+    parts = urlsplit(url)
+    path = parts.path.rstrip("/")
+    if path.endswith("/query"):
+        items = parse_qsl(parts.query) + (list(params.items()) if isinstance(params, dict) else list(params or []))
+        if any((key in PROBE_PARAMS) and (str(value).lower() not in ["false", ""]) for key, value in items):
+            return 'probe'
+        return 'query'
+    if re.search(r"/(MapServer|FeatureServer)/(\d+|layers)$", path):
+        return 'metadata'
+    return 'catalog'
+
+
+def cache_key(method: str, url: str, params=None):
+    """
+    sha256 of the method, the url without query string and the sorted query
+    parameters (the ones in the url and params together), so "?f=json" in the
+    url and params={'f': 'json'} are the same entry.
+    """
+    parts = urlsplit(url)
+    items = parse_qsl(parts.query, keep_blank_values=True)
+    if isinstance(params, dict):
+        items += [(key, value) for key, value in params.items() if value is not None]
+    elif params:
+        items += list(params)
+    normalized = sorted((str(key).lower(), str(value)) for key, value in items)
+    base = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+    return hashlib.sha256(json.dumps([method.upper(), base, normalized]).encode("utf-8")).hexdigest()
+
+
+class ARCGIS_ResponseCache:
+    '''
+    Content-addressed on-disk cache of GET responses (see cache_key), each entry
+    a gzip file with a json header line (status, headers, url, created) and the
+    body. Used by ARCGIS_Session, opt-in.
+
+    max_bytes: size cap of the compressed entries, least recently used ones are
+               evicted above it (an entry is "used" when stored or served).
+    ttls: {endpoint type: seconds} overriding DEFAULT_TTLS (catalog, metadata, query, probe).
+    offline: serve only from the cache (even expired entries), a miss raises
+             ARCGIS_CacheMiss instead of hitting the server.
+    Only 200 answers that are not ArcGIS {"error": ...} bodies are stored.
+    '''
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = 2 * 1024 ** 3, ttls: dict = None, offline: bool = False, compresslevel: int = 6):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.offline = offline
+        self.compresslevel = compresslevel
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+        self._entries = {} # key -> [size, last used]
+        self._size = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+
+    def _scan(self):
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith(".gz"):
+                    stat = entry.stat()
+                    self._entries[entry.name[:-3]] = [stat.st_size, stat.st_mtime]
+                    self._size += stat.st_size
+
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.gz")
+
+
+    def get(self, method: str, url: str, params=None):
+        """
+        Cached requests.Response (fresh for its endpoint type, or any in offline
+        mode), None on a miss. Raises ARCGIS_CacheMiss on an offline miss.
+        """
+        key = cache_key(method, url, params)
+        path = self._path(key)
+        header, body = None, None
+        if key in self._entries:
+            try:
+                with gzip.open(path, "rb") as f:
+                    header = json.loads(f.readline())
+                    body = f.read()
+            except (OSError, ValueError):
+                self._forget(key) # Removed or truncated behind our back.
+
+        ttl = self.ttls.get(endpoint_type(url, params))
+        fresh = (header is not None) and (self.offline or ttl is None or time.time() - header['created'] <= ttl)
+        if not fresh:
+            with self._lock:
+                self.stats['misses'] += 1
+            if self.offline:
+                raise ARCGIS_CacheMiss(f"Not in the response cache (offline): {url} {params or ''}")
+            return None
+
+        self._touch(key, path)
+        with self._lock:
+            self.stats['hits'] += 1
+        return self._response(header, body)
+
+
+    def put(self, method: str, url: str, params, response):
+
+        if response.status_code != 200:
+            return
+        body = response.content
+        if ERROR_BODY.match(body[:256]):
+            return # ArcGIS answers errors with HTTP 200, don't keep them.
+        key = cache_key(method, url, params)
+        path = self._path(key)
+        header = {
+            'status': response.status_code,
+            'url': response.url,
+            'headers': {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers},
+            'encoding': response.encoding,
+            'created': time.time(),
+            }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wb", compresslevel=self.compresslevel) as f:
+            f.write(json.dumps(header).encode("utf-8"))
+            f.write(b"\n")
+            f.write(body)
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            previous = self._entries.get(key)
+            self._size += size - (previous[0] if previous else 0)
+            self._entries[key] = [size, time.time()]
+            self.stats['stored'] += 1
+        self._evict()
+
+
+    def clear(self):
+
+        with self._lock:
+            keys = list(self._entries)
+        for key in keys:
+            self._forget(key)
+
+
+    def size(self):
+        return self._size
+
+
+    def _touch(self, key, path):
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._entries[key][1] = now
+        try:
+            os.utime(path, (now, now)) # LRU order survives restarts (rebuilt from mtimes).
+        except OSError:
+            pass
+
+
+    def _forget(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[0]
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+    def _evict(self):
+        """
+        Least recently used entries out until the cache is 90% of max_bytes.
+        """
+        if (self.max_bytes is None) or (self._size <= self.max_bytes):
+            return
+        with self._lock:
+            oldest = sorted(self._entries.items(), key=lambda x: x[1][1])
+        target = 0.9 * self.max_bytes
+        for key, (size, _) in oldest:
+            if self._size <= target:
+                break
+            self._forget(key)
+            with self._lock:
+                self.stats['evicted'] += 1
+
+
+    @staticmethod
+    def _response(header, body):
+
+        response = requests.Response()
+        response.status_code = header['status']
+        response._content = body
+        response.headers = CaseInsensitiveDict(header['headers'])
+        response.url = header['url']
+        response.encoding = header.get('encoding')
+        response.from_cache = True
+        return response
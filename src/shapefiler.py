@@ -2,10 +2,14 @@ import sys
 import os
 import shutil
 import re
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd 
 sys.path.insert(0,'\\'.join(sys.path[0].split('\\')[:-1]))
-from src.utils import shapefile_categories_mapping, categories_mapping
+from src.utils import shapefile_categories_mapping, categories_mapping, read_layer
 from src.config import SHAPEFILE_DIR, OUTPUTS_DIR
+from src.partitions import write_partitions, parallel_dissolve
 import json
 import geopandas as gpd
 
@@ -15,19 +19,230 @@ def extract_description(value):
     return match.group(1).strip() if match else value
 
 
-mapping = shapefile_categories_mapping()
-mapping['long_filenames'] = mapping['level_2'] + "_" + mapping['filename']
+CATALOG_NAMES = ['mapping', 'files', 'filenames', 'long_filenames', 'categories']
+_catalog = None
+
+
+def catalog(refresh=False):
+    """
+    {mapping, files, filenames, long_filenames, categories} of the downloaded
+    layers, built on first use (not at import). refresh: build it again.
+    """
+    global _catalog
+    if (_catalog is None) or refresh:
+        mapping = shapefile_categories_mapping()
+        mapping['long_filenames'] = mapping['level_2'] + "_" + mapping['filename']
+        _catalog = {
+            'mapping': mapping,
+            'files': mapping['file_path'].unique().tolist(),
+            'filenames': mapping['filename'].unique().tolist(),
+            'long_filenames': mapping['long_filenames'].unique().tolist(),
+            'categories': mapping['level_2'].unique().tolist(),
+            }
+    return _catalog
+
+
+def __getattr__(name):
+    # shapefiler.mapping / categories / ... still work, lazily.
+    if name in CATALOG_NAMES:
+        return catalog()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# How every category (level_2) is exported to shapefiles, one rule per category:
+#   files:    layers ('file' of the mapping) exported, None: every layer of the category.
+#   legend:   renderer legend join from the layer metadata: field (codes) mapped to
+#             label (the renderer label) and description (extract_description of it).
+#   clean:    {column: [(old, new), ...]} string replacements.
+#   dissolve: column dissolved by, "all" for the whole layer, None: no dissolve.
+#   columns:  columns kept before writing, None: all.
+#   split:    one shapefile per value of this column (filename(value).shp), None: {file}.shp.
+# Output: SHAPEFILE_DIR/{level_2}/{file}/
+EXPORT_RULES = {
+    'Bordes2020': {
+        'files': ['pe.gis.vecinospaises_pe_wgs'],
+        'split': 'name',
+        'filename': str.strip,
+        },
+    'ProtegidaArea': {
+        'dissolve': 'all',
+        'columns': ['geometry'],
+        },
+    'AguaSubterranea': {
+        'legend': {'field': 'ruleid', 'label': 'legend', 'description': 'name'},
+        'dissolve': 'legend',
+        'split': 'name',
+        },
+    'RecursosMineros': {
+        'dissolve': 'category',
+        'split': 'category',
+        },
+    'RecursosAgricultura': {
+        'files': ['area'],
+        'clean': {'tipo': [("/", "_"), (" -", "")]},
+        'dissolve': 'tipo',
+        'split': 'tipo',
+        },
+    'MapaHabitat': {
+        'files': ['terrestre_habitat'],
+        'clean': {'tipo': [(",", ""), ("(", ""), (")", "")]},
+        'dissolve': 'tipo',
+        'split': 'tipo',
+        },
+    }
+
+
+class SourceCache:
+    '''
+    Layers and layer metadata loaded once and shared by the export jobs
+    (thread safe). Copies are handed out, the jobs modify their frames.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._layers = {}
+        self._metadata = {}
+        self.loads = 0
 
-files = mapping['file_path'].unique().tolist()
-filenames = mapping['filename'].unique().tolist()
-long_filenames = mapping['long_filenames'].unique().tolist()
-categories = mapping['level_2'].unique().tolist()
+
+    def layer(self, file_path):
+        with self._lock:
+            if file_path not in self._layers:
+                gdf = read_layer(file_path)
+                gdf.columns = gdf.columns.str.replace("attributes.", "")
+                self._layers[file_path] = gdf
+                self.loads += 1
+            return self._layers[file_path].copy()
+
+
+    def release(self, file_path):
+        with self._lock:
+            self._layers.pop(file_path, None)
+
+
+    def metadata(self, row):
+        path = os.path.join(OUTPUTS_DIR, row['level_1'], row['level_2'], row['level_3'], f"{row['file']}_metadata.json")
+        with self._lock:
+            if path not in self._metadata:
+                with open(path) as koko:
+                    self._metadata[path] = json.load(koko)
+            return self._metadata[path]
+
+
+def renderer_legend(metadata):
+    """
+    {value: label} of the uniqueValue renderer of a layer metadata.
+    """
+    legend = pd.json_normalize(metadata['drawingInfo']['renderer']['uniqueValueInfos'])[['value', 'label']]
+    return dict(legend.astype({"value": 'int'}).values)
+
+
+def export_layer(gdf, rule, row, cache, output_dir=SHAPEFILE_DIR, workers=1):
+    """
+    Applies a rule to the layer of a mapping row, writes its shapefiles.
+    Returns the written paths.
+    """
+    if rule.get('legend') is not None:
+        join = rule['legend']
+        legend = renderer_legend(cache.metadata(row))
+        gdf[join['label']] = gdf[join['field']].map(legend)
+        if join.get('description') is not None:
+            gdf[join['description']] = gdf[join['field']].map({key: extract_description(value) for key, value in legend.items()})
+    for column, replacements in (rule.get('clean') or {}).items():
+        for old, new in replacements:
+            gdf[column] = gdf[column].str.replace(old, new, regex=False)
+    if rule.get('dissolve') == 'all':
+        gdf = parallel_dissolve(gdf, workers=workers)
+    elif rule.get('dissolve') is not None:
+        gdf = parallel_dissolve(gdf, by=rule['dissolve'], workers=workers)
+    if rule.get('columns') is not None:
+        gdf = gdf[rule['columns']]
+
+    layer_dir = os.path.join(output_dir, row['level_2'], row['file'])
+    os.makedirs(layer_dir, exist_ok=True)
+    if rule.get('split') is not None:
+        return write_partitions(gdf, rule['split'], layer_dir, filename=rule.get('filename'), workers=workers)
+    path = os.path.join(layer_dir, f"{row['file']}.shp")
+    gdf.to_file(path, driver="ESRI Shapefile")
+    return [path]
+
+
+def export_source(file_path, jobs, output_dir=SHAPEFILE_DIR, cache=None, workers=1):
+    """
+    Runs in the pool: every (rule, mapping row) job reading file_path, the
+    layer loaded once. Returns [(level_2, file, paths or error message)].
+    """
+    cache = SourceCache() if cache is None else cache
+    results = []
+    for rule, row in jobs:
+        try:
+            results.append((row['level_2'], row['file'], export_layer(cache.layer(file_path), rule, row, cache, output_dir, workers)))
+        except Exception as e:
+            results.append((row['level_2'], row['file'], f"{type(e).__name__}: {e}"))
+    cache.release(file_path) # Every job of the source is done, memory back.
+    return results
+
+
+class ARCGIS_ShapefileExporter:
+    '''
+    Exports the categories of the catalog to shapefiles following EXPORT_RULES,
+    all of them in one run. Jobs are grouped by source file (each layer is read
+    once, through a SourceCache) and the sources exported in a pool of workers
+    processes (workers=1: in this process, one cache shared by every job).
+    '''
+    def __init__(self, rules=None, workers=None, output_dir=SHAPEFILE_DIR):
+        self.rules = EXPORT_RULES if rules is None else rules
+        self.workers = multiprocessing.cpu_count() if workers is None else max(1, workers)
+        self.output_dir = output_dir
+        self.cache = SourceCache()
+        self.outputs = {}
+        self.failed = {}
+
+
+    def jobs(self, categories=None):
+        """
+        {file_path: [(rule, mapping row)]} of the categories (None: every category with a rule).
+        """
+        mapping = catalog()['mapping']
+        categories = list(self.rules) if categories is None else categories
+        unknown = [x for x in categories if x not in self.rules]
+        if len(unknown) > 0:
+            raise Exception(f"No export rule for {unknown}, rules: {list(self.rules)}")
+        jobs = {}
+        for level_2 in categories:
+            rule = self.rules[level_2]
+            rows = mapping[mapping['level_2'] == level_2]
+            if rule.get('files') is not None:
+                rows = rows[rows['file'].isin(rule['files'])]
+            for row in rows.to_dict("records"):
+                jobs.setdefault(row['file_path'], []).append((rule, row))
+        return jobs
+
+
+    def run(self, categories=None):
+
+        jobs = self.jobs(categories)
+        print(f"Exporting {sum(map(len, jobs.values()))} layers from {len(jobs)} source files.")
+        if (self.workers == 1) or (len(jobs) <= 1):
+            results = [export_source(file_path, source_jobs, self.output_dir, self.cache, self.workers) for file_path, source_jobs in jobs.items()]
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)), mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [executor.submit(export_source, file_path, source_jobs, self.output_dir) for file_path, source_jobs in jobs.items()]
+                results = [future.result() for future in futures]
+
+        for level_2, file, paths in [x for result in results for x in result]:
+            if isinstance(paths, str):
+                self.failed[(level_2, file)] = paths
+                print(f"Export of {level_2}/{file} failed: {paths}")
+            else:
+                self.outputs[(level_2, file)] = paths
+                print(f"Exported {level_2}/{file}: {len(paths)} shapefiles.")
+        return self.outputs
 
 
 class ARCGIS_Shapefiler:
     def __init__(self):
         self.file = None
-        self.files_list = filenames
+        self.files_list = catalog()['filenames']
         self.gdf = None
         self.rasterized = None
         self.raster_data = None
@@ -41,150 +256,23 @@ class ARCGIS_Shapefiler:
         """
         self.level_2 = level_2
 
-        if level_2 not in categories:
+        if level_2 not in catalog()['categories']:
             raise Exception(f"File '{level_2}' not found in the categories.")
 
         if self.level_2 not in os.listdir(SHAPEFILE_DIR):
             os.mkdir(os.path.join(SHAPEFILE_DIR,f"{self.level_2}"))
 
 
-    def shapefiling(self):
-
+    def shapefiling(self, workers=1):
+        """
+        Exports the selected category following its rule in EXPORT_RULES.
+        Raises if any of its layers failed (after exporting the others).
+        """
         if self.level_2 is None:
             raise Exception("method .select_arcgis_item() needs to be run first.")
-
-        if self.level_2 == 'Bordes2020':
-            
-            name = 'pe.gis.vecinospaises_pe_wgs'
-            if name not in os.listdir(os.path.join(SHAPEFILE_DIR, self.level_2)):
-                os.mkdir(os.path.join(SHAPEFILE_DIR, self.level_2,f"{name}"))
-
-            metadata = mapping[(mapping['level_2'] == self.level_2) & (mapping['file'] == name)].reset_index(drop=True)
-
-            gdf = gpd.rarcgis_file(metadata.loc[0,'file_path'])
-            gdf.columns = gdf.columns.str.replace("attributes.", "")
-            for loc in gdf['name'].unique():
-                gdf[gdf['name'] == loc].to_file(os.path.join(SHAPEFILE_DIR, self.level_2, name, f"{loc.strip()}.shp"), driver="ESRI Shapefile")
-
-
-
-
-        if self.level_2 == 'ProtegidaArea':
-
-            metadata = mapping[(mapping['level_2'] == self.level_2)].reset_index(drop=True)
-
-            for num, row in metadata.iterrows():
-                if row['file'] not in os.listdir(os.path.join(SHAPEFILE_DIR, self.level_2)):
-                    os.mkdir(os.path.join(SHAPEFILE_DIR, self.level_2,f"{row['file']}"))
-                
-                gdf = gpd.rarcgis_file(row['file_path'])
-                gdf.columns = gdf.columns.str.replace("attributes.", "")
-                gdf.dissolve()[['geometry']].to_file(os.path.join(SHAPEFILE_DIR, self.level_2, row['file'], f"{row['file']}.shp"), driver="ESRI Shapefile")
-
-
-
-
-        if self.level_2 == 'AguaSubterranea':
-
-            metadata = mapping[(mapping['level_2'] == self.level_2)].reset_index(drop=True)
-
-            for num, row in metadata.iterrows():
-                if row['file'] not in os.listdir(os.path.join(SHAPEFILE_DIR, self.level_2)):
-                    os.mkdir(os.path.join(SHAPEFILE_DIR, self.level_2,f"{row['file']}"))
-
-                with open(os.path.join(OUTPUTS_DIR, row['level_1'], row['level_2'], row['level_3'], f"{row['file']}_metadata.json")) as koko:
-                    metadata = json.load(koko)
-                    legend = pd.json_normalize(metadata['drawingInfo']['renderer']['uniqueValueInfos'])[['value', 'label']]
-                    legend = dict(legend.astype({"value": 'int'}).values)
-                    descriptions = {key: extract_description(value) for key, value in legend.items()}
-
-                gdf = gpd.rarcgis_file(row['file_path'])
-                gdf.columns = gdf.columns.str.replace("attributes.", "")
-                gdf['legend'] = gdf['ruleid'].map(legend)
-                gdf['name'] = gdf['ruleid'].map(descriptions)
-                gdf = gdf.dissolve(by='legend').reset_index()
-
-                for num, row2 in gdf.iterrows():
-                    gdf[gdf['name'] == row2['name']].to_file(os.path.join(SHAPEFILE_DIR, self.level_2, row['file'], f"{row2['name']}.shp"), driver="ESRI Shapefile")
-
-
-
-
-        if self.level_2 == 'RecursosMineros':
-
-            metadata = mapping[(mapping['level_2'] == self.level_2)].reset_index(drop=True)
-
-            for num, row in metadata.iterrows():
-                if row['file'] not in os.listdir(os.path.join(SHAPEFILE_DIR, self.level_2)):
-                    os.mkdir(os.path.join(SHAPEFILE_DIR, self.level_2,f"{row['file']}"))
-
-                with open(os.path.join(OUTPUTS_DIR, row['level_1'], row['level_2'], row['level_3'], f"{row['file']}_metadata.json")) as koko:
-                    metadata = json.load(koko)
-                    try:
-                        legend = pd.json_normalize(metadata['drawingInfo']['renderer']['uniqueValueInfos'])[['value', 'label']]
-                        legend = dict(legend.astype({"value": 'int'}).values)
-                    except:
-                        pass
-
-                    gdf = gpd.rarcgis_file(row['file_path'])
-                    gdf.columns = gdf.columns.str.replace("attributes.", "")
-                    gdf = gdf.dissolve(by='category').reset_index()
-
-                    for num, row2 in gdf.iterrows():
-                        gdf[gdf['category'] == row2['category']].to_file(os.path.join(SHAPEFILE_DIR, self.level_2, row['file'], f"{row2['category']}.shp"), driver="ESRI Shapefile")
-
-
-
-
-        if self.level_2 == 'RecursosAgricultura':
-
-            metadata = mapping[(mapping['level_2'] == self.level_2)].reset_index(drop=True)
-
-            for num, row in metadata.iterrows():
-                if row['file'] not in os.listdir(os.path.join(SHAPEFILE_DIR, self.level_2)):
-                    os.mkdir(os.path.join(SHAPEFILE_DIR, self.level_2,f"{row['file']}"))
-
-                with open(os.path.join(OUTPUTS_DIR, row['level_1'], row['level_2'], row['level_3'], f"{row['file']}_metadata.json")) as koko:
-                    metadata = json.load(koko)
-                    try:
-                        legend = pd.json_normalize(metadata['drawingInfo']['renderer']['uniqueValueInfos'])[['value', 'label']]
-                        legend = dict(legend.astype({"value": 'int'}).values)
-                    except:
-                        pass
-
-                if row['long_filenames'] in ['RecursosAgricultura_area.geojson']:
-                    gdf = gpd.rarcgis_file(row['file_path'])
-                    gdf.columns = gdf.columns.str.replace("attributes.", "")
-                    gdf['tipo'] = gdf['tipo'].str.replace("/","_").str.replace(" -","")
-                    gdf = gdf.dissolve(by='tipo').reset_index()
-
-                    for num, row2 in gdf.iterrows():
-                        gdf[gdf['tipo'] == row2['tipo']].to_file(os.path.join(SHAPEFILE_DIR, self.level_2, row['file'], f"{row2['tipo']}.shp"), driver="ESRI Shapefile")
-
-
-
-
-        if self.level_2 == 'MapaHabitat':
-
-            metadata = mapping[(mapping['level_2'] == self.level_2)].reset_index(drop=True)
-
-            for num, row in metadata.iterrows():
-                if row['file'] not in os.listdir(os.path.join(SHAPEFILE_DIR, self.level_2)):
-                    os.mkdir(os.path.join(SHAPEFILE_DIR, self.level_2,f"{row['file']}"))
-
-                with open(os.path.join(OUTPUTS_DIR, row['level_1'], row['level_2'], row['level_3'], f"{row['file']}_metadata.json")) as koko:
-                    metadata = json.load(koko)
-                    try:
-                        legend = pd.json_normalize(metadata['drawingInfo']['renderer']['uniqueValueInfos'])[['value', 'label']]
-                        legend = dict(legend.astype({"value": 'int'}).values)
-                    except:
-                        pass
-
-                if row['long_filenames'] in ['MapaHabitat_terrestre_habitat.geojson']:
-                    gdf = gpd.rarcgis_file(row['file_path'])
-                    gdf.columns = gdf.columns.str.replace("attributes.", "")
-                    gdf['tipo'] = gdf['tipo'].str.replace(",","").str.replace("(","").str.replace(")","")
-                    gdf = gdf.dissolve(by='tipo').reset_index()
-
-                    for num, row2 in gdf.iterrows():
-                        gdf[gdf['tipo'] == row2['tipo']].to_file(os.path.join(SHAPEFILE_DIR, self.level_2, row['file'], f"{row2['tipo']}.shp"), driver="ESRI Shapefile")
+        exporter = ARCGIS_ShapefileExporter(workers=workers)
+        exporter.run([self.level_2])
+        if len(exporter.failed) > 0:
+            failed = "; ".join(f"{file}: {error}" for (_, file), error in exporter.failed.items())
+            raise Exception(f"Export of {len(exporter.failed)} layers of '{self.level_2}' failed: {failed}")
+        return exporter.outputs
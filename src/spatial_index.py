@@ -0,0 +1,371 @@
+'''
+Persistent spatial index over the downloaded layers, and a cross-layer query
+API: "which features of any layer intersect this bbox / point".
+
+- Per layer: the bounds of every feature (plus the byte offsets of the lines
+  for GeoJSONSeq files) saved in an .npz next to the index, from which an
+  STRtree is bulk loaded on first use (and kept in memory).
+- Global: layers.json with the extent, feature count and file signature
+  (mtime, size) of every indexed layer, a query first keeps the layers whose
+  extent it touches.
+
+A query then opens only the candidate layers and reads only the candidate
+features: parquet row groups holding them, or the lines at their offsets for
+GeoJSONSeq. GeoJSON files can't be read partially, they are indexed through a
+GeoParquet sidecar written next to the index (rewritten when the file changes).
+Built after a download by ARCGIS_Client (spatial_index=...), or for a whole
+outputs tree with index_outputs().
+'''
+import os
+import json
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pyproj import CRS
+
+from .config import OUTPUTS_DIR
+from .utils import categories_mapping, read_layer, INDEX_DIR
+from .writers import write_geoparquet
+from .logger_config import setup_logger
+
+
+logger = setup_logger()
+
+SPATIAL_INDEX_DIR = os.path.join(OUTPUTS_DIR, INDEX_DIR, "spatial")
+INDEXED_EXTENSIONS = ['.parquet', '.geojsonl', '.geojson'] # Preference order when a layer has several (geojson needs a sidecar).
+WGS84 = CRS.from_epsg(4326)
+SIDECAR_ROW_GROUP_SIZE = 2000
+INDEX_VERSION = 2 # Entries of other versions (GDAL fids) are indexed again.
+
+
+@functools.lru_cache(maxsize=None)
+def parse_crs(crs_json: str):
+    """
+    pyproj CRS of a GeoParquet crs (PROJJSON), parsed once: parsing costs more
+    than reading a few features.
+    """
+    crs = json.loads(crs_json)
+    return CRS.from_user_input(crs if crs is not None else "OGC:CRS84")
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def feature_bounds(path, chunk_size: int = 50000):
+    """
+    (bounds N x 4, offsets or None) of the features of a layer, in file order.
+    Parquet: from the bbox covering column when there is one (no geometry
+    decoding), rows are addressed by position. GeoJSONSeq: scanned line by
+    line (chunk_size lines parsed at once), offsets are the N + 1 byte
+    positions where the feature lines start (and the last one ends).
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        if 'bbox' in pq.read_schema(path).names:
+            bbox = pq.read_table(path, columns=['bbox']).column('bbox').combine_chunks()
+            bounds = np.column_stack([bbox.field(name).to_numpy(zero_copy_only=False) for name in ['xmin', 'ymin', 'xmax', 'ymax']])
+            return bounds.astype(float), None
+        return shapely.bounds(read_layer(path, columns=[]).geometry.values), None
+
+    if not path.endswith(".geojsonl"):
+        raise Exception(f"{path}: only parquet and geojsonl files are indexed directly (geojson through a sidecar).")
+
+    bounds, starts, lines = [], [], []
+    position = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip(b"\x1e \t\r\n"):
+                starts.append(position)
+                lines.append(line)
+            position += len(line)
+            if len(lines) >= chunk_size:
+                bounds.append(shapely.bounds(shapely.from_geojson(lines, on_invalid="ignore")))
+                lines = []
+    if lines:
+        bounds.append(shapely.bounds(shapely.from_geojson(lines, on_invalid="ignore")))
+    bounds = np.concatenate(bounds) if bounds else np.empty((0, 4))
+    return bounds, np.array(starts + [position], dtype=np.int64)
+
+
+def read_geojsonseq(path, rows, offsets, columns=None):
+    """
+    Features at rows of a GeoJSONSeq file, every line read at its offset (see feature_bounds).
+    """
+    lines = []
+    with open(path, "rb") as f:
+        for row in rows:
+            f.seek(offsets[row])
+            lines.append(f.read(offsets[row + 1] - offsets[row]))
+    properties = pd.DataFrame([json.loads(line.strip(b"\x1e \t\r\n")).get('properties') or {} for line in lines])
+    if columns is not None:
+        properties = properties.reindex(columns=list(columns))
+    geometry = shapely.from_geojson(lines, on_invalid="ignore") if lines else []
+    return gpd.GeoDataFrame(properties, geometry=geometry, crs=WGS84) # GeoJSON is always WGS84.
+
+
+def read_features(path, rows, offsets=None, columns=None):
+    """
+    Only the features at rows (positions in the file) of a layer.
+    Parquet: the row groups holding them are read, then the rows taken.
+    GeoJSONSeq: their lines read at the byte offsets of the index.
+    """
+    rows = np.sort(np.asarray(rows, dtype=np.int64))
+    if path.endswith(".geojsonl"):
+        return read_geojsonseq(path, rows, offsets, columns)
+
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(path)
+    geo = json.loads(parquet.schema_arrow.metadata[b'geo'])
+    geometry = geo['primary_column']
+    if geo['columns'][geometry].get('encoding', 'WKB').upper() != 'WKB':
+        return read_layer(path, columns=columns).iloc[rows].reset_index(drop=True)
+
+    sizes = [parquet.metadata.row_group(i).num_rows for i in range(parquet.metadata.num_row_groups)]
+    starts = np.r_[0, np.cumsum(sizes)]
+    group_of = np.searchsorted(starts, rows, side="right") - 1
+    groups = np.unique(group_of)
+    # Position of every row inside the concatenation of the row groups read.
+    read_starts = np.r_[0, np.cumsum([sizes[g] for g in groups])]
+    local = rows - starts[group_of] + read_starts[np.searchsorted(groups, group_of)]
+
+    if columns is not None:
+        columns = [col for col in columns if col != geometry] + [geometry]
+    table = parquet.read_row_groups(groups.tolist(), columns=columns).take(local)
+    df = table.drop_columns([col for col in ['bbox'] if col in table.column_names]).to_pandas()
+    crs = parse_crs(json.dumps(geo['columns'][geometry].get('crs', "OGC:CRS84"), sort_keys=True))
+    return gpd.GeoDataFrame(df.drop(columns=geometry), geometry=shapely.from_wkb(df[geometry].values), crs=crs)
+
+
+class ARCGIS_SpatialIndex:
+    '''
+    Persistent per-layer + global spatial index of the downloaded layers (see
+    the module docstring). Layers are keyed by their path relative to outputs_dir.
+
+        index = ARCGIS_SpatialIndex()
+        index.index_outputs()
+        index.query_point(-77.03, -12.05)
+        index.query_bbox(-77.1, -12.1, -76.9, -11.9, columns=['attributes.nombre'])
+    '''
+    def __init__(self, index_dir: str = SPATIAL_INDEX_DIR, outputs_dir: str = OUTPUTS_DIR):
+        self.index_dir = index_dir
+        self.outputs_dir = outputs_dir
+        self.layers_path = os.path.join(index_dir, "layers.json")
+        self._lock = threading.Lock()
+        self._trees = {} # layer -> (signature, STRtree, offsets)
+        self._extents = None
+        os.makedirs(index_dir, exist_ok=True)
+        try:
+            with open(self.layers_path) as f:
+                self.layers = json.load(f)
+        except (OSError, ValueError):
+            self.layers = {}
+
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.outputs_dir)).replace(os.sep, "/")
+
+
+    def _path(self, layer):
+        return os.path.join(self.outputs_dir, *layer.split("/"))
+
+
+    def _npz(self, layer):
+        return os.path.join(self.index_dir, f"{hashlib.sha1(layer.encode('utf-8')).hexdigest()[:20]}.npz")
+
+
+    def _sidecar(self, layer):
+        return os.path.join(self.index_dir, f"{hashlib.sha1(layer.encode('utf-8')).hexdigest()[:20]}.parquet")
+
+
+    def _source(self, layer):
+        """
+        File the features of a layer are read from: the layer itself, or its GeoParquet sidecar (geojson).
+        """
+        return self._sidecar(layer) if layer.endswith(".geojson") else self._path(layer)
+
+
+    def _write_sidecar(self, path, layer):
+
+        tmp_path = f"{self._sidecar(layer)}.{threading.get_ident()}.tmp"
+        gdf = read_layer(path)
+        # Hilbert ordered, small row groups: the candidates of a query sit in a few of them.
+        valid = (gdf.geometry.notna() & ~gdf.geometry.is_empty).to_numpy()
+        if valid.any():
+            hilbert = gdf.geometry[valid].hilbert_distance().to_numpy()
+            gdf = gdf.iloc[np.r_[np.flatnonzero(valid)[np.argsort(hilbert, kind="stable")], np.flatnonzero(~valid)]]
+        write_geoparquet(gdf, tmp_path, row_group_size=SIDECAR_ROW_GROUP_SIZE)
+        os.replace(tmp_path, self._sidecar(layer))
+
+
+    def save(self):
+
+        with self._lock:
+            tmp_path = f"{self.layers_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.layers, f)
+            os.replace(tmp_path, self.layers_path)
+
+
+    def index_layer(self, path: str, force: bool = False, save: bool = True):
+        """
+        (Re)indexes a layer file, skipped when its signature didn't change.
+        GeoJSON files are converted to a GeoParquet sidecar first, which is
+        what gets indexed and read. Returns its entry in self.layers.
+        """
+        layer = self._key(path)
+        signature = file_signature(path)
+        entry = self.layers.get(layer)
+        if (entry is not None) and (entry['signature'] == signature) and (entry.get('version') == INDEX_VERSION) \
+            and os.path.exists(self._npz(layer)) and os.path.exists(self._source(layer)) and not force:
+            return entry
+
+        if path.endswith(".geojson"):
+            self._write_sidecar(path, layer)
+        bounds, offsets = feature_bounds(self._source(layer))
+        valid = ~np.isnan(bounds).any(axis=1)
+        arrays = {'bounds': bounds}
+        if offsets is not None:
+            arrays['offsets'] = offsets
+        tmp_path = f"{self._npz(layer)}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self._npz(layer))
+
+        extent = [float(bounds[valid, 0].min()), float(bounds[valid, 1].min()), float(bounds[valid, 2].max()), float(bounds[valid, 3].max())] if valid.any() else None
+        entry = {'signature': signature, 'count': int(len(bounds)), 'extent': extent, 'version': INDEX_VERSION}
+        with self._lock:
+            self.layers[layer] = entry
+            self._trees.pop(layer, None)
+            self._extents = None
+        if save:
+            self.save()
+        return entry
+
+
+    def index_job(self, paths):
+        """
+        After a download (ARCGIS_Client): indexes the first indexable of the
+        output paths of a layer (parquet first).
+        """
+        paths = [x for x in paths if os.path.splitext(x)[1] in INDEXED_EXTENSIONS and os.path.exists(x)]
+        if len(paths) == 0:
+            return None
+        paths = sorted(paths, key=lambda x: INDEXED_EXTENSIONS.index(os.path.splitext(x)[1]))
+        return self.index_layer(paths[0])
+
+
+    def index_outputs(self, workers: int = 8, force: bool = False):
+        """
+        Indexes every layer of the outputs tree (one file per layer, parquet
+        first) and drops the entries of layers that no longer exist.
+        """
+        mapping = categories_mapping(self.outputs_dir)
+        mapping['order'] = mapping['filename'].map(lambda x: INDEXED_EXTENSIONS.index(os.path.splitext(x)[1]))
+        mapping = mapping.sort_values('order').drop_duplicates(['level_1', 'level_2', 'level_3', 'file'])
+        paths = mapping['file_path'].tolist()
+
+        failed = {}
+        def index(path):
+            try:
+                self.index_layer(path, force=force, save=False)
+            except Exception as e:
+                failed[path] = e
+                logger.error(f"Error indexing layer {path}: {e}")
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(index, paths))
+        keep = {self._key(path) for path in paths}
+        with self._lock:
+            for layer in [x for x in self.layers if x not in keep]:
+                self.layers.pop(layer)
+                self._trees.pop(layer, None)
+                for path in [self._npz(layer), self._sidecar(layer)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._extents = None
+        self.save()
+        print(f"Spatial index: {len(self.layers)} layers, {len(failed)} failed.")
+        return failed
+
+
+    def candidate_layers(self, bounds):
+        """
+        Layers whose extent intersects bounds (minx, miny, maxx, maxy).
+        """
+        with self._lock:
+            if self._extents is None:
+                names = [layer for layer, entry in self.layers.items() if entry['extent'] is not None]
+                extents = np.array([self.layers[layer]['extent'] for layer in names], dtype=float).reshape(-1, 4)
+                self._extents = (names, extents)
+            names, extents = self._extents
+        minx, miny, maxx, maxy = bounds
+        hit = (extents[:, 0] <= maxx) & (extents[:, 2] >= minx) & (extents[:, 1] <= maxy) & (extents[:, 3] >= miny)
+        return [names[i] for i in np.flatnonzero(hit)]
+
+
+    def _tree(self, layer):
+        """
+        (STRtree over the feature bounds, line offsets or None) of a layer,
+        reindexed first if the file changed since it was indexed.
+        """
+        path = self._path(layer)
+        signature = file_signature(path)
+        cached = self._trees.get(layer)
+        if (cached is not None) and (cached[0] == signature):
+            return cached[1], cached[2]
+        if (self.layers[layer]['signature'] != signature) or (self.layers[layer].get('version') != INDEX_VERSION):
+            print(f"Layer {layer} changed since it was indexed, indexing it again.")
+            self.index_layer(path)
+        with np.load(self._npz(layer)) as data:
+            bounds = data['bounds']
+            offsets = data['offsets'] if 'offsets' in data else None
+        boxes = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+        boxes[np.isnan(bounds).any(axis=1)] = None # Features without geometry.
+        tree = shapely.STRtree(boxes)
+        with self._lock:
+            self._trees[layer] = (signature, tree, offsets)
+        return tree, offsets
+
+
+    def query(self, geometry, layers=None, predicate: str = "intersects", columns=None):
+        """
+        Features of every indexed layer (or of layers) for which
+        predicate(feature geometry, geometry) holds (shapely predicate name),
+        as one GeoDataFrame with a 'layer' column (EPSG:4326 outputs).
+        columns: attributes to read (None: all, [] only the geometry).
+        """
+        candidates = self.candidate_layers(shapely.bounds(geometry))
+        if layers is not None:
+            candidates = [layer for layer in candidates if layer in set(layers)]
+        frames = []
+        for layer in candidates:
+            tree, offsets = self._tree(layer)
+            rows = tree.query(geometry) # Bounding boxes that touch the query geometry.
+            if len(rows) == 0:
+                continue
+            gdf = read_features(self._source(layer), rows, offsets, columns)
+            gdf = gdf[getattr(shapely, predicate)(gdf.geometry.values, geometry)]
+            if len(gdf) > 0:
+                frames.append(gdf.assign(layer=layer))
+        if len(frames) == 0:
+            return gpd.GeoDataFrame({'layer': []}, geometry=[], crs=WGS84)
+        frames = [gdf.to_crs(WGS84) if (gdf.crs is not None) and not gdf.crs.equals(WGS84, ignore_axis_order=True) else gdf.set_crs(WGS84, allow_override=True) for gdf in frames]
+        out = pd.concat(frames, ignore_index=True)
+        return gpd.GeoDataFrame(out, geometry=frames[0].geometry.name, crs=WGS84)
+
+
+    def query_point(self, x: float, y: float, **kwargs):
+        return self.query(shapely.Point(x, y), **kwargs)
+
+
+    def query_bbox(self, minx: float, miny: float, maxx: float, maxy: float, **kwargs):
+        return self.query(shapely.box(minx, miny, maxx, maxy), **kwargs)
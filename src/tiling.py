@@ -0,0 +1,227 @@
+import json
+import queue
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from .logger_config import setup_logger
+
+logger = setup_logger()
+
+
+class Tile:
+    '''
+    Envelope of the layer extent (in the extent spatial reference) at a quadtree depth.
+    '''
+    def __init__(self, xmin, ymin, xmax, ymax, depth=0):
+        self.xmin, self.ymin, self.xmax, self.ymax = xmin, ymin, xmax, ymax
+        self.depth = depth
+
+
+    def split(self):
+        xmid = (self.xmin + self.xmax) / 2
+        ymid = (self.ymin + self.ymax) / 2
+        return [
+            Tile(self.xmin, self.ymin, xmid, ymid, self.depth + 1),
+            Tile(xmid, self.ymin, self.xmax, ymid, self.depth + 1),
+            Tile(self.xmin, ymid, xmid, self.ymax, self.depth + 1),
+            Tile(xmid, ymid, self.xmax, self.ymax, self.depth + 1),
+            ]
+
+
+    def query_params(self, wkid):
+        return {
+            'geometry': json.dumps({'xmin': self.xmin, 'ymin': self.ymin, 'xmax': self.xmax, 'ymax': self.ymax}),
+            'geometryType': "esriGeometryEnvelope",
+            'inSR': wkid,
+            'spatialRel': "esriSpatialRelIntersects",
+            }
+
+
+    def __repr__(self):
+        return f"Tile({self.xmin:.4f}, {self.ymin:.4f}, {self.xmax:.4f}, {self.ymax:.4f}, depth={self.depth})"
+
+
+class ARCGIS_TiledQuery:
+    '''
+    Downloads a layer as an adaptive quadtree of envelope queries over its extent
+    (from the layer metadata). A tile holding more features than one page is split
+    in four, down to max_depth (deeper tiles are paged by offset). Tiles are
+    counted and fetched concurrently, and features straddling tile borders are
+    deduplicated by ObjectID.
+
+    Tiles stream their pages to the consumer, at most queue_size pages wait in
+    between (the fetching threads block when it's full). Features the envelopes
+    can't reach (null geometries, outside a stale extent...) are caught by
+    comparing the result with the returnCountOnly of the layer, see iter_pages.
+    '''
+    def __init__(self, client, job, workers: int = 4, max_depth: int = 8, queue_size: int = None):
+        self.client = client
+        self.job = job
+        self.workers = max(1, workers)
+        self.max_depth = max_depth
+        self.queue_size = queue_size or 2 * self.workers
+        metadata = job.metadata or {}
+        if 'extent' not in metadata:
+            raise Exception(f"No extent in the metadata of {job.label}, it can't be tiled.")
+        extent = metadata['extent']
+        spatial_reference = extent.get('spatialReference') or {}
+        self.wkid = spatial_reference.get('latestWkid') or spatial_reference.get('wkid') or 4326
+        self.root = Tile(extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])
+        self.page_size = job.feature_params['resultRecordCount']
+        self.oid_field = client._object_id_field(metadata)
+        self.seen = set()
+        self.n_tiles = 0
+        self.n_features = 0
+        self._results = None
+        self._stop = None
+
+
+    def iter_pages(self):
+        """
+        Yields page dicts (deduplicated) as they arrive, tiles in no particular order.
+        Once every tile is done the features yielded are checked against the count
+        of the whole layer (same where, no envelope): when some are missing the
+        ObjectIDs not seen yet are fetched (needs the ObjectID field, see _missing_pages).
+        """
+        self._results = queue.Queue(maxsize=self.queue_size)
+        self._stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        running = 0
+
+        def submit(task, tile):
+            nonlocal running
+            running += 1
+            executor.submit(self._run, task, tile)
+
+        try:
+            submit(self._count_tile, self.root)
+            while running:
+                kind, tile, value = self._results.get()
+                if kind == 'page':
+                    yield self._deduplicate(value)
+                    continue
+                running -= 1
+                if kind == 'error':
+                    raise value
+                if kind == 'count':
+                    if value == 0:
+                        continue
+                    if (value is not None) and (value > self.page_size) and (tile.depth < self.max_depth):
+                        for child in tile.split():
+                            submit(self._count_tile, child)
+                    else:
+                        submit(self._fetch_tile, tile)
+                else:
+                    self.n_tiles += 1
+        finally:
+            self._stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: {self.n_tiles} tiles fetched, {self.n_features} unique features ({self.job.label})")
+        yield from self._missing_pages()
+
+
+    def _missing_pages(self):
+        """
+        The features the tiles missed, if the count says there are some: the
+        ObjectIDs of the layer (returnIdsOnly) not seen yet, fetched in
+        objectIds batches of a page.
+        """
+        total = self.client.get_feature_count(self.job.url, self.job.feature_params['where'], label=self.job.label)
+        if (total is None) or (self.n_features >= total):
+            return
+        object_ids = None
+        if self.oid_field is not None:
+            object_ids = self.client.get_object_ids(self.job.url, self.job.feature_params['where'], label=self.job.label)
+        if object_ids is None:
+            print(f"{self.job.label}: the tiles returned {self.n_features} of {total} features and the ObjectIDs of the rest can't be listed.")
+            logger.warning(f"{self.job.label}: the tiles returned {self.n_features} of {total} features and the ObjectIDs of the rest can't be listed.")
+            return
+
+        missing = sorted(set(object_ids) - self.seen)
+        print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: The tiles returned {self.n_features} of {total} features, fetching the {len(missing)} missing ones by ObjectID ({self.job.label})")
+        logger.warning(f"The tiles returned {self.n_features} of {total} features, fetching the {len(missing)} missing ones by ObjectID ({self.job.label})")
+        before = self.n_features
+        base_params = {k: v for k, v in self.job.feature_params.items() if k not in ['resultOffset', 'resultRecordCount']}
+        for i in range(0, len(missing), self.page_size):
+            params = dict(base_params, objectIds=",".join(str(oid) for oid in missing[i:i + self.page_size]))
+            data = self.client.query_with_retries(self.job.url, params, self.job.label)
+            if 'features' not in data:
+                raise Exception(f"Page without features for {self.job.label}: {data}")
+            yield self._deduplicate(data)
+        print(f"{datetime.datetime.now().strftime('%H:%M:%S')}: {self.n_features - before} features added by ObjectID ({self.job.label})")
+
+
+    def _run(self, task, tile):
+        # Runs in the pool, every outcome goes through the results queue.
+        try:
+            task(tile)
+        except BaseException as e:
+            self._put(('error', tile, e))
+
+
+    def _put(self, item):
+        # Blocks while the queue is full, gives up once the consumer is gone.
+        while not self._stop.is_set():
+            try:
+                self._results.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    def _count_tile(self, tile):
+
+        self._put(('count', tile, self._count(tile)))
+
+
+    def _fetch_tile(self, tile):
+
+        for data in self._fetch(tile):
+            if not self._put(('page', tile, data)):
+                return
+        self._put(('fetched', tile, None))
+
+
+    def _count(self, tile):
+
+        return self.client.get_feature_count(self.job.url, self.job.feature_params['where'], extra=tile.query_params(self.wkid), label=self.job.label)
+
+
+    def _fetch(self, tile):
+
+        params = dict(self.job.feature_params, **tile.query_params(self.wkid))
+        params['resultOffset'] = 0
+        return self.client.iter_pages(self.job.url, params, self.job.label)
+
+
+    def _deduplicate(self, data):
+
+        features = data['features']
+        if self.oid_field is None:
+            self.n_features += len(features)
+            return data
+        if isinstance(features, pd.DataFrame):
+            column = f"attributes.{self.oid_field}"
+            if column not in features.columns:
+                self.n_features += len(features)
+                return data
+            keep = ~features[column].isin(self.seen) & ~features[column].duplicated()
+            self.seen.update(features.loc[keep, column].tolist())
+            self.n_features += int(keep.sum())
+            return dict(data, features=features[keep].reset_index(drop=True))
+
+        unique = []
+        for feature in features:
+            oid = (feature.get('attributes') or {}).get(self.oid_field)
+            if oid is None:
+                unique.append(feature)
+            elif oid not in self.seen:
+                self.seen.add(oid)
+                unique.append(feature)
+        self.n_features += len(unique)
+        return dict(data, features=unique)
@@ -1,67 +1,320 @@
+import os
 import pandas as pd
+import geopandas as gpd
 import numpy as np
-import ast
-from shapely.geometry import Polygon, Point, LineString
-
-
-# Function to create a Point from x and y
-def create_point(row):
-    if pd.isna(row['geometry.x']):
-        return np.nan
-    if pd.isna(row['geometry.y']):
-        return np.nan
-    return Point(row['geometry.x'], row['geometry.y'])
-
-# Function to convert the string to a shapely Polygon
-def create_polygon_from_string(coord_string):
-    if coord_string is None or (isinstance(coord_string, float) and pd.isnull(coord_string)):
-        return np.nan
-    if isinstance(coord_string, list):
-        if len(coord_string) == 0:  # Check if the evaluated result is empty
-            return np.nan
-        coordinates = coord_string[0]
-        polygon = Polygon(coordinates)   
-    else:
-        eval_result = ast.literal_eval(coord_string)
-        if len(eval_result) == 0:  # Check if the evaluated result is empty
-            return np.nan
-        coordinates = eval_result[0]
-        polygon = Polygon(coordinates)
-    return polygon
-
-def create_linestring_from_string(coord_string):
-    if coord_string is None or (isinstance(coord_string, float) and pd.isnull(coord_string)):
-        return np.nan
-    if isinstance(coord_string, list):
-        if len(coord_string) == 0:  # Check if the evaluated result is empty
-            return np.nan
-        coordinates = coord_string[0]
-        line = LineString(coordinates)   
-    else:
-        eval_result = ast.literal_eval(coord_string)
-        if len(eval_result) == 0:  # Check if the evaluated result is empty
-            return np.nan
-        coordinates = eval_result[0]
-        line = LineString(coordinates)
-    return line
+import json
+import threading
+from itertools import chain, compress
+import shapely
+
+from .config import OUTPUTS_DIR, RASTER_DIR
+
+
+def _parse_coordinates(values):
+    """
+    Coordinates column -> object array of lists. Strings only appear when the
+    frame was reloaded from csv, they are parsed once (json, not literal_eval).
+    """
+    values = pd.Series(values).to_numpy(dtype=object, copy=True) if not isinstance(values, np.ndarray) else values.copy()
+    for i in np.flatnonzero([isinstance(x, str) for x in values]):
+        values[i] = json.loads(values[i])
+    return values
+
+
+def _flatten_parts(values, min_points):
+    """
+    Esri rings/paths of every feature -> one coordinate array plus, per part,
+    the feature it belongs to. Parts with less than min_points are dropped.
+    """
+    is_list = np.fromiter((isinstance(x, list) for x in values), dtype=bool, count=len(values))
+    parts_per_feature = np.fromiter((len(x) if ok else 0 for x, ok in zip(values, is_list)), dtype=np.int64, count=len(values))
+    parts = list(chain.from_iterable(values[is_list]))
+    part_feature = np.repeat(np.arange(len(values)), parts_per_feature)
+    part_size = np.fromiter(map(len, parts), dtype=np.int64, count=len(parts))
+
+    keep = part_size >= min_points
+    if not keep.all():
+        parts = list(compress(parts, keep))
+        part_feature, part_size = part_feature[keep], part_size[keep]
+    if len(parts) == 0:
+        return np.empty((0, 2)), part_feature, part_size
+
+    points = list(chain.from_iterable(parts))
+    try:
+        coords = np.array(points, dtype=float)[:, :2]
+    except ValueError: # Mixed xy / xyz(m) vertices.
+        coords = np.array([point[:2] for point in points], dtype=float)
+    return coords, part_feature, part_size
+
+
+def _collect(parts, part_feature, n_features, multi_constructor):
+    """
+    One geometry per feature: the part itself when a feature has a single part,
+    a Multi* geometry otherwise. Features without parts get None.
+    """
+    geoms = np.full(n_features, None, dtype=object)
+    if len(parts) == 0:
+        return geoms
+    parts_per_feature = np.bincount(part_feature, minlength=n_features)
+    single = parts_per_feature[part_feature] == 1
+    geoms[part_feature[single]] = parts[single]
+    if (~single).any():
+        multi_features = part_feature[~single]
+        multi = multi_constructor(parts[~single], indices=np.unique(multi_features, return_inverse=True)[1])
+        geoms[np.unique(multi_features)] = multi
+    return geoms
+
+
+def build_points(x, y):
+    """
+    Points from the geometry.x / geometry.y columns in one call, None where x or y is missing.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    geoms = np.full(len(x), None, dtype=object)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    geoms[valid] = shapely.points(x[valid], y[valid])
+    return geoms
+
+
+def polygons_from_parts(coords, ring_feature, ring_size, n_features):
+    """
+    (Multi)Polygons of n_features features from the flat coordinates of their
+    rings (ring_feature: feature of every ring, in order, ring_size: its points).
+    Every ring is used: in Esri geometries outer rings are clockwise and holes
+    are counter-clockwise, each hole following the outer ring it belongs to.
+    """
+    if len(ring_size) == 0:
+        return np.full(n_features, None, dtype=object)
+
+    linearrings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(ring_size)), ring_size))
+    first_of_feature = np.r_[True, ring_feature[1:] != ring_feature[:-1]]
+    starts_polygon = first_of_feature | ~shapely.is_ccw(linearrings)
+    polygon_index = np.cumsum(starts_polygon) - 1
+    polygons = shapely.polygons(linearrings, indices=polygon_index)
+    return _collect(polygons, ring_feature[starts_polygon], n_features, shapely.multipolygons)
+
+
+def linestrings_from_parts(coords, path_feature, path_size, n_features):
+    """
+    (Multi)LineStrings of n_features features from the flat coordinates of their paths.
+    """
+    if len(path_size) == 0:
+        return np.full(n_features, None, dtype=object)
+
+    lines = shapely.linestrings(coords, indices=np.repeat(np.arange(len(path_size)), path_size))
+    return _collect(lines, path_feature, n_features, shapely.multilinestrings)
+
+
+def build_polygons(rings):
+    """
+    (Multi)Polygons from Esri json rings, built in bulk with shapely 2 (see polygons_from_parts).
+    """
+    values = _parse_coordinates(rings)
+    coords, ring_feature, ring_size = _flatten_parts(values, min_points=4)
+    return polygons_from_parts(coords, ring_feature, ring_size, len(values))
+
+
+def build_linestrings(paths):
+    """
+    (Multi)LineStrings from Esri json paths, built in bulk with shapely 2.
+    """
+    values = _parse_coordinates(paths)
+    coords, path_feature, path_size = _flatten_parts(values, min_points=2)
+    return linestrings_from_parts(coords, path_feature, path_size, len(values))
+
+
+def dequantize_features(features, transform):
+    """
+    Undoes quantizationParameters on Esri json features (in place): vertices come
+    as integers on the transform grid, delta encoded from the previous vertex
+    of the same path/ring, the first one of every path/ring relative to the
+    origin (the same in pbf, see pbf._decode_geometry). Points are absolute.
+    """
+    (x_scale, y_scale), (x_translate, y_translate) = transform['scale'][:2], transform['translate'][:2]
+    y_sign = -1.0 if transform.get('originPosition', 'upperLeft') == 'upperLeft' else 1.0
+
+    def convert(parts):
+        out = []
+        for part in parts:
+            xy = np.cumsum(np.asarray(part, dtype=float)[:, :2], axis=0)
+            xy[:, 0] = x_translate + xy[:, 0] * x_scale
+            xy[:, 1] = y_translate + y_sign * xy[:, 1] * y_scale
+            out.append(xy.tolist())
+        return out
+
+    for feature in features:
+        geometry = feature.get('geometry')
+        if not geometry:
+            continue
+        for key in ['rings', 'paths']:
+            if key in geometry:
+                geometry[key] = convert(geometry[key])
+        if 'points' in geometry:
+            geometry['points'] = convert([geometry['points']])[0]
+        if ('x' in geometry) and (geometry['x'] is not None):
+            geometry['x'] = x_translate + geometry['x'] * x_scale
+            geometry['y'] = y_translate + y_sign * geometry['y'] * y_scale
+    return features
 
 
 def assigning_geometry(df):
 
     if ('geometry.rings' in df.columns):
-        df['geometry'] = df['geometry.rings'].apply(create_polygon_from_string)
-        indices = df[~df['geometry.rings'].isna()].index
-        df.loc[indices,'geometry.rings'] = df.loc[indices,'geometry.rings'].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
+        df['geometry.rings'] = _parse_coordinates(df['geometry.rings'])
+        df['geometry'] = build_polygons(df['geometry.rings'])
         df = df.rename(columns={'geometry.rings' : 'rings'})
 
     if ('geometry.paths' in df.columns):
-        df['geometry'] = df['geometry.paths'].apply(create_linestring_from_string)
-        indices = df[~df['geometry.paths'].isna()].index
-        df.loc[indices,'geometry.paths'] = df.loc[indices,'geometry.paths'].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
+        df['geometry.paths'] = _parse_coordinates(df['geometry.paths'])
+        df['geometry'] = build_linestrings(df['geometry.paths'])
         df = df.rename(columns={'geometry.paths' : 'paths'})
 
     if (('geometry.x' in df.columns) and ('geometry.y' in df.columns)):
-        df['geometry'] = df.apply(create_point, axis=1)
+        df['geometry'] = build_points(df['geometry.x'], df['geometry.y'])
         df = df.rename(columns={'geometry.x' : 'x' , 'geometry.y' : 'y'})
     
     return df
+
+
+# Layer specific attribute fixes, {name_lower: function(df) -> df}. Applied by
+# ad_hoc_attributes_tweaks after the geometry is built (column names already lower case).
+AD_HOC_TWEAKS = {}
+
+
+def ad_hoc_attributes_tweaks(df, name_lower):
+    """
+    Applies the AD_HOC_TWEAKS of the layer, the frame is returned as is for the
+    layers without one.
+    """
+    tweak = AD_HOC_TWEAKS.get(name_lower)
+    if tweak is None:
+        return df
+    return tweak(df)
+
+
+def read_layer(path, columns=None, bbox=None):
+    """
+    Loads a downloaded layer whatever its format (GeoParquet, GeoJSON, GeoJSONSeq...).
+    columns: attributes to load (geometry is always loaded).
+    bbox: (minx, miny, maxx, maxy) filter, a row-group scan on parquet files.
+    """
+    if path.endswith(".parquet"):
+        if columns is not None:
+            columns = list(columns) + ['geometry']
+        try:
+            return gpd.read_parquet(path, columns=columns, bbox=bbox)
+        except ValueError:
+            # No bbox covering column (e.g. streamed files): filter after reading.
+            gdf = gpd.read_parquet(path, columns=columns)
+            return gdf if bbox is None else gdf.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]]
+    return gpd.read_file(path, columns=columns, bbox=bbox)
+
+
+LAYER_EXTENSIONS = ['.parquet', '.geojson', '.geojsonl'] # Layers read_layer can load.
+MAPPING_COLUMNS = ['level_1', 'level_2', 'level_3', 'file', 'filename', 'file_path']
+NOT_LAYERS_DIRS = ['http_cache', 'metrics', 'catalog', 'writers'] # Written next to the projects in the outputs directory.
+# Persisted listings, in a "_" directory (never walked) so writing them doesn't change the mtime of the root.
+INDEX_DIR = "_index"
+_index_lock = threading.Lock()
+
+
+def _scan_directory(path, previous, seen, depth, max_depth, rows, parents, skip=()):
+    """
+    Walks path down to max_depth, files at max_depth become rows
+    (level_1, ..., level_n, file name). A directory is listed again only when
+    its mtime changed since its listing in previous ({path: [mtime_ns, files,
+    subdirectories]}); the listings of the walk are collected in seen.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return
+    cached = previous.get(path)
+    if (cached is None) or (cached[0] != mtime):
+        files, subdirectories = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirectories.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+        cached = [mtime, sorted(files), sorted(subdirectories)]
+    seen[path] = cached
+
+    if depth == max_depth:
+        rows.extend(parents + [name] for name in cached[1])
+        return
+    for name in cached[2]:
+        if name.startswith((".", "_")) or (name in skip):
+            continue
+        _scan_directory(os.path.join(path, name), previous, seen, depth + 1, max_depth, rows, parents + [name])
+
+
+def indexed_listing(root, max_depth, index_path, skip=()):
+    """
+    [level_1, ..., level_max_depth, file name] of every file max_depth levels
+    under root (skip: top level directories left out). The directory listings
+    are persisted in index_path and only the directories whose mtime changed
+    are listed again, so an unchanged tree costs one stat per directory.
+    """
+    with _index_lock:
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        previous = index.get('directories', {}) if index.get('root') == root else {}
+        seen, rows = {}, []
+        _scan_directory(root, previous, seen, 0, max_depth, rows, [], skip)
+        if seen != previous:
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(os.path.dirname(index_path), exist_ok=True)
+                with open(tmp_path, "w") as f:
+                    json.dump({'root': root, 'directories': seen}, f)
+                os.replace(tmp_path, index_path)
+            except OSError:
+                pass # Read-only tree, the index is only a speed-up.
+    return rows
+
+
+def categories_mapping(outputs_dir=OUTPUTS_DIR):
+    """
+    Catalog of the downloaded layers: one row per layer file in
+    outputs_dir/{level_1: project}/{level_2: service}/{level_3: layer}/,
+    columns level_1, level_2, level_3, file (no extension), filename, file_path.
+    Listings come from the persisted index (see indexed_listing).
+    """
+    rows = indexed_listing(outputs_dir, 3, os.path.join(outputs_dir, INDEX_DIR, "catalog_index.json"), skip=NOT_LAYERS_DIRS)
+    mapping = pd.DataFrame(
+        [row[:3] + [os.path.splitext(row[3])[0], row[3], os.path.join(outputs_dir, *row)] for row in rows if os.path.splitext(row[3])[1] in LAYER_EXTENSIONS],
+        columns=MAPPING_COLUMNS,
+        )
+    return mapping.sort_values(['level_1', 'level_2', 'level_3', 'filename']).reset_index(drop=True)
+
+
+def shapefile_categories_mapping(outputs_dir=OUTPUTS_DIR):
+    """
+    categories_mapping() with a single file per layer (a layer downloaded in
+    several formats: geojson, else parquet, else geojsonl), what ARCGIS_Shapefiler exports.
+    """
+    mapping = categories_mapping(outputs_dir)
+    preference = {'.geojson': 0, '.parquet': 1, '.geojsonl': 2}
+    mapping['order'] = mapping['filename'].map(lambda x: preference[os.path.splitext(x)[1]])
+    mapping = mapping.sort_values('order').drop_duplicates(['level_1', 'level_2', 'level_3', 'file'])
+    return mapping.drop(columns='order').sort_values(['level_1', 'level_2', 'level_3', 'filename']).reset_index(drop=True)
+
+
+def raster_categories_mapping(raster_dir=RASTER_DIR):
+    """
+    Rasters written in raster_dir by ARCGIS_Rasterize ({level_2}_{file}.tif):
+    columns level_2, file, filename, file_path.
+    """
+    rows = indexed_listing(raster_dir, 0, os.path.join(raster_dir, INDEX_DIR, "rasters_index.json"))
+    records = []
+    for (filename,) in rows:
+        stem, extension = os.path.splitext(filename)
+        if extension in ['.tif', '.tiff']:
+            records.append([stem.split("_")[0], "_".join(stem.split("_")[1:]), filename, os.path.join(raster_dir, filename)])
+    return pd.DataFrame(records, columns=['level_2', 'file', 'filename', 'file_path'])
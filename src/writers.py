@@ -0,0 +1,213 @@
+import json
+
+import numpy as np
+import shapely
+
+
+STREAM_EXTENSIONS = {
+    'geojsonseq': ".geojsonl",
+    'parquet': ".parquet",
+    }
+
+OUTPUT_EXTENSIONS = {
+    'csv': ".csv",
+    'geojson': ".geojson",
+    'parquet': ".parquet",
+    }
+
+# Arrow type of the parquet column of a layer field. Integers go to int64 so
+# pages where nulls made them floats still fit; dates are left as they come.
+ARROW_FIELD_TYPES = {
+    'esriFieldTypeSmallInteger': "int64",
+    'esriFieldTypeInteger': "int64",
+    'esriFieldTypeOID': "int64",
+    'esriFieldTypeSingle': "float64",
+    'esriFieldTypeDouble': "float64",
+    'esriFieldTypeString': "string",
+    'esriFieldTypeGUID': "string",
+    'esriFieldTypeGlobalID': "string",
+    }
+
+
+class GeoJSONSeqWriter:
+    '''
+    Appends GeoDataFrames to a GeoJSONSeq / NDJSON file, one feature per line.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+        self.n_features = 0
+
+
+    def write(self, gdf):
+        self.write_encoded(encode_geojsonseq(gdf))
+
+
+    def write_encoded(self, encoded):
+        """
+        encoded: (text, n features) from encode_geojsonseq.
+        """
+        text, n_features = encoded
+        self.file.write(text)
+        self.n_features += n_features
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+class GeoParquetWriter:
+    '''
+    Appends GeoDataFrames to a GeoParquet file, one row group per write().
+    Geometry is stored as WKB. The schema is the first page's with the types of
+    the layer fields (see ARROW_FIELD_TYPES), so a first page of whole numbers
+    doesn't make a double field int64. Pages are cast to it safely (missing
+    columns -> nulls), a page that doesn't fit raises.
+    fields: the layer fields ({'name', 'type'}, metadata or page ones).
+    '''
+    def __init__(self, path: str, compression: str = "zstd", fields: list = None):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise Exception("pyarrow is needed to write parquet outputs (pip install pyarrow).")
+        self.path = path
+        self.compression = compression
+        self.writer = None
+        self.schema = None
+        self.n_features = 0
+        self.field_types = {field['name'].lower(): ARROW_FIELD_TYPES[field['type']] for field in fields or []
+                            if field.get('name') and field.get('type') in ARROW_FIELD_TYPES}
+
+
+    def write(self, gdf):
+        self.write_encoded(encode_parquet_page(gdf))
+
+
+    def write_encoded(self, encoded):
+        """
+        encoded: (arrow table, geo metadata) from encode_parquet_page.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table, geo_metadata = encoded
+        if self.writer is None:
+            fields = [self._schema_field(field) for field in table.schema]
+            self.schema = pa.schema(fields, metadata={b"geo": json.dumps(geo_metadata).encode()})
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+
+        self.writer.write_table(_conform(table, self.schema))
+        self.n_features += len(table)
+
+
+    def _schema_field(self, field):
+        import pyarrow as pa
+
+        # 'attributes.area' -> 'area'
+        field_type = self.field_types.get(field.name.rsplit(".", 1)[-1].lower())
+        if field_type is not None:
+            return pa.field(field.name, pa.type_for_alias(field_type))
+        if pa.types.is_null(field.type):
+            return pa.field(field.name, pa.string()) # All-null column of an unknown field, keep it as strings.
+        return field
+
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def write_geoparquet(gdf, path: str, compression: str = "zstd", row_group_size: int = 50000):
+    """
+    Whole layer -> GeoParquet (WKB geometry + bbox covering column so readers can
+    filter row groups by extent). Dtypes are kept, only nested objects become strings.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise Exception("pyarrow is needed to write parquet outputs (pip install pyarrow).")
+    gdf = gdf.set_geometry(gdf.geometry)
+    attributes = _attributes_frame(gdf)
+    out = gdf[[gdf.geometry.name]].join(attributes)[list(attributes.columns) + [gdf.geometry.name]]
+    out.to_parquet(path, compression=compression, row_group_size=row_group_size, geometry_encoding="WKB", write_covering_bbox=True, index=False)
+
+
+def encode_geojsonseq(gdf):
+    """
+    Page -> (GeoJSONSeq text, n features), the CPU heavy part of GeoJSONSeqWriter.write.
+    """
+    lines = [json.dumps(feature, default=_json_default) for feature in gdf.iterfeatures(na='null', drop_id=True)]
+    return "".join(f"{line}\n" for line in lines), len(gdf)
+
+
+def encode_parquet_page(gdf):
+    """
+    Page -> (arrow table with WKB geometry, geo metadata), the CPU heavy part of GeoParquetWriter.write.
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(_attributes_frame(gdf), preserve_index=False)
+    table = table.append_column(gdf.geometry.name, pa.array(shapely.to_wkb(np.asarray(gdf.geometry.values)), type=pa.binary()))
+    return table, _geo_metadata(gdf)
+
+
+def encode_page(gdf, stream_format: str):
+    if stream_format == 'geojsonseq':
+        return encode_geojsonseq(gdf)
+    if stream_format == 'parquet':
+        return encode_parquet_page(gdf)
+    raise Exception(f"Unknown stream format '{stream_format}', options: {list(STREAM_EXTENSIONS)}")
+
+
+def open_stream_writer(path: str, stream_format: str, fields: list = None):
+    if stream_format == 'geojsonseq':
+        return GeoJSONSeqWriter(path)
+    if stream_format == 'parquet':
+        return GeoParquetWriter(path, fields=fields)
+    raise Exception(f"Unknown stream format '{stream_format}', options: {list(STREAM_EXTENSIONS)}")
+
+
+def _attributes_frame(gdf):
+
+    df = gdf.drop(columns=[gdf.geometry.name])
+    # Mixed python objects can't go to arrow, turn them into strings (like the geojson output).
+    object_cols = [col for col in df.select_dtypes('object').columns if df[col].map(lambda x: isinstance(x, (list, dict))).any()]
+    return df.astype({col: str for col in object_cols})
+
+
+def _conform(table, schema):
+    import pyarrow as pa
+
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            column = table.column(field.name)
+            if column.type != field.type:
+                try:
+                    column = column.cast(field.type) # Safe: fails instead of truncating or overflowing.
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as e:
+                    raise Exception(f"Column '{field.name}' ({column.type}) doesn't fit the {field.type} of the parquet file: {e}")
+        else:
+            column = pa.nulls(len(table), type=field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _geo_metadata(gdf):
+
+    metadata = {
+        "version": "1.0.0",
+        "primary_column": gdf.geometry.name,
+        "columns": {gdf.geometry.name: {"encoding": "WKB", "geometry_types": []}},
+        }
+    if gdf.crs is not None:
+        metadata["columns"][gdf.geometry.name]["crs"] = gdf.crs.to_json_dict()
+    return metadata
+
+
+def _json_default(value):
+
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
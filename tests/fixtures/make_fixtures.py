@@ -0,0 +1,145 @@
+'''
+Writes the /query fixtures of tests/test_pbf.py: for every answer the Esri
+json one (<name>.json) and the pbf one, as protobuf text (<name>.txtpb) and
+encoded by protoc with Esri's schema (<name>.pbf). Both carry the same
+quantized integers, so the two decode paths can be compared.
+
+    cd tests/fixtures && python make_fixtures.py
+'''
+import os
+import json
+import subprocess
+
+
+FIXTURES_DIR = os.path.dirname(os.path.abspath(__file__))
+SCALE = 1e-6
+
+POLYGON_FIELDS = [
+    ('OBJECTID', 'esriFieldTypeOID', 'uint_value'),
+    ('NAME', 'esriFieldTypeString', 'string_value'),
+    ('AREA', 'esriFieldTypeDouble', 'double_value'),
+    ('CODE', 'esriFieldTypeInteger', 'sint_value'),
+    ('CREATED', 'esriFieldTypeDate', 'int64_value'),
+    ]
+POLYGONS = [
+    # A polygon with a hole: clockwise outer ring, counter-clockwise hole.
+    ({'OBJECTID': 1, 'NAME': "Concesión Áncash", 'AREA': 0.0064, 'CODE': -12, 'CREATED': 1700000000000}, [
+        [(-77.4, -11.9), (-77.4, -11.8), (-77.3, -11.8), (-77.3, -11.9), (-77.4, -11.9)],
+        [(-77.38, -11.88), (-77.32, -11.88), (-77.32, -11.82), (-77.38, -11.82), (-77.38, -11.88)],
+        ]),
+    # Multipart: two outer rings, the second one with a hole.
+    ({'OBJECTID': 2, 'NAME': "Two parts", 'AREA': 0.0089, 'CODE': 7, 'CREATED': 1600000000000}, [
+        [(-77.1, -11.6), (-77.1, -11.55), (-77.05, -11.55), (-77.05, -11.6), (-77.1, -11.6)],
+        [(-76.9, -11.4), (-76.9, -11.3), (-76.8, -11.3), (-76.8, -11.4), (-76.9, -11.4)],
+        [(-76.88, -11.38), (-76.82, -11.38), (-76.82, -11.32), (-76.88, -11.32), (-76.88, -11.38)],
+        ]),
+    # Null geometry and a null attribute.
+    ({'OBJECTID': 3, 'NAME': "Sin geometría", 'AREA': 0.0, 'CODE': None, 'CREATED': 1500000000000}, None),
+    ]
+
+POLYLINE_FIELDS = [
+    ('OBJECTID', 'esriFieldTypeOID', 'uint_value'),
+    ('NAME', 'esriFieldTypeString', 'string_value'),
+    ('LENGTH_KM', 'esriFieldTypeSingle', 'float_value'),
+    ]
+POLYLINES = [
+    ({'OBJECTID': 10, 'NAME': "Two paths", 'LENGTH_KM': 2.5}, [
+        [(-77.4, -11.9), (-77.35, -11.85), (-77.3, -11.8)],
+        [(-77.2, -11.7), (-77.15, -11.65)],
+        ]),
+    ({'OBJECTID': 11, 'NAME': "One path", 'LENGTH_KM': 0.75}, [
+        [(-77.0, -11.5), (-76.95, -11.45), (-76.9, -11.5), (-76.85, -11.45)],
+        ]),
+    ({'OBJECTID': 12, 'NAME': None, 'LENGTH_KM': None}, None),
+    ]
+
+OBJECT_IDS = [1, 2, 3, 127, 128, 300, 70000, 2 ** 40]
+COUNT = 1234567
+
+
+def quantize(parts, translate, origin):
+    """
+    Parts -> quantized parts, every vertex a delta from the previous one of the
+    same part (the first one from the origin), y growing down for upperLeft.
+    """
+    y_sign = -1 if origin == 'upperLeft' else 1
+    out = []
+    for part in parts:
+        px, py, quantized = 0, 0, []
+        for x, y in part:
+            qx = round((x - translate[0]) / SCALE)
+            qy = round(y_sign * (y - translate[1]) / SCALE)
+            quantized.append([qx - px, qy - py])
+            px, py = qx, qy
+        out.append(quantized)
+    return out
+
+
+def _text_value(kind, value):
+    if value is None:
+        return "attributes { }"
+    if kind == 'string_value':
+        return f"attributes {{ string_value: {json.dumps(value, ensure_ascii=False)} }}"
+    return f"attributes {{ {kind}: {value!r} }}"
+
+
+def feature_answer(fields, features, geometry_type, key, translate, origin, exceeded):
+    """
+    (Esri json answer, protobuf text) of a feature query.
+    """
+    json_features, text_features = [], []
+    for attributes, parts in features:
+        quantized = quantize(parts, translate, origin) if parts is not None else None
+        json_features.append({'attributes': attributes, 'geometry': {key: quantized} if quantized is not None else None})
+        text = [_text_value(kind, attributes[name]) for name, _, kind in fields]
+        if quantized is not None:
+            lengths = [len(part) for part in quantized]
+            coords = [value for part in quantized for vertex in part for value in vertex]
+            text.append(f"geometry {{ lengths: {lengths} coords: {coords} }}")
+        text_features.append("      features {\n        " + "\n        ".join(text) + "\n      }")
+
+    answer = {
+        'objectIdFieldName': "OBJECTID",
+        'geometryType': f"esriGeometry{geometry_type}",
+        'spatialReference': {'wkid': 4326, 'latestWkid': 4326},
+        'transform': {'originPosition': origin, 'scale': [SCALE, SCALE, 0, 0], 'translate': [translate[0], translate[1], 0, 0]},
+        'fields': [{'name': name, 'type': field_type, 'alias': name.title()} for name, field_type, _ in fields],
+        'features': json_features,
+        }
+    if exceeded:
+        answer['exceededTransferLimit'] = True
+    text_fields = "\n".join(f'      fields {{ name: "{name}" fieldType: {field_type} alias: "{name.title()}" }}' for name, field_type, _ in fields)
+    text = f"""queryResult {{
+  featureResult {{
+      objectIdFieldName: "OBJECTID"
+      geometryType: esriGeometryType{geometry_type}
+      spatialReference {{ wkid: 4326 lastestWkid: 4326 }}
+      exceededTransferLimit: {str(exceeded).lower()}
+      transform {{
+        quantizeOriginPostion: {origin}
+        scale {{ xScale: {SCALE!r} yScale: {SCALE!r} }}
+        translate {{ xTranslate: {translate[0]!r} yTranslate: {translate[1]!r} }}
+      }}
+{text_fields}
+{chr(10).join(text_features)}
+  }}
+}}
+"""
+    return answer, text
+
+
+def write(name, answer, text):
+
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), "w", encoding="utf-8") as f:
+        json.dump(answer, f, ensure_ascii=False, indent=1)
+    with open(os.path.join(FIXTURES_DIR, f"{name}.txtpb"), "w", encoding="utf-8") as f:
+        f.write(text)
+    with open(os.path.join(FIXTURES_DIR, f"{name}.txtpb"), "rb") as source, open(os.path.join(FIXTURES_DIR, f"{name}.pbf"), "wb") as target:
+        subprocess.run(["protoc", "--encode=esriPBuffer.FeatureCollectionPBuffer", "FeatureCollection.proto"], stdin=source, stdout=target, cwd=FIXTURES_DIR, check=True)
+
+
+if __name__ == "__main__":
+    write("polygons", *feature_answer(POLYGON_FIELDS, POLYGONS, "Polygon", 'rings', (-78.0, -11.0), 'upperLeft', exceeded=True))
+    write("polylines", *feature_answer(POLYLINE_FIELDS, POLYLINES, "Polyline", 'paths', (-78.0, -12.0), 'lowerLeft', exceeded=False))
+    write("count", {'count': COUNT}, f"queryResult {{ countResult {{ count: {COUNT} }} }}\n")
+    write("ids", {'objectIdFieldName': "OBJECTID", 'objectIds': OBJECT_IDS}, f'queryResult {{ idsResult {{ objectIdFieldName: "OBJECTID" objectIds: {OBJECT_IDS} }} }}\n')
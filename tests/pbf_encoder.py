@@ -0,0 +1,102 @@
+'''
+Minimal encoder of /query?f=pbf answers (FeatureCollection protocol buffer)
+for the tests: the inverse of src/pbf.py for the messages it reads. Geometries
+are quantized like the server does it, zigzag deltas from the previous vertex
+of the same part.
+'''
+import struct
+
+GEOMETRY_TYPES = {'point': 0, 'multipoint': 1, 'polyline': 2, 'polygon': 3}
+ORIGINS = {'upperLeft': 0, 'lowerLeft': 1}
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def key(number, wire_type):
+    return varint((number << 3) | wire_type)
+
+
+def length_delimited(number, payload):
+    return key(number, 2) + varint(len(payload)) + payload
+
+
+def varint_field(number, value):
+    return key(number, 0) + varint(value)
+
+
+def double_field(number, value):
+    return key(number, 1) + struct.pack('<d', value)
+
+
+def packed(number, values):
+    return length_delimited(number, b''.join(varint(v) for v in values))
+
+
+def _value(value):
+    if isinstance(value, str):
+        return length_delimited(1, value.encode("utf-8"))
+    if isinstance(value, float):
+        return double_field(3, value)
+    return key(8, 0) + varint(zigzag(value))
+
+
+def quantize(parts, scale, translate, origin='upperLeft'):
+    """
+    [[(x, y), ...] per part] -> (lengths, zigzag deltas), restarting at every part.
+    """
+    y_sign = -1 if origin == 'upperLeft' else 1
+    lengths, coords = [], []
+    for part in parts:
+        lengths.append(len(part))
+        px, py = 0, 0
+        for x, y in part:
+            qx = round((x - translate[0]) / scale[0])
+            qy = round(y_sign * (y - translate[1]) / scale[1])
+            coords += [zigzag(qx - px), zigzag(qy - py)]
+            px, py = qx, qy
+    return lengths, coords
+
+
+def encode_features(features, geometry_type='polygon', scale=(1e-6, 1e-6), translate=(0.0, 0.0), origin='upperLeft', exceeded=False):
+    """
+    features: [(attributes dict, [[(x, y), ...] per part] or None)] -> pbf bytes.
+    The fields are the keys of the first feature, strings / doubles / sint64.
+    """
+    names = list(features[0][0].keys())
+    transform = varint_field(1, ORIGINS[origin]) \
+        + length_delimited(2, double_field(1, scale[0]) + double_field(2, scale[1])) \
+        + length_delimited(3, double_field(1, translate[0]) + double_field(2, translate[1]))
+    result = length_delimited(1, b'OBJECTID') + varint_field(7, GEOMETRY_TYPES[geometry_type]) \
+        + varint_field(9, int(exceeded)) + length_delimited(12, transform)
+    for name in names:
+        result += length_delimited(13, length_delimited(1, name.encode("utf-8")) + varint_field(2, 1))
+    for attributes, parts in features:
+        feature = b''.join(length_delimited(1, _value(attributes[name])) for name in names)
+        if parts is not None:
+            lengths, coords = quantize(parts, scale, translate, origin)
+            feature += length_delimited(2, packed(2, lengths) + packed(3, coords))
+        result += length_delimited(15, feature)
+    return length_delimited(2, length_delimited(1, result))
+
+
+def encode_count(count):
+    return length_delimited(2, length_delimited(2, varint_field(1, count)))
+
+
+def encode_object_ids(object_ids, field_name='OBJECTID'):
+    payload = length_delimited(1, field_name.encode("utf-8")) + packed(3, object_ids)
+    return length_delimited(2, length_delimited(3, payload))
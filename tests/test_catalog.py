@@ -0,0 +1,51 @@
+import os
+
+from src.catalog import ARCGIS_Catalog
+
+
+ITEM = "/server/rest/services"
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    '''
+    Services directory with one folder of two services, the layers of "Broken" can't be listed
+    until fixed.
+    '''
+    def __init__(self):
+        self.broken = True
+
+
+    def get(self, url, params=None):
+        path = url.split("example.com", 1)[1]
+        if path == ITEM:
+            return FakeResponse({'folders': ["Project"], 'services': []})
+        if path == f"{ITEM}/Project":
+            return FakeResponse({'services': [{'name': "Project/Good", 'type': "MapServer"}, {'name': "Project/Broken", 'type': "MapServer"}]})
+        if path.endswith("/Broken/MapServer/layers") and self.broken:
+            return FakeResponse({'error': {'code': 500, 'message': "Error handling service request"}})
+        return FakeResponse({'layers': [{'id': 0, 'name': "Roads", 'type': "Feature Layer"}], 'tables': []})
+
+
+def test_failed_layer_listing_is_not_persisted(tmp_path):
+    session = FakeSession()
+    catalog = ARCGIS_Catalog("https://example.com", ITEM, session, catalog_dir=str(tmp_path))
+    crawled = catalog.load()
+    assert list(crawled['Project']['Good']['layers']) == ["Roads"]
+    assert crawled['Project']['Broken']['layers'] == {}
+    assert not os.path.exists(catalog.path)
+
+    # The next run crawls again and gets the layers once the service answers.
+    session.broken = False
+    crawled = ARCGIS_Catalog("https://example.com", ITEM, session, catalog_dir=str(tmp_path)).load()
+    assert list(crawled['Project']['Broken']['layers']) == ["Roads"]
+    assert os.path.exists(catalog.path)
@@ -0,0 +1,43 @@
+import pytest
+
+from src.checkpoints import PageJournal
+
+
+def _page(i):
+    return {'features': [{'attributes': {'OBJECTID': i}}], 'exceededTransferLimit': True}
+
+
+def test_journal_replays_the_pages_in_order(tmp_path):
+    journal = PageJournal(str(tmp_path / "layer.pages.jsonl"))
+    assert not journal.exists()
+    assert list(journal.replay()) == []
+    for i in range(3):
+        journal.append(_page(i))
+    assert list(journal.replay()) == [_page(i) for i in range(3)]
+
+
+def test_journal_truncate_drops_pages_the_checkpoint_does_not_know(tmp_path):
+    # A crash after writing page 3 but before saving the checkpoint (2 pages).
+    journal = PageJournal(str(tmp_path / "layer.pages.jsonl"))
+    for i in range(3):
+        journal.append(_page(i))
+    journal.truncate(2)
+    assert list(journal.replay()) == [_page(0), _page(1)]
+    journal.append(_page(5))
+    assert list(journal.replay()) == [_page(0), _page(1), _page(5)]
+
+
+def test_journal_truncate_short_journal_fails(tmp_path):
+    journal = PageJournal(str(tmp_path / "layer.pages.jsonl"))
+    journal.append(_page(0))
+    with pytest.raises(Exception, match="less than 2 pages"):
+        journal.truncate(2)
+
+
+def test_journal_truncate_creates_and_remove_deletes(tmp_path):
+    journal = PageJournal(str(tmp_path / "layer.pages.jsonl"))
+    journal.truncate(0)
+    assert journal.exists() and list(journal.replay()) == []
+    journal.remove()
+    assert not journal.exists()
+    journal.remove() # Nothing to remove, no error.
@@ -0,0 +1,140 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import shapely
+
+from src.arcgis_client import ARCGIS_Client, layer_fields, normalize_frame, page_frame
+from src.pbf import decode_feature_collection
+from tests.pbf_encoder import encode_features, quantize
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+URL = "https://example.com/arcgis/rest/services/project/MapServer/0/query"
+
+
+def _response(content: bytes):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = content
+    response.encoding = "utf-8"
+    return response
+
+
+def _fixture(name, extension):
+    with open(os.path.join(FIXTURES_DIR, f"{name}.{extension}"), "rb") as f:
+        return f.read()
+
+
+def _decode(content, query_format):
+    return ARCGIS_Client().decode_response(_response(content), URL, {'f': query_format})
+
+
+def _layer_frame(page):
+    return normalize_frame(page_frame(page['features']), "layer")
+
+
+def assert_same_page(pbf_page, json_page):
+    """
+    Same attributes (values and dtypes) and geometries from the pbf and the json path.
+    """
+    pbf_frame, json_frame = _layer_frame(pbf_page), _layer_frame(json_page)
+    columns = [col for col in json_frame.columns if col.startswith("attributes.")]
+    assert [col for col in pbf_frame.columns if col.startswith("attributes.")] == columns
+    pd.testing.assert_frame_equal(pbf_frame[columns], json_frame[columns])
+    for from_pbf, from_json in zip(pbf_frame['geometry'], json_frame['geometry']):
+        if from_json is None:
+            assert from_pbf is None
+        else:
+            assert from_pbf.geom_type == from_json.geom_type
+            assert shapely.equals_exact(from_pbf, from_json, tolerance=1e-9)
+    assert pbf_page.get('exceededTransferLimit', False) == json_page.get('exceededTransferLimit', False)
+
+
+@pytest.mark.parametrize("name", ["polygons", "polylines"])
+def test_fixture_pbf_matches_json(name):
+    assert_same_page(_decode(_fixture(name, "pbf"), 'pbf'), _decode(_fixture(name, "json"), 'json'))
+
+
+def test_fixture_polygons_geometries():
+    geometries = decode_feature_collection(_fixture("polygons", "pbf"))['features']['geometry']
+    assert geometries[0].geom_type == "Polygon" and len(geometries[0].interiors) == 1
+    assert geometries[1].geom_type == "MultiPolygon" and [len(p.interiors) for p in geometries[1].geoms] == [0, 1]
+    assert geometries[2] is None
+    assert shapely.equals_exact(geometries[0].exterior, shapely.LinearRing([(-77.4, -11.9), (-77.4, -11.8), (-77.3, -11.8), (-77.3, -11.9)]), tolerance=1e-9)
+
+
+def test_fixture_fields_and_nulls():
+    page = decode_feature_collection(_fixture("polygons", "pbf"))
+    json_page = json.loads(_fixture("polygons", "json"))
+    assert page['fields'] == json_page['fields'] # name, type, alias
+    features = page['features']
+    assert features['attributes.NAME'].tolist() == ["Concesión Áncash", "Two parts", "Sin geometría"]
+    assert features['attributes.CODE'].iloc[:2].tolist() == [-12, 7] and np.isnan(features['attributes.CODE'].iloc[2])
+    assert features['attributes.CREATED'].dtype == np.int64
+
+
+def test_fields_completed_from_metadata():
+    page = decode_feature_collection(_fixture("polylines", "pbf"))
+    domain = {'type': "codedValue", 'name': "Names", 'codedValues': [{'name': "One path", 'code': "One path"}]}
+    metadata = {'fields': [
+        {'name': "OBJECTID", 'type': "esriFieldTypeOID", 'alias': "Objectid"},
+        {'name': "NAME", 'type': "esriFieldTypeString", 'alias': "Name", 'length': 50, 'domain': domain},
+        ]}
+    fields = layer_fields(page['fields'], metadata)
+    assert [field['type'] for field in fields] == ["esriFieldTypeOID", "esriFieldTypeString", "esriFieldTypeSingle"]
+    assert fields[1]['length'] == 50 and fields[1]['domain'] == domain
+    assert layer_fields([], metadata) == metadata['fields'] # geojson pages
+
+
+@pytest.mark.parametrize("name", ["count", "ids"])
+def test_fixture_count_and_ids_match_json(name):
+    assert _decode(_fixture(name, "pbf"), 'pbf') == _decode(_fixture(name, "json"), 'json')
+
+
+def test_large_page_matches_json():
+    # Random multipart polygons, strings full of "z" (the feature key byte) and
+    # nulls: the feature framing and the columnar decode against the json path.
+    rng = np.random.default_rng(0)
+    scale, translate = (1e-6, 1e-6), (-80.0, 0.0)
+    features, json_features = [], []
+    for oid in range(1, 501):
+        parts = []
+        for _ in range(rng.integers(1, 4)):
+            cx, cy = rng.uniform(-79, -70), rng.uniform(-17, -1)
+            radius = rng.uniform(0.001, 0.1)
+            ring = [(cx - radius, cy - radius), (cx - radius, cy + radius), (cx + radius, cy + radius), (cx + radius, cy - radius)]
+            parts.append(ring + [ring[0]])
+        attributes = {
+            'OBJECTID': oid,
+            'NAME': "z" * int(rng.integers(0, 200)) if oid % 13 else "",
+            'VALUE': float(rng.normal()),
+            }
+        geometry = parts if oid % 17 else None
+        features.append((attributes, geometry))
+        if geometry is None:
+            json_features.append({'attributes': attributes})
+            continue
+        lengths, deltas = quantize(geometry, scale, translate)
+        pairs = [[(value >> 1) ^ -(value & 1) for value in deltas[i:i + 2]] for i in range(0, len(deltas), 2)]
+        rings, start = [], 0
+        for length in lengths:
+            rings.append(pairs[start:start + length])
+            start += length
+        json_features.append({'attributes': attributes, 'geometry': {'rings': rings}})
+
+    pbf_page = _decode(encode_features(features, 'polygon', scale, translate), 'pbf')
+    json_page = _decode(json.dumps({
+        'features': json_features,
+        'transform': {'originPosition': 'upperLeft', 'scale': list(scale), 'translate': list(translate)},
+        }).encode("utf-8"), 'json')
+    assert len(pbf_page['features']) == 500
+    assert_same_page(pbf_page, json_page)
+
+
+def test_empty_page():
+    page = decode_feature_collection(b"\x12\x02\x0a\x00") # queryResult { featureResult { } }
+    assert len(page['features']) == 0
@@ -0,0 +1,70 @@
+import json
+
+import shapely
+
+from src.arcgis_client import ARCGIS_Client, features_to_geodataframe
+from src.layer_job import LayerJob
+from src.pbf import decode_feature_collection
+from src.utils import dequantize_features
+from tests.pbf_encoder import encode_features, quantize
+
+
+SCALE = (1e-6, 1e-6)
+TRANSLATE = (-77.5, -11.5) # upperLeft corner of the extent
+TRANSFORM = {'originPosition': 'upperLeft', 'scale': list(SCALE), 'translate': list(TRANSLATE)}
+
+MULTI_POLYGON = [
+    [(-77.4, -11.9), (-77.4, -11.8), (-77.3, -11.8), (-77.3, -11.9), (-77.4, -11.9)],
+    [(-77.38, -11.88), (-77.32, -11.88), (-77.32, -11.82), (-77.38, -11.82), (-77.38, -11.88)], # hole
+    [(-77.1, -11.6), (-77.1, -11.55), (-77.05, -11.55), (-77.05, -11.6), (-77.1, -11.6)],
+    ]
+MULTI_LINE = [
+    [(-77.4, -11.9), (-77.35, -11.85), (-77.3, -11.8)],
+    [(-77.2, -11.7), (-77.15, -11.65)],
+    ]
+
+
+def _json_features(parts, key):
+    # Esri json quantized the same way as the pbf ones (zigzag undone).
+    lengths, deltas = quantize(parts, SCALE, TRANSLATE)
+    deltas = [(value >> 1) ^ -(value & 1) for value in deltas]
+    pairs = [deltas[i:i + 2] for i in range(0, len(deltas), 2)]
+    out, start = [], 0
+    for length in lengths:
+        out.append(pairs[start:start + length])
+        start += length
+    return [{'attributes': {'OBJECTID': 1}, 'geometry': {key: out}}]
+
+
+def test_multipart_polygon_pbf_matches_json():
+    features = dequantize_features(_json_features(MULTI_POLYGON, 'rings'), TRANSFORM)
+    from_json = features_to_geodataframe(features, "layer").geometry.iloc[0]
+    page = decode_feature_collection(encode_features([({'OBJECTID': 1}, MULTI_POLYGON)], 'polygon', SCALE, TRANSLATE))
+    from_pbf = page['features']['geometry'].iloc[0]
+
+    assert from_pbf.geom_type == "MultiPolygon"
+    assert len(from_pbf.geoms[0].interiors) == 1
+    assert shapely.equals_exact(from_pbf, from_json, tolerance=1e-9)
+    assert shapely.equals_exact(from_pbf, shapely.MultiPolygon([(MULTI_POLYGON[0], [MULTI_POLYGON[1]]), (MULTI_POLYGON[2], [])]), tolerance=1e-9)
+
+
+def test_multipart_polyline_pbf_matches_json():
+    features = dequantize_features(_json_features(MULTI_LINE, 'paths'), TRANSFORM)
+    page = decode_feature_collection(encode_features([({'OBJECTID': 1}, MULTI_LINE)], 'polyline', SCALE, TRANSLATE))
+    from_pbf = page['features']['geometry'].iloc[0]
+
+    assert shapely.equals_exact(from_pbf, shapely.MultiLineString(features[0]['geometry']['paths']), tolerance=1e-9)
+    assert shapely.equals_exact(from_pbf, shapely.MultiLineString(MULTI_LINE), tolerance=1e-9)
+
+
+def test_quantization_uses_layer_extent():
+    client = ARCGIS_Client(geometry_options={'quantization_tolerance': 0.5}, layer_geometry_options={'roads': {'quantization_tolerance': 2.0}})
+    job = LayerJob("project", "service", "roads", "/services/project/MapServer/0", "https://example.com")
+    job.metadata = {'extent': {'xmin': 100000.0, 'ymin': 8000000.0, 'xmax': 900000.0, 'ymax': 9000000.0, 'spatialReference': {'wkid': 32718}}}
+    params = json.loads(client.generalization_params(job)['quantizationParameters'])
+    assert params['extent'] == job.metadata['extent']
+    assert params['tolerance'] == 2.0
+
+    job.metadata = {}
+    params = json.loads(client.generalization_params(job)['quantizationParameters'])
+    assert params['extent']['spatialReference'] == {'wkid': 4326}
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from src.rasterizer import mode_downsample
+
+
+def brute_mode(array, factor):
+    """Most frequent value (smallest on ties) of every block, one block at a time."""
+    height, width = array.shape
+    out = np.empty((-(-height // factor), -(-width // factor)), dtype=array.dtype)
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            values, counts = np.unique(array[i * factor:(i + 1) * factor, j * factor:(j + 1) * factor], return_counts=True)
+            out[i, j] = values[np.argmax(counts)]
+    return out
+
+
+@pytest.mark.parametrize("shape, factor, chunk_pixels", [
+    ((40, 40), 4, 4_000_000),
+    ((37, 53), 4, 4_000_000),
+    ((37, 53), 4, 100), # One output row per strip.
+    ((101, 7), 3, 50),
+    ((5, 3), 4, 10), # Smaller than one block.
+    ((9, 9), 10, 1),
+])
+def test_mode_downsample_matches_brute_force(shape, factor, chunk_pixels):
+    array = np.random.default_rng(0).integers(0, 4, shape).astype(np.uint8)
+    assert (mode_downsample(array, factor, chunk_pixels) == brute_mode(array, factor)).all()
+
+
+def test_mode_downsample_edge_blocks_not_biased():
+    # Right block: real pixels 1,1,1 | 2,2,0 -> 1. Repeating the border column would make it 2.
+    array = np.zeros((3, 5), dtype=np.uint8)
+    array[:, 3] = 1
+    array[:, 4] = [2, 2, 0]
+    assert mode_downsample(array, 3).tolist() == [[0, 1]]
+
+
+def test_mode_downsample_factor_one_is_identity():
+    array = np.arange(6).reshape(2, 3)
+    assert mode_downsample(array, 1) is array
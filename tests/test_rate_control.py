@@ -0,0 +1,73 @@
+import requests
+
+from benchmarks.mock_arcgis_server import ARCGIS_MockServer
+from src.arcgis_client import ARCGIS_Client
+from src.layer_job import LayerJob
+from src.rate_control import AdaptivePageSize, ARCGIS_ServerError, backoff_delay, is_client_error, is_rejected_query, is_throttled, retry_after_seconds
+
+
+def test_page_size_halves_on_failure_down_to_min():
+    sizer = AdaptivePageSize(1000, min_size=100)
+    assert [sizer.failure() for _ in range(5)] == [500, 250, 125, 100, 100]
+
+
+def test_page_size_grows_back_additively_up_to_max():
+    sizer = AdaptivePageSize(1000, min_size=10, increase=300)
+    sizer.failure()
+    sizer.failure()
+    assert [sizer.success() for _ in range(4)] == [550, 850, 1000, 1000]
+
+
+def test_page_size_default_increase_is_a_tenth():
+    sizer = AdaptivePageSize(2000)
+    sizer.failure()
+    assert sizer.success() == 1200
+
+
+def test_page_size_cap_lowers_the_max():
+    sizer = AdaptivePageSize(2000, min_size=10)
+    assert sizer.cap(1000) == 1000
+    assert sizer.success() == 1000
+    assert sizer.cap(5) == 10 # Never under min_size.
+    assert sizer.cap(5000) == 10 # Nor above a previous cap.
+
+
+def test_client_errors_are_not_retried():
+    assert [is_client_error(code) for code in [400, 403, 404, 499]] == [True] * 4
+    assert [is_client_error(code) for code in [None, 200, 408, 429, 500, 503]] == [False] * 6
+
+
+def test_timeouts_answered_with_400_are_retried():
+    assert is_rejected_query({'code': 400, 'message': "Invalid query parameters.", 'details': ["'where' parameter is invalid"]})
+    assert not is_rejected_query({'code': 400, 'message': "Unable to complete operation.", 'details': []})
+    assert not is_rejected_query({'code': 400, 'message': "Error", 'details': ["The operation has timed out."]})
+    assert not is_rejected_query({'code': 500, 'message': "Error performing query operation."})
+
+
+def test_throttled():
+    assert is_throttled(ARCGIS_ServerError("", 429))
+    assert is_throttled(ARCGIS_ServerError("", 503, retry_after=2.0))
+    assert not is_throttled(ARCGIS_ServerError("", 503))
+    assert not is_throttled(ARCGIS_ServerError("", 400))
+
+
+def test_throttled_parallel_pages_wait_instead_of_failing():
+    with ARCGIS_MockServer(folders=1, services_per_folder=1, layers_per_service=1, features=200, max_record_count=20, vertices=4, rate_limit=5, retry_after=1) as server:
+        client = ARCGIS_Client(base_url=server.url, item=server.item, page_workers=8, page_retries=5, backoff=0.01)
+        job = LayerJob("Folder0", "Service0", "layer", f"{server.item}/Folder0/Service0/MapServer/0", server.url)
+        job.metadata = {}
+        params = {'f': "json", 'where': "1=1", 'outFields': "*", 'returnGeometry': "false", 'resultOffset': 0, 'resultRecordCount': 20}
+        features, fields = client.get_request_parallel(job.url, params, job, workers=8)
+    assert server.stats['throttled'] > 0
+    assert sorted(feature['attributes']['OBJECTID'] for feature in features) == list(range(1, 201))
+
+
+def test_retry_after():
+    response = requests.Response()
+    assert retry_after_seconds(response) is None
+    response.headers['Retry-After'] = "7"
+    assert retry_after_seconds(response) == 7.0
+    response.headers['Retry-After'] = "Wed, 21 Oct 2015 07:28:00 GMT" # In the past.
+    assert retry_after_seconds(response) == 0.0
+    assert backoff_delay(5, retry_after=3.0) == 3.0
+    assert 0 <= backoff_delay(10, base=1.0, cap=4.0) <= 4.0
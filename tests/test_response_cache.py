@@ -0,0 +1,100 @@
+import os
+import time
+
+import pytest
+import requests
+
+from src.response_cache import ARCGIS_CacheMiss, ARCGIS_ResponseCache, cache_key, endpoint_type
+
+
+LAYER = "https://example.com/arcgis/rest/services/Project/Service/MapServer/3"
+QUERY = f"{LAYER}/query"
+
+
+def _response(body: bytes, status_code: int = 200):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.url = QUERY
+    response.encoding = "utf-8"
+    response.headers['Content-Type'] = "application/json"
+    return response
+
+
+def test_cache_key_ignores_parameter_order_and_placement():
+    assert cache_key("GET", f"{QUERY}?f=json&where=1%3D1", None) == cache_key("get", QUERY, {'where': "1=1", 'f': "json"})
+    assert cache_key("GET", QUERY, {'f': "json", 'resultOffset': 0}) != cache_key("GET", QUERY, {'f': "json", 'resultOffset': 1000})
+
+
+def test_endpoint_types():
+    assert endpoint_type(LAYER) == 'metadata'
+    assert endpoint_type(f"{LAYER[:-2]}/layers") == 'metadata'
+    assert endpoint_type("https://example.com/arcgis/rest/services/Project") == 'catalog'
+    assert endpoint_type(QUERY, {'where': "1=1", 'resultOffset': 0}) == 'query'
+    assert endpoint_type(QUERY, {'where': "1=1", 'returnCountOnly': "true"}) == 'probe'
+    assert endpoint_type(f"{QUERY}?returnIdsOnly=true", None) == 'probe'
+    assert endpoint_type(QUERY, {'returnCountOnly': "false"}) == 'query'
+
+
+def test_put_and_get(tmp_path):
+    cache = ARCGIS_ResponseCache(str(tmp_path))
+    params = {'f': "json", 'where': "1=1", 'resultOffset': 0}
+    assert cache.get("GET", QUERY, params) is None
+    cache.put("GET", QUERY, params, _response(b'{"features": []}'))
+    cached = cache.get("GET", QUERY, dict(reversed(list(params.items()))))
+    assert cached.from_cache and cached.json() == {'features': []}
+    assert cached.headers['content-type'] == "application/json"
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 1
+    # Entries survive a new cache on the same directory.
+    assert ARCGIS_ResponseCache(str(tmp_path)).get("GET", QUERY, params).content == b'{"features": []}'
+
+
+@pytest.mark.parametrize("body", [b'{"error": {"code": 500}}', b'{ "error" : {"code": 400}}', b'  {\n"error":{}}'])
+def test_error_bodies_are_not_stored(tmp_path, body):
+    cache = ARCGIS_ResponseCache(str(tmp_path))
+    cache.put("GET", QUERY, {'f': "json"}, _response(body))
+    cache.put("GET", LAYER, {'f': "json"}, _response(b"", status_code=503))
+    assert cache.size() == 0 and cache.stats['stored'] == 0
+
+
+def test_probes_are_only_served_offline(tmp_path):
+    params = {'f': "json", 'where': "1=1", 'returnCountOnly': "true"}
+    cache = ARCGIS_ResponseCache(str(tmp_path))
+    cache.put("GET", QUERY, params, _response(b'{"count": 10}'))
+    assert cache.get("GET", QUERY, params) is None
+    assert ARCGIS_ResponseCache(str(tmp_path), offline=True).get("GET", QUERY, params).json() == {'count': 10}
+
+
+def test_expired_entries_are_missed_online_served_offline(tmp_path):
+    params = {'f': "json"}
+    cache = ARCGIS_ResponseCache(str(tmp_path), ttls={'metadata': 0.05})
+    cache.put("GET", LAYER, params, _response(b'{"id": 3}'))
+    assert cache.get("GET", LAYER, params) is not None
+    time.sleep(0.1)
+    assert cache.get("GET", LAYER, params) is None
+    offline = ARCGIS_ResponseCache(str(tmp_path), offline=True)
+    assert offline.get("GET", LAYER, params).json() == {'id': 3}
+    with pytest.raises(ARCGIS_CacheMiss):
+        offline.get("GET", LAYER, {'f': "pjson"})
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ARCGIS_ResponseCache(str(tmp_path), compresslevel=0)
+    body = os.urandom(2000)
+    for offset in range(3):
+        cache.put("GET", QUERY, {'resultOffset': offset}, _response(body))
+    cache.get("GET", QUERY, {'resultOffset': 0}) # Used again, 1 is now the oldest.
+    # Room for two of the three entries, whatever the size of their headers.
+    cache.max_bytes = int(0.8 * cache.size())
+    cache.put("GET", QUERY, {'resultOffset': 0}, _response(body)) # Triggers the eviction.
+    assert cache.size() <= 0.9 * cache.max_bytes
+    assert cache.get("GET", QUERY, {'resultOffset': 1}) is None
+    assert cache.get("GET", QUERY, {'resultOffset': 0}) is not None
+    assert cache.stats['evicted'] >= 1
+
+
+def test_clear(tmp_path):
+    cache = ARCGIS_ResponseCache(str(tmp_path))
+    cache.put("GET", QUERY, {'f': "json"}, _response(b'{"features": []}'))
+    cache.clear()
+    assert cache.size() == 0 and cache.get("GET", QUERY, {'f': "json"}) is None
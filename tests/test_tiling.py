@@ -0,0 +1,100 @@
+import json
+import threading
+
+from src.layer_job import LayerJob
+from src.tiling import ARCGIS_TiledQuery
+
+
+class FakeClient:
+    '''
+    Point layer in memory answering the queries ARCGIS_TiledQuery makes.
+    Features without a point are never inside an envelope, like null geometries.
+    '''
+    def __init__(self, points):
+        self.points = points # {oid: (x, y) or None}
+        self.pages_served = 0
+        self.requested_by_id = []
+        self.lock = threading.Lock()
+
+
+    def _object_id_field(self, metadata):
+        return "OBJECTID"
+
+
+    def _matching(self, params):
+        if 'geometry' not in params:
+            return sorted(self.points)
+        box = json.loads(params['geometry'])
+        return sorted(oid for oid, xy in self.points.items() if xy is not None
+                      and box['xmin'] <= xy[0] <= box['xmax'] and box['ymin'] <= xy[1] <= box['ymax'])
+
+
+    def get_feature_count(self, url, where="1=1", extra: dict = None, label: str = None):
+        return len(self._matching(extra or {}))
+
+
+    def get_object_ids(self, url, where="1=1", label: str = None):
+        return self._matching({})
+
+
+    def query_with_retries(self, url, params, label, on_failure=None, retries=None):
+        object_ids = [int(oid) for oid in params['objectIds'].split(",")]
+        self.requested_by_id.extend(object_ids)
+        return {'features': [{'attributes': {'OBJECTID': oid}} for oid in object_ids if oid in self.points]}
+
+
+    def iter_pages(self, url, feature_params, label, sizer=None):
+        oids = self._matching(feature_params)
+        size = feature_params['resultRecordCount']
+        for start in range(feature_params['resultOffset'], len(oids), size):
+            with self.lock:
+                self.pages_served += 1
+            page = oids[start:start + size]
+            yield {'features': [{'attributes': {'OBJECTID': oid}} for oid in page], 'exceededTransferLimit': start + size < len(oids)}
+
+
+def _job(page_size=10):
+    job = LayerJob("project", "service", "layer", "/services/project/MapServer/0", "https://example.com")
+    job.metadata = {'extent': {'xmin': 0.0, 'ymin': 0.0, 'xmax': 10.0, 'ymax': 10.0, 'spatialReference': {'wkid': 4326}}}
+    job.feature_params = {'where': "1=1", 'resultOffset': 0, 'resultRecordCount': page_size}
+    return job
+
+
+def _grid_points(n):
+    return {oid: ((oid * 0.37) % 10, (oid * 0.73) % 10) for oid in range(1, n + 1)}
+
+
+def _oids(pages):
+    return [feature['attributes']['OBJECTID'] for data in pages for feature in data['features']]
+
+
+def test_tiles_return_every_feature_once():
+    client = FakeClient(_grid_points(200))
+    oids = _oids(ARCGIS_TiledQuery(client, _job(), workers=3).iter_pages())
+    assert sorted(oids) == list(range(1, 201))
+
+
+def test_missing_features_are_fetched_by_object_id():
+    points = _grid_points(200)
+    missing = list(range(1, 201, 7)) + [5]
+    for oid in range(1, 201, 7):
+        points[oid] = None # null geometry
+    points[5] = (50.0, 50.0) # outside the stated extent
+    client = FakeClient(points)
+    tiled = ARCGIS_TiledQuery(client, _job(), workers=3)
+    oids = _oids(tiled.iter_pages())
+    assert sorted(oids) == list(range(1, 201))
+    assert tiled.n_features == 200
+    # Only the missing ones, not the whole layer again.
+    assert sorted(client.requested_by_id) == sorted(missing)
+
+
+def test_pages_are_streamed_with_backpressure():
+    client = FakeClient(_grid_points(400))
+    tiled = ARCGIS_TiledQuery(client, _job(page_size=10), workers=2, max_depth=0, queue_size=1)
+    pages = tiled.iter_pages()
+    next(pages)
+    # One page handed out, one waiting in the queue, one blocked on it at most.
+    assert client.pages_served <= 3
+    pages.close()
+    assert client.pages_served <= 3
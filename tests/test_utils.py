@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from src.utils import assigning_geometry, build_linestrings, build_points, build_polygons
+
+
+OUTER = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]] # clockwise
+HOLE = [[2, 2], [8, 2], [8, 8], [2, 8], [2, 2]] # counter-clockwise
+OTHER = [[20, 0], [20, 5], [25, 5], [25, 0], [20, 0]]
+
+
+def test_build_polygons():
+    rings = [
+        [OUTER, HOLE], # polygon with a hole
+        [OUTER, OTHER], # two polygons
+        [OUTER, HOLE, OTHER], # a hole follows its outer ring
+        None,
+        np.nan,
+        [],
+        [[[0, 0], [1, 1], [0, 0]]], # ring too short, dropped
+        json.dumps([OTHER]), # reloaded from csv
+        ]
+    geoms = build_polygons(pd.Series(rings, dtype=object))
+    assert shapely.equals(geoms[0], shapely.Polygon(OUTER, [HOLE]))
+    assert shapely.equals(geoms[1], shapely.MultiPolygon([shapely.Polygon(OUTER), shapely.Polygon(OTHER)]))
+    assert geoms[2].geom_type == "MultiPolygon" and [len(p.interiors) for p in geoms[2].geoms] == [1, 0]
+    assert list(geoms[3:7]) == [None, None, None, None]
+    assert shapely.equals(geoms[7], shapely.Polygon(OTHER))
+
+
+def test_build_polygons_without_rings():
+    assert list(build_polygons(pd.Series([None, np.nan], dtype=object))) == [None, None]
+
+
+def test_build_linestrings():
+    paths = [
+        [[[0, 0], [1, 1], [2, 0]]],
+        [[[0, 0], [1, 1]], [[5, 5], [6, 6], [7, 5]]],
+        [[[0, 0, 3.5], [1, 1, 4.5]]], # z dropped
+        None,
+        [[[9, 9]]], # single vertex, dropped
+        ]
+    geoms = build_linestrings(pd.Series(paths, dtype=object))
+    assert shapely.equals(geoms[0], shapely.LineString([[0, 0], [1, 1], [2, 0]]))
+    assert geoms[1].geom_type == "MultiLineString" and len(geoms[1].geoms) == 2
+    assert not geoms[2].has_z
+    assert geoms[3] is None and geoms[4] is None
+
+
+def test_build_points():
+    geoms = build_points([1.0, np.nan, 3.0], [2.0, 5.0, None])
+    assert shapely.equals(geoms[0], shapely.Point(1, 2))
+    assert geoms[1] is None and geoms[2] is None
+
+
+def test_assigning_geometry_renames_the_coordinate_columns():
+    df = pd.json_normalize([
+        {'attributes': {'id': 1}, 'geometry': {'rings': [OUTER]}},
+        {'attributes': {'id': 2}, 'geometry': None},
+        ])
+    df = assigning_geometry(df)
+    assert 'rings' in df.columns and 'geometry.rings' not in df.columns
+    assert shapely.equals(df['geometry'][0], shapely.Polygon(OUTER)) and df['geometry'][1] is None
+
+    df = assigning_geometry(pd.DataFrame({'geometry.x': [1.0], 'geometry.y': [2.0]}))
+    assert list(df.columns) == ['x', 'y', 'geometry'] and df['geometry'][0] == shapely.Point(1, 2)
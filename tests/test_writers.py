@@ -0,0 +1,43 @@
+import geopandas as gpd
+import pyarrow.parquet as pq
+import pytest
+import shapely
+
+from src.writers import GeoParquetWriter
+
+
+FIELDS = [
+    {'name': "OBJECTID", 'type': "esriFieldTypeOID"},
+    {'name': "AREA", 'type': "esriFieldTypeDouble"},
+    {'name': "CODE", 'type': "esriFieldTypeInteger"},
+    ]
+
+
+def _page(oids, areas, codes):
+    return gpd.GeoDataFrame({
+        'attributes.objectid': oids,
+        'attributes.area': areas,
+        'attributes.code': codes,
+        'geometry': [shapely.Point(oid, oid) for oid in oids],
+        }, geometry='geometry', crs="EPSG:4326")
+
+
+def test_pages_keep_the_layer_field_types(tmp_path):
+    path = str(tmp_path / "layer.parquet")
+    writer = GeoParquetWriter(path, fields=FIELDS)
+    writer.write(_page([1, 2], [5, 6], [1, 2])) # Whole numbers in a double field.
+    writer.write(_page([3, 4], [5.7, 6.2], [3, None])) # A null made the integers floats.
+    writer.close()
+
+    table = pq.read_table(path)
+    assert table.column('attributes.area').to_pylist() == [5.0, 6.0, 5.7, 6.2]
+    assert table.column('attributes.code').to_pylist() == [1, 2, 3, None]
+    assert str(table.schema.field('attributes.code').type) == "int64"
+
+
+def test_pages_that_dont_fit_raise(tmp_path):
+    writer = GeoParquetWriter(str(tmp_path / "layer.parquet")) # No field types.
+    writer.write(_page([1, 2], [5, 6], [1, 2]))
+    with pytest.raises(Exception, match="attributes.area"):
+        writer.write(_page([3, 4], [5.7, 6.2], [3, 4]))
+    writer.close()